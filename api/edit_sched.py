@@ -1,23 +1,34 @@
 import json
+import time
+import base64
+import binascii
+import hashlib
 import datetime
 import logging
 
 from urllib.error import HTTPError
-from flask import request, render_template
+from flask import request, render_template, g, Response
 
 from . import api as app
 from config import config
-from scheduler import SchedulerHandler
+from scheduler import get_handler
+from auth_cache import AuthCache
+from availability import AvailabilityCache, TAKEN
+from interval_index import format_minutes
+import metrics
+import job_summary
 from reserve import ReserveTem, ReserveTime
+from recurring import RecurringRules
 from instrument import Instrument
-from errors import InstrumentException, ReserveException
+from errors import InstrumentException, ReserveException, SchedulerException
 
 
 def auth(username, password):
     """验证用户名密码
 
     debug时，可以是测试用户，无需密码
-    其他情况，可以是管理员用户，或正确的易约帐号
+    其他情况，可以是管理员用户，或正确的易约帐号；
+    易约帐号的验证结果在AuthCache中缓存，缓存有效时不再登录
     """
     if config.debug and username in config.TEST_USERS:
         return True
@@ -27,11 +38,179 @@ def auth(username, password):
         else:
             return False
     else:
+        cached = AuthCache().get(username, password)
+        if cached is not None:
+            return cached
         r = ReserveTem()
         r.set_account(username, password)
         return r.login()
 
 
+def trigger_time_of(job):
+    """任务的开始预约时间，job本身会提前预热时间触发"""
+    return job.kwargs.get('trigger_time') or job.trigger.run_date
+
+
+def verify_account(reserve):
+    """设定预约前验证帐号，之后再检查日历、重叠的任务，未验证的请求不会触发这些查询
+
+    :param ReserveTem reserve: 已set_account
+    :return: 帐号错误或验证出错时返回给前端的dict，否则为None
+    """
+    try:
+        if reserve.check_account():
+            return None
+    except Exception as e:
+        logging.exception(e)
+        return dict(code=-4, msg='服务器出现错误')
+    return dict(code=-1, msg='帐号或密码错误')
+
+
+def check_availability(reserve_info):
+    """设定预约时检查时间段是否已被预约（见availability.py）
+
+    :return: (error, warning) 按`config.AVAILABILITY_MODE`，'reject'时返回给前端的error，'warn'时的提示
+    """
+    if config.AVAILABILITY_MODE == 'off':
+        return None, None
+    status, conflict = AvailabilityCache().check(reserve_info)
+    if status != TAKEN:
+        return None, None
+    msg = '该时间段已被预约（%s）' % conflict
+    if config.AVAILABILITY_MODE == 'reject':
+        return dict(code=-6, msg=msg), None
+    return None, msg + '，到时可能无法预约成功'
+
+
+def describe_intervals(intervals, username):
+    """区间索引的查询结果转换为返回给前端的列表，只有自己的任务（管理员为所有任务）才返回job_id和用户名
+
+    window是任务的第几个时间段：0为主时间段，i为第i个备选时间段
+    """
+    result = []
+    for start, end, job_id, owner, window in intervals:
+        item = dict(start_time=format_minutes(start), end_time=format_minutes(end), window=window,
+                    own=owner == username)
+        if owner == username or username == config.ADMIN_USERNAME:
+            item.update(job_id=job_id, username=owner)
+        result.append(item)
+    return result
+
+
+def check_conflicts(reserve_info, username, alternatives=()):
+    """设定预约时检查主时间段和备选时间段是否与已设定的任务时间重叠，到时这些任务会互相竞争同一时间段
+
+    :return: (conflicts, warning) 重叠的任务时间段（见`describe_intervals`）和提示，没有重叠时为([], None)
+             conflicts每项的request_window是新预约的第几个时间段与之重叠，0为主时间段，i为第i个备选时间段
+    """
+    handler = get_handler()
+    conflicts, jobs = [], {}
+    for request_window, data in enumerate([reserve_info] + list(alternatives)):
+        intervals = handler.get_conflicts(data)
+        for (_, _, job_id, owner, _), item in zip(intervals, describe_intervals(intervals, username)):
+            item['request_window'] = request_window
+            conflicts.append(item)
+            jobs[job_id] = owner == username
+    if not conflicts:
+        return [], None
+    # 同一任务可能有多个时间段重叠，按任务计数
+    own = sum(jobs.values())
+    if own == len(jobs):
+        warning = '与你已设定的%d个预约任务时间重叠' % own
+    else:
+        warning = '与已设定的%d个预约任务时间重叠（其中%d个是你的）' % (len(jobs), own)
+    return conflicts, warning
+
+
+def join_warnings(*warnings):
+    return '；'.join(warning for warning in warnings if warning) or None
+
+
+def parse_reservation(fields):
+    """解析一条预约的参数，参数说明见`api_reserve`
+
+    :param fields: request.form或dict
+    :return: (error, reserve_info, run_time)
+            error 参数有误时为返回给前端的dict，否则为None
+            reserve_info 预约POST请求提交的数据
+            run_time 开始预约的时间
+    """
+    instrument_name = fields.get('instrument', '')  # OLD_F20
+    raw_reserve_date = fields.get('reserve_date')  # '2017-01-01'
+    start_time = fields.get('start_time')  # '12:00'
+    end_time = fields.get('end_time')  # '13:00'
+    report = fields.get('report', 'tem')
+    reserve_time = fields.get('reserve_time', '')  # 开抢时间 2017-01-01 00:00:00
+
+    # 根据名称找到仪器对象
+    try:
+        instrument = Instrument.get(name=instrument_name)
+    except InstrumentException as e:
+        logging.info(e)
+        return dict(code=-2, msg="不存在该仪器: '%s'" % instrument_name), None, None
+    # 判断start_time，end_time，reserve_date是否符合要求
+    try:
+        datetime.datetime.strptime(start_time, '%H:%M')
+        datetime.datetime.strptime(end_time, '%H:%M')
+        reserve_date = datetime.datetime.strptime(raw_reserve_date, '%Y-%m-%d').date()
+        # 设定预约时间
+        if config.debug:
+            if reserve_time == '':
+                run_time = datetime.datetime.now()
+            else:
+                run_time = datetime.datetime.strptime(reserve_time, '%Y-%m-%d %H:%M:%S')
+        else:
+            # 根据实验时间和仪器自动判断预约时间
+            run_time = ReserveTime.get_time(instrument, reserve_date)
+    except (ValueError, TypeError) as e:
+        logging.warning('预约参数不正确：%s' % e)
+        return dict(code=-5, msg='预约参数不正确'), None, None
+
+    reserve_info = dict(
+        reserveDate=reserve_date.strftime('%Y年%m月%d日'),
+        reserveStartTime=start_time,
+        reserveEndTime=end_time,
+        instrumentId=instrument.instrument_id,
+        ReserveReport=report
+    )
+    return None, reserve_info, run_time
+
+
+def parse_alternatives(fields, run_time):
+    """解析一条预约的备选时间段
+
+    :param fields: request.form或dict，alternatives为JSON数组（或已解析的list），每一项字段与/api/reserve相同，
+            没有的字段与主预约相同，如只换时间段：[{"start_time": "13:00", "end_time": "17:00"}]
+    :param datetime.datetime run_time: 主预约开始预约的时间
+    :return: (error, alternatives) alternatives为备选的预约POST请求提交的数据的list
+    """
+    raw = fields.get('alternatives')
+    if not raw:
+        return None, []
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            raw = None
+    if not isinstance(raw, list) or not all(isinstance(item, dict) for item in raw):
+        return dict(code=-5, msg='备选时间段参数不正确'), None
+    if len(raw) > config.ALTERNATIVES_MAX:
+        return dict(code=-5, msg='最多设置%d个备选时间段' % config.ALTERNATIVES_MAX), None
+    defaults = dict((key, fields.get(key)) for key in ('instrument', 'reserve_date', 'start_time', 'end_time',
+                                                        'report', 'reserve_time') if fields.get(key) is not None)
+    alternatives = []
+    for i, item in enumerate(raw):
+        error, reserve_info, alternative_run_time = parse_reservation(dict(defaults, **item))
+        if error:
+            error['msg'] = '备选时间段第%d项：%s' % (i + 1, error['msg'])
+            return error, None
+        # 备选的时间段在主预约开始预约时必须已经可以预约，如下一周的日期还没开放
+        if not config.debug and alternative_run_time > run_time:
+            return dict(code=-5, msg='备选时间段第%d项在开始预约时还不能预约' % (i + 1)), None
+        alternatives.append(reserve_info)
+    return None, alternatives
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'GET':
@@ -58,40 +237,22 @@ def api_reserve():
     可选请求参数：
         report: 预约实验时要求填写的实验内容
         reserve_time: 开始预约时间，只有debug时才有效，否则预约时间是根据实验时间自动生成
+        alternatives: 备选时间段，JSON数组，见parse_alternatives；时间段已被预约时在同一次登录中依次尝试
 
+    时间段已被预约时，按config.AVAILABILITY_MODE：'warn'时仍然设定，返回的warning为提示；
+    'reject'时返回code=-6
+    主时间段或备选时间段与已设定的任务（同一仪器、实验日期，含它们的备选时间段）时间重叠时仍然设定，
+    返回的conflicts为这些时间段，见`check_conflicts`，warning中也有提示
     """
     username = request.form.get('username', '')
     password = request.form.get('password', '')
-    instrument_name = request.form.get('instrument', '')  # OLD_F20
-    raw_reserve_date = request.form.get('reserve_date')  # '2017-01-01'
-    start_time = request.form.get('start_time')  # '12:00'
-    end_time = request.form.get('end_time')  # '13:00'
-    report = request.form.get('report', 'tem')
-    reserve_time = request.form.get('reserve_time', '')  # 开抢时间 2017-01-01 00:00:00
-
-    # 根据名称找到仪器对象
-    try:
-        instrument = Instrument.get(name=instrument_name)
-    except InstrumentException as e:
-        logging.info(e)
-        return json.dumps(dict(code=-2, msg="不存在该仪器: '%s'" % instrument_name), ensure_ascii=False)
-    # 判断start_time，end_time，reserve_date是否符合要求
-    try:
-        datetime.datetime.strptime(start_time, '%H:%M')
-        datetime.datetime.strptime(end_time, '%H:%M')
-        reserve_date = datetime.datetime.strptime(raw_reserve_date, '%Y-%m-%d').date()
-    except ValueError as e:
-        logging.warning('预约参数不正确：%s' % e)
-        return json.dumps(dict(code=-5, msg='预约参数不正确'))
 
-    reserve_date_str = reserve_date.strftime('%Y年%m月%d日')
-    reserve_info = dict(
-        reserveDate=reserve_date_str,
-        reserveStartTime=start_time,
-        reserveEndTime=end_time,
-        instrumentId=instrument.instrument_id,
-        ReserveReport=report
-    )
+    error, reserve_info, run_time = parse_reservation(request.form)
+    if error:
+        return json.dumps(error, ensure_ascii=False)
+    error, alternatives = parse_alternatives(request.form, run_time)
+    if error:
+        return json.dumps(error, ensure_ascii=False)
 
     # 创建对象，传入预约数据
     reserve = ReserveTem()
@@ -100,16 +261,16 @@ def api_reserve():
     except ReserveException as e:
         logging.warning('用户名或密码不符合要求：%s' % e)
         return json.dumps(dict(code=-5, msg='用户名或密码不符合要求'))
-    reserve.set_info(reserve_info)
-    # 设定预约时间
-    if config.debug:
-        if reserve_time == '':
-            run_time = datetime.datetime.now()
-        else:
-            run_time = datetime.datetime.strptime(reserve_time, '%Y-%m-%d %H:%M:%S')
-    else:
-        # 根据实验时间和仪器自动判断预约时间
-        run_time = ReserveTime.get_time(instrument, reserve_date)
+    # 帐号正确后才查询日历和已设定的任务
+    error = verify_account(reserve)
+    if error:
+        return json.dumps(error, ensure_ascii=False)
+    error, warning = check_availability(reserve_info)
+    if error:
+        return json.dumps(error, ensure_ascii=False)
+    # 在设定之前检查，否则会和自己重叠
+    conflicts, conflict_warning = check_conflicts(reserve_info, username, alternatives)
+    reserve.set_info(reserve_info, alternatives)
 
     # 设定定时任务
     try:
@@ -119,14 +280,269 @@ def api_reserve():
         return json.dumps(dict(code=-4, msg='服务器出现错误'), ensure_ascii=False)
 
     if job:
-        return json.dumps(dict(code=0, msg='预约设定成功', job_id=job.id,
-                               trigger_time=job.trigger.run_date.strftime('%Y-%m-%d %H:%M:%S')))
+        result = dict(code=0, msg='预约设定成功', job_id=job.id,
+                      trigger_time=trigger_time_of(job).strftime('%Y-%m-%d %H:%M:%S'))
+        warning = join_warnings(warning, conflict_warning)
+        if warning:
+            result['warning'] = warning
+        if conflicts:
+            result['conflicts'] = conflicts
+        return json.dumps(result)
     else:
         return json.dumps(dict(code=-1, msg='帐号或密码错误'), ensure_ascii=False)
 
 
+@app.route('/api/reserve_batch', methods=['POST'])
+def api_reserve_batch():
+    """批量预约实验，同一帐号的多条预约只验证一次帐号，所有定时任务一次写入
+
+    方法：POST
+    请求body格式：x-www-form-urlencoded
+
+    必要请求参数：
+        username: 登录易约的用户名
+        password: 登录易约的密码
+        reservations: JSON数组，每一项是一条预约，字段与/api/reserve相同：
+            instrument, reserve_date, start_time, end_time, 可选report, reserve_time, alternatives
+
+    返回的results与reservations一一对应，每一项有code, msg，成功时还有job_id, trigger_time，
+    时间段已被预约时按config.AVAILABILITY_MODE有warning或code=-6，与已设定的任务时间重叠时有conflicts；
+    只要有一项参数不正确，整批都不会设定
+    """
+    username = request.form.get('username', '')
+    password = request.form.get('password', '')
+    try:
+        items = json.loads(request.form.get('reservations', ''))
+    except ValueError:
+        items = None
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return json.dumps(dict(code=-5, msg='预约参数不正确'), ensure_ascii=False)
+    if len(items) > config.BATCH_MAX_SIZE:
+        return json.dumps(dict(code=-5, msg='一次最多预约%d条' % config.BATCH_MAX_SIZE), ensure_ascii=False)
+
+    reserve = ReserveTem()
+    try:
+        reserve.set_account(username, password)
+    except ReserveException as e:
+        logging.warning('用户名或密码不符合要求：%s' % e)
+        return json.dumps(dict(code=-5, msg='用户名或密码不符合要求'), ensure_ascii=False)
+    error = verify_account(reserve)
+    if error:
+        return json.dumps(error, ensure_ascii=False)
+
+    results = []
+    reservations = []
+    for item in items:
+        error, reserve_info, run_time = parse_reservation(item)
+        warning = None
+        conflicts = []
+        alternatives = None
+        if not error:
+            error, alternatives = parse_alternatives(item, run_time)
+        if not error:
+            error, warning = check_availability(reserve_info)
+        if not error:
+            conflicts, conflict_warning = check_conflicts(reserve_info, username, alternatives)
+            warning = join_warnings(warning, conflict_warning)
+        result = error or dict(code=0, msg='ok')
+        if warning:
+            result['warning'] = warning
+        if conflicts:
+            result['conflicts'] = conflicts
+        results.append(result)
+        if not error:
+            reservations.append((reserve_info, run_time, alternatives))
+    if len(reservations) < len(items):
+        return json.dumps(dict(code=-5, msg='预约参数不正确', results=results), ensure_ascii=False)
+
+    try:
+        jobs = reserve.set_jobs(reservations)
+    except Exception as e:
+        logging.exception(e)
+        return json.dumps(dict(code=-4, msg='服务器出现错误'), ensure_ascii=False)
+    if jobs is None:
+        return json.dumps(dict(code=-1, msg='帐号或密码错误'), ensure_ascii=False)
+
+    for result, job in zip(results, jobs):
+        result.update(msg='预约设定成功', job_id=job.id, trigger_time=trigger_time_of(job).strftime('%Y-%m-%d %H:%M:%S'))
+    return json.dumps(dict(code=0, msg='预约设定成功', results=results), ensure_ascii=False)
+
+
+@app.route('/api/recurring_rule', methods=['POST'])
+def api_recurring_rule():
+    """添加每周重复的预约规则，到结束日期为止每周预约同一仪器、同一时间段
+
+    规则只保存一次，同一时间只有下一个实验日期的预约任务（按仪器自动判断开始预约时间），
+    这个任务执行或被删除后自动生成再下一周的任务，见recurring.py
+
+    方法：POST
+    请求body格式：x-www-form-urlencoded
+
+    必要请求参数：
+        username, password: 登录易约的用户名密码
+        instrument: 预约的仪器，必须是resources.instruments中某一仪器的name
+        weekday: 实验日期是周几，0-6，周一是0
+        start_time, end_time: 实验时间段，格式：9:00
+        end_date: 最后一个实验日期（包含），格式：2017-01-01
+
+    可选请求参数：
+        report: 预约实验时要求填写的实验内容
+
+    返回的rule见/api/recurring_rules
+    """
+    username = request.form.get('username', '')
+    password = request.form.get('password', '')
+    try:
+        instrument = Instrument.get(name=request.form.get('instrument', ''))
+    except InstrumentException as e:
+        logging.info(e)
+        return json.dumps(dict(code=-2, msg="不存在该仪器: '%s'" % request.form.get('instrument', '')),
+                          ensure_ascii=False)
+    start_time = request.form.get('start_time')
+    end_time = request.form.get('end_time')
+    try:
+        weekday = int(request.form.get('weekday', ''))
+        datetime.datetime.strptime(start_time, '%H:%M')
+        datetime.datetime.strptime(end_time, '%H:%M')
+        end_date = datetime.datetime.strptime(request.form.get('end_date'), '%Y-%m-%d').date()
+        if not 0 <= weekday <= 6 or end_date < datetime.date.today():
+            raise ValueError('weekday or end_date out of range')
+    except (ValueError, TypeError) as e:
+        logging.warning('重复预约参数不正确：%s' % e)
+        return json.dumps(dict(code=-5, msg='预约参数不正确'), ensure_ascii=False)
+
+    try:
+        ReserveTem().set_account(username, password)
+    except ReserveException as e:
+        logging.warning('用户名或密码不符合要求：%s' % e)
+        return json.dumps(dict(code=-5, msg='用户名或密码不符合要求'), ensure_ascii=False)
+    if username == config.ADMIN_USERNAME or not auth(username, password):
+        return json.dumps(dict(code=-1, msg='帐号或密码错误'), ensure_ascii=False)
+
+    rules = RecurringRules()
+    if len(rules.rules(username)) >= config.RECURRING_MAX_RULES:
+        return json.dumps(dict(code=-5, msg='最多设置%d条重复预约' % config.RECURRING_MAX_RULES), ensure_ascii=False)
+    try:
+        rule = rules.add(username, password, instrument.instrument_id, weekday, start_time, end_time, end_date,
+                         request.form.get('report', 'tem'))
+    except Exception as e:
+        logging.exception(e)
+        return json.dumps(dict(code=-4, msg='服务器出现错误'), ensure_ascii=False)
+    return json.dumps(dict(code=0, msg='重复预约设定成功', rule=rules.describe(rule)), ensure_ascii=False)
+
+
+@app.route('/api/recurring_rules')
+def api_recurring_rules():
+    """用户的重复预约规则，管理员为所有规则，按添加的先后排序
+
+    方法：GET
+
+    请求参数：
+        username, password: 帐号密码，debug时默认管理员
+
+    返回的rules每项有rule_id, instrument, weekday, start_time, end_time, report, end_date，
+    upcoming为下一个未执行的任务（job_id, reserve_date, trigger_time），没有时为null；
+    finished表示已过结束日期，error为最近一次生成任务失败的原因
+    """
+    username = request.args.get('username')
+    password = request.args.get('password')
+    if username is None or password is None:
+        if config.debug:
+            username = config.ADMIN_USERNAME
+            password = config.ADMIN_PASSWORD
+        else:
+            return json.dumps(dict(code=-2, msg='请输入帐号密码'))
+
+    if not auth(username, password):
+        return json.dumps(dict(code=-1, msg='帐号或密码错误'))
+
+    rules = RecurringRules()
+    owned = rules.rules(None if username == config.ADMIN_USERNAME else username)
+    return json.dumps(dict(code=0, msg='ok', rules=[rules.describe(rule) for rule in owned]), ensure_ascii=False)
+
+
+@app.route('/api/remove_recurring_rule', methods=['GET', 'POST'] if config.debug else ['POST'])
+def remove_recurring_rule():
+    """删除重复预约规则以及它未执行的任务，请求参数username, password, rule_id"""
+    if config.debug and request.method == 'GET':
+        # debug时，帐号密码默认管理员，GET POST都可以
+        fields = request.args
+    else:
+        fields = request.form
+    default_username, default_password = (config.ADMIN_USERNAME, config.ADMIN_PASSWORD) if config.debug else ('', '')
+    username = fields.get('username', default_username)
+    password = fields.get('password', default_password)
+
+    if not auth(username, password):
+        return json.dumps(dict(code=-1, msg='用户名或密码错误'), ensure_ascii=False)
+    if RecurringRules().remove(fields.get('rule_id'), username):
+        return json.dumps(dict(code=0, msg='删除成功！'), ensure_ascii=False)
+    return json.dumps(dict(code=-1, msg='规则不存在'), ensure_ascii=False)
+
+
+def encode_cursor(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode() if cursor else None
+
+
+def decode_cursor(text):
+    """:raise ValueError: 游标不正确"""
+    try:
+        next_run_time, job_id = json.loads(base64.urlsafe_b64decode(text.encode()))
+        return float(next_run_time), str(job_id)
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('invalid cursor: %s' % text)
+
+
+def parse_job_filters(args):
+    """解析/api/scheduled_jobs的筛选、分页参数
+
+    :return: (filters, limit, cursor)
+    :raise ValueError: 参数不正确
+    """
+    filters = {}
+    if args.get('instrument'):
+        try:
+            filters['instrument_id'] = Instrument.get(name=args['instrument']).instrument_id
+        except InstrumentException:
+            raise ValueError("no instrument '%s'" % args['instrument'])
+    for name in ('date_from', 'date_to'):
+        if args.get(name):
+            filters[name] = datetime.datetime.strptime(args[name], '%Y-%m-%d').date()
+    for name in ('trigger_from', 'trigger_to'):
+        if args.get(name):
+            filters[name] = datetime.datetime.strptime(args[name], '%Y-%m-%d %H:%M:%S')
+    limit = None
+    if args.get('limit'):
+        limit = int(args['limit'])
+        if not 0 < limit <= config.JOBS_PAGE_MAX:
+            raise ValueError('limit should be in 1..%d' % config.JOBS_PAGE_MAX)
+    cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+    return filters, limit, cursor
+
+
+def jobs_etag(username, args):
+    """任务列表的ETag：用户任务列表的版本，加上查询参数（不含密码）"""
+    query = '&'.join('%s=%s' % item for item in sorted(args.items(multi=True)) if item[0] != 'password')
+    return '%s-%s' % (get_handler().get_version(username), hashlib.sha1(query.encode()).hexdigest()[:12])
+
+
 @app.route('/api/scheduled_jobs')
 def scheduled_jobs():
+    """用户的预约任务，管理员为所有任务，按触发时间排序
+
+    方法：GET
+
+    请求参数：
+        username, password: 帐号密码，debug时默认管理员
+    可选请求参数：
+        instrument: 仪器的name
+        date_from, date_to: 实验日期的范围，格式：2017-01-01
+        trigger_from, trigger_to: 开始预约时间的范围，格式：2017-01-01 00:00:00
+        limit: 每页的任务数，不超过config.JOBS_PAGE_MAX，默认全部
+        cursor: 上一页返回的next_cursor
+
+    响应带ETag，请求带If-None-Match且任务列表没有变化时返回304，不读取任务
+    """
     username = request.args.get('username')
     password = request.args.get('password')
     if username is None or password is None:
@@ -136,25 +552,71 @@ def scheduled_jobs():
         else:
             return json.dumps(dict(code=-2, msg='请输入帐号密码'))
 
-    if auth(username, password):
-        jobs = SchedulerHandler().get_jobs(username)
-    else:
+    if not auth(username, password):
         return json.dumps(dict(code=-1, msg='帐号或密码错误'))
 
-    result_jobs = []
-    for job in jobs:
-        result_jobs.append(dict(
-            id=job.id,
-            username=job.kwargs['username'],
-            trigger_time=job.trigger.run_date.strftime('%Y-%m-%d %H:%M:%S'),
-            reserve_date=datetime.datetime.strptime(
-                job.kwargs['reserve_data']['reserveDate'], '%Y年%m月%d日').strftime('%Y-%m-%d'),
-            reserveStartTime=job.kwargs['reserve_data']['reserveStartTime'],
-            reserveEndTime=job.kwargs['reserve_data']['reserveEndTime'],
-            instrument=Instrument.get(instrument_id=job.kwargs['reserve_data']['instrumentId']).cn_name,
-            ReserveReport=job.kwargs['reserve_data']['ReserveReport']
-        ))
-    return json.dumps(dict(code=0, msg='ok', jobs=result_jobs))
+    etag = jobs_etag(username, request.args)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    try:
+        filters, limit, cursor = parse_job_filters(request.args)
+    except ValueError as e:
+        logging.info('查询参数不正确：%s' % e)
+        return json.dumps(dict(code=-5, msg='查询参数不正确'), ensure_ascii=False)
+    summaries, next_cursor = get_handler().query_summaries(username, limit=limit, cursor=cursor, **filters)
+    # 各任务的JSON已经缓存，直接拼接
+    response = Response('{"code": 0, "msg": "ok", "jobs": %s, "next_cursor": %s}' % (
+        job_summary.join(summaries), json.dumps(encode_cursor(next_cursor))))
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/api/slot_jobs')
+def slot_jobs():
+    """某仪器某实验日期已设定的预约任务的实验时间段（含备选时间段），按开始时间排序；
+    带start_time, end_time时只返回与该时间段重叠的
+
+    方法：GET
+
+    请求参数：
+        username, password: 帐号密码，debug时默认管理员
+        instrument: 仪器的name
+        reserve_date: 实验日期，格式：2017-01-01
+    可选请求参数：
+        start_time, end_time: 实验时间段，格式：9:00
+
+    返回的jobs每项有start_time, end_time, window, own，window为0是任务的主时间段，i是第i个备选时间段；
+    自己的任务（管理员为所有任务）还有job_id, username
+    """
+    username = request.args.get('username')
+    password = request.args.get('password')
+    if username is None or password is None:
+        if config.debug:
+            username = config.ADMIN_USERNAME
+            password = config.ADMIN_PASSWORD
+        else:
+            return json.dumps(dict(code=-2, msg='请输入帐号密码'))
+
+    if not auth(username, password):
+        return json.dumps(dict(code=-1, msg='帐号或密码错误'))
+
+    try:
+        instrument = Instrument.get(name=request.args.get('instrument', ''))
+        reserve_date = datetime.datetime.strptime(request.args.get('reserve_date', ''), '%Y-%m-%d').strftime('%Y年%m月%d日')
+    except (InstrumentException, ValueError) as e:
+        logging.info('查询参数不正确：%s' % e)
+        return json.dumps(dict(code=-5, msg='查询参数不正确'), ensure_ascii=False)
+    start_time, end_time = request.args.get('start_time'), request.args.get('end_time')
+    handler = get_handler()
+    if start_time or end_time:
+        intervals = handler.get_conflicts(dict(instrumentId=instrument.instrument_id, reserveDate=reserve_date,
+                                               reserveStartTime=start_time, reserveEndTime=end_time))
+    else:
+        intervals = handler.get_slot_intervals(instrument.instrument_id, reserve_date)
+    return json.dumps(dict(code=0, msg='ok', jobs=describe_intervals(intervals, username)), ensure_ascii=False)
 
 
 @app.route('/api/remove_job', methods=['GET', 'POST'] if config.debug else ['POST'])
@@ -175,7 +637,7 @@ def remove_one_job():
         job_id = request.form.get('job_id')
 
     if auth(username, password):
-        if SchedulerHandler().remove_job(job_id, username):
+        if get_handler().remove_job(job_id, username):
             return json.dumps(dict(code=0, msg='删除成功！'), ensure_ascii=False)
         else:
             return json.dumps(dict(code=-1, msg='任务不存在'), ensure_ascii=False)
@@ -197,7 +659,7 @@ def remove_all_jobs():
         password = request.form.get('password', '')
 
     if auth(username, password):
-        SchedulerHandler().remove_all_jobs(username)
+        get_handler().remove_all_jobs(username)
         return json.dumps(dict(code=0, msg='删除成功！'), ensure_ascii=False)
     else:
         return json.dumps(dict(code=-1, msg='用户名或密码错误'), ensure_ascii=False)
@@ -225,3 +687,42 @@ def login_test():
         return json.dumps(dict(code=0, msg=msg), ensure_ascii=False)
     else:
         return json.dumps(dict(code=-1, msg='登录失败'), ensure_ascii=False)
+
+
+@app.route('/api/clock')
+def server_clock():
+    """预约任务使用的服务器时钟的校准状态（scheduler单独运行时是scheduler进程中的时钟）
+
+    offset: 服务器时间 - 本地时间（秒）
+    latency: 请求的单程延迟（秒）
+    error: offset的误差范围（±秒），null表示还未校准
+    """
+    return json.dumps(dict(code=0, msg='ok', clock=get_handler().clock_status()), ensure_ascii=False)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_latency(response):
+    if 'request_start' in g:
+        metrics.api_request_seconds.observe(time.perf_counter() - g.request_start,
+                                            endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+
+@app.route('/api/metrics')
+def api_metrics():
+    """登录、预约、触发延迟、上游错误、API延迟等指标，Prometheus文本格式
+
+    scheduler单独运行时，预约相关的指标在scheduler进程中，与本进程的指标合并，用process标签区分
+    """
+    text = metrics.registry.expose()
+    if config.SCHEDULER_MODE == 'remote':
+        try:
+            text = metrics.merge([('web', text), ('scheduler', get_handler().metrics_exposition())])
+        except SchedulerException as e:
+            logging.warning('get scheduler metrics failed: %s' % e)
+    return Response(text, mimetype='text/plain; version=0.0.4')
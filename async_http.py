@@ -0,0 +1,248 @@
+import io
+import ssl
+import time
+import asyncio
+import datetime
+import http.client
+from collections import deque
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+from config import config
+from http_client import HttpClient, PreparedRequest, handle_response
+
+
+class _Connection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def usable(self):
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+class _AsyncHostPool(object):
+    """一个host的异步连接池，与http_client._HostPool相同，只能在事件循环中使用"""
+
+    def __init__(self, scheme, host, port, size):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.size = size
+        self.in_use = 0
+        self.condition = asyncio.Condition()
+        self.idle = deque()  # (connection, 放回的时间)
+
+    async def reserve(self, count):
+        """增加count个可以同时使用的连接，用完后调用`unreserve(count)`"""
+        async with self.condition:
+            self.size += count
+            self.condition.notify_all()
+
+    def unreserve(self, count):
+        self.size -= count
+        while len(self.idle) > self.size:
+            self.idle.popleft()[0].close()
+
+    async def _new_connection(self):
+        ssl_context = ssl.create_default_context() if self.scheme == 'https' else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl_context), config.HTTP_TIMEOUT)
+        return _Connection(reader, writer)
+
+    async def acquire(self):
+        """取出一个连接，返回(connection, 是否是复用的连接)"""
+        async with self.condition:
+            try:
+                await asyncio.wait_for(self.condition.wait_for(lambda: self.in_use < self.size), config.HTTP_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise http.client.HTTPException('connection pool of %s is exhausted' % self.host)
+            self.in_use += 1
+        now = time.time()
+        while self.idle:
+            conn, released_at = self.idle.pop()
+            if now - released_at < config.HTTP_IDLE_TIMEOUT and conn.usable():
+                return conn, True
+            conn.close()
+        try:
+            return await self._new_connection(), False
+        except BaseException:
+            self._done()
+            raise
+
+    def _done(self):
+        """一个连接用完，唤醒一个等待的请求；不用等待锁，在事件循环中不会和其他协程同时执行"""
+        self.in_use -= 1
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self.condition:
+            self.condition.notify()
+
+    def release(self, conn, reusable=True):
+        if reusable:
+            self.idle.append((conn, time.time()))
+            while len(self.idle) > self.size:
+                self.idle.popleft()[0].close()
+        else:
+            conn.close()
+        self._done()
+
+    async def pre_open(self, count):
+        """预先建立连接，使之后的请求不用再等待TCP握手"""
+        count = min(count, self.size)
+        conns = await asyncio.gather(*[self._new_connection() for i in range(count)])
+        now = time.time()
+        self.idle.extend((conn, now) for conn in conns)
+        while len(self.idle) > self.size:
+            self.idle.popleft()[0].close()
+
+
+async def _read_body(reader, method, status, headers):
+    """读取响应的body，返回(body, 连接是否还能复用)"""
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        return b'', True
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                # trailer直到空行
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks), True
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+    length = headers.get('Content-Length')
+    if length is not None:
+        return await reader.readexactly(int(length)), True
+    return await reader.read(), False
+
+
+class AsyncHttpClient(object):
+    """HttpClient的异步版本，在AsyncEngine的事件循环中使用，不占用线程
+
+    用asyncio.open_connection实现HTTP/1.1，每个host一个大小为`config.ASYNC_HTTP_POOL_SIZE`的keep-alive连接池；
+    请求的构造（PreparedRequest）、重定向和错误处理与HttpClient相同，
+    预约任务的CookieJar由HttpClient保存，同一用户在两种引擎中使用同一个CookieJar
+
+    单例
+    """
+    _instance = None
+    max_redirects = HttpClient.max_redirects
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.pools = {}
+        return cls._instance
+
+    def _pool(self, url):
+        parts = urlsplit(url)
+        default_port = 443 if parts.scheme == 'https' else 80
+        key = (parts.scheme, parts.hostname, parts.port or default_port)
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = self.pools[key] = _AsyncHostPool(*key, size=config.ASYNC_HTTP_POOL_SIZE)
+        return pool
+
+    async def pre_open(self, url, count=1):
+        await self._pool(url).pre_open(count)
+
+    async def reserve(self, url, count):
+        """与HttpClient.reserve相同"""
+        await self._pool(url).reserve(count)
+
+    def unreserve(self, url, count):
+        self._pool(url).unreserve(count)
+
+    def prepare(self, url, data=None, cookie_jar=None, method=None):
+        return HttpClient().prepare(url, data, cookie_jar, method)
+
+    @staticmethod
+    def _request_bytes(pool, prepared):
+        host = pool.host if pool.port in (80, 443) else '%s:%d' % (pool.host, pool.port)
+        lines = ['%s %s HTTP/1.1' % (prepared.method, prepared.path), 'Host: %s' % host,
+                 'Accept-Encoding: identity']
+        lines.extend('%s: %s' % item for item in prepared.headers.items())
+        if prepared.body is not None:
+            lines.append('Content-Length: %d' % len(prepared.body))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (prepared.body or b'')
+
+    async def _exchange(self, conn, pool, prepared):
+        conn.writer.write(self._request_bytes(pool, prepared))
+        await conn.writer.drain()
+        sent_at = datetime.datetime.now()
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected('Remote end closed connection without response')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        header_lines = []
+        while True:
+            line = await conn.reader.readline()
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines)))
+        status = int(status)
+        body, reusable = await _read_body(conn.reader, prepared.method, status, headers)
+        connection = headers.get('Connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive'):
+            reusable = False
+        return status, reason, headers, body, reusable, sent_at
+
+    async def _send(self, prepared, cookie_jar, on_sent=None):
+        """发送一次请求，不跟随重定向，返回(status, reason, headers, body)，on_sent见HttpClient._send"""
+        pool = self._pool(prepared.url)
+        conn, reused = await pool.acquire()
+        try:
+            try:
+                result = await asyncio.wait_for(self._exchange(conn, pool, prepared), config.HTTP_TIMEOUT)
+            except (http.client.RemoteDisconnected, ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                # 复用的连接已被服务器关闭，换一个新连接重试一次
+                conn.close()
+                conn = await pool._new_connection()
+                result = await asyncio.wait_for(self._exchange(conn, pool, prepared), config.HTTP_TIMEOUT)
+        except asyncio.TimeoutError:
+            pool.release(conn, reusable=False)
+            raise TimeoutError('request to %s timed out' % prepared.url)
+        except BaseException:
+            pool.release(conn, reusable=False)
+            raise
+        status, reason, headers, body, reusable, sent_at = result
+        pool.release(conn, reusable=reusable)
+        if on_sent is not None:
+            on_sent(sent_at)
+
+        if cookie_jar is not None:
+            cookie_jar.extract_cookies(_CookieResponse(headers), prepared.request)
+        return status, reason, headers, body
+
+    async def open(self, url, data=None, cookie_jar=None, method=None):
+        """与HttpClient.open相同"""
+        return await self.open_prepared(self.prepare(url, data, cookie_jar, method), cookie_jar)
+
+    async def open_prepared(self, prepared, cookie_jar=None, on_sent=None):
+        """与HttpClient.open_prepared相同"""
+        for i in range(self.max_redirects + 1):
+            status, reason, headers, body = await self._send(prepared, cookie_jar, on_sent if i == 0 else None)
+            response = handle_response(prepared, status, reason, headers, body, cookie_jar)
+            if not isinstance(response, PreparedRequest):
+                return response
+            prepared = response
+        raise HTTPError(prepared.url, status, 'too many redirects', headers, io.BytesIO(body))
+
+
+class _CookieResponse(object):
+    """CookieJar.extract_cookies需要的响应接口"""
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def info(self):
+        return self.headers
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import datetime
+import threading
+from time import perf_counter
+from urllib.error import HTTPError
+
+from config import config
+from clock import ServerClock
+from async_http import AsyncHttpClient
+from release import PreciseTimer
+from retry import ABORT, RELOGIN, BACKOFF
+from reserve import ReserveTem, burst_offsets
+from errors import ReserveException
+
+
+class AsyncEngine(object):
+    """在一个后台线程中运行的事件循环，`config.ENGINE = 'asyncio'`时所有预约任务都在这里执行
+
+    等待和HTTP请求都不占用线程，一个线程可以同时执行数百个预约任务
+
+    单例
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.lock = threading.Lock()
+            cls._instance.loop = None
+            cls._instance.thread = None
+        return cls._instance
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                # 在启动的线程中校准，不阻塞事件循环
+                if not PreciseTimer().calibrated:
+                    PreciseTimer().calibrate()
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name='reserve-loop', daemon=True)
+                self.thread.start()
+        return self.loop
+
+    def submit(self, coro):
+        """在事件循环中执行协程，返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    def run(self, coro, timeout=None):
+        """在事件循环中执行协程，阻塞到结束并返回结果"""
+        return self.submit(coro).result(timeout)
+
+
+async def wait_until_async(target_time):
+    """`reserve.wait_until`的协程版本"""
+    if target_time is None:
+        return
+    delta = (target_time - datetime.datetime.now()).total_seconds()
+    if delta > 0:
+        await asyncio.sleep(delta)
+
+
+class AsyncReserveTem(ReserveTem):
+    """ReserveTem的异步版本，登录、提交和重试的逻辑与结果都与ReserveTem相同
+
+    只能在AsyncEngine的事件循环中使用带_async的方法；设置定时任务仍使用ReserveTem
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.client = AsyncHttpClient()
+
+    def _sync_only(self, name, replacement=None):
+        raise ReserveException('AsyncReserveTem.%s is not available, use %s in AsyncEngine'
+                               % (name, replacement or name + '_async'))
+
+    # 继承的同步方法会把AsyncHttpClient的协程当成结果，直接报错，避免误用
+    def login(self):
+        self._sync_only('login')
+
+    def _reserve(self):
+        self._sync_only('_reserve')
+
+    def warm_up(self):
+        self._sync_only('warm_up')
+
+    def keep_reserve(self):
+        self._sync_only('keep_reserve', 'run_reserve')
+
+    def fire(self, trigger_time=None):
+        self._sync_only('fire')
+
+    def _fire(self, trigger_time=None):
+        self._sync_only('_fire')
+
+    def burst_reserve(self, trigger_time, burst):
+        self._sync_only('burst_reserve')
+
+    async def login_async(self):
+        login_data = self._login_data()
+        start = perf_counter()
+        for i in range(config.LOGIN_TRY_TIME):
+            try:
+                login_result = await self.client.open(self.login_url, login_data, self.cookie)
+                break
+            except HTTPError as e:
+                error = e
+                delay = self._login_retry_delay(i, e, start)
+                if i < config.LOGIN_TRY_TIME - 1:
+                    await asyncio.sleep(delay)
+        else:
+            self._login_exhausted(start)
+            raise error
+        return self._login_done(login_result, start)
+
+    async def _reserve_async(self):
+        prepared = self._before_post()
+        start = perf_counter()
+        try:
+            location = (await self.client.open_prepared(prepared, self.cookie, self._post_sent)).geturl()
+        except Exception as e:
+            self._post_failed(e, start)
+            raise
+        return self._reserve_result(location, start)
+
+    async def warm_up_async(self):
+        try:
+            return await self.login_async()
+        except HTTPError as e:
+            return False
+        except Exception as e:
+            logging.exception(e)
+            return False
+
+    async def fire_async(self, trigger_time=None):
+        success = await self._fire_async(trigger_time)
+        self._fire_done(trigger_time, success)
+        return success
+
+    async def _fire_async(self, trigger_time=None):
+        if trigger_time is not None:
+            trigger_time = ServerClock().to_local(trigger_time) + datetime.timedelta(seconds=self.release_offset())
+        burst = self.get_burst() if trigger_time is not None else None
+        if trigger_time is not None:
+            await wait_until_async(trigger_time - datetime.timedelta(seconds=config.HTTP_PRE_OPEN_SECONDS))
+            try:
+                await self.client.pre_open(self.reserve_url, len(burst_offsets(burst)) or 1)
+            except Exception as e:
+                logging.warning('pre-open connections failed: %s' % e)
+        if not self.session_valid():
+            self._event('relogin', reason='session expired before reserve')
+            if not await self.warm_up_async():
+                return False
+        self.prepare()
+        if burst is None and trigger_time is not None:
+            self.release_error = await PreciseTimer().wait_async(trigger_time.timestamp())
+
+        if burst is not None:
+            done = self._burst_done(await self.burst_reserve_async(trigger_time, burst))
+            if done is not None:
+                return done
+
+        backoff_count = 0
+        for i in range(config.TRY_TIME):
+            try:
+                reserve_result = await self._reserve_async()
+            except Exception as e:
+                action, reason = self._attempt_failed('sequential', i + 1, error=e)
+            else:
+                if reserve_result.get('status'):
+                    self._event('success', mode='sequential', attempt=i + 1, release_error=self.release_error)
+                    return True
+                action, reason = self._attempt_failed('sequential', i + 1, reserve_result)
+            if action == ABORT:
+                if self.next_alternative(reason):
+                    continue
+                self._event('failed', reason=reason, attempts=self.attempts)
+                return False
+            if action == RELOGIN and await self.warm_up_async():
+                continue
+            if i < config.TRY_TIME - 1:
+                await asyncio.sleep(self.retry_policy.delay(action, backoff_count))
+                if action == BACKOFF:
+                    backoff_count += 1
+        self._event('failed', reason='超过最大尝试次数', attempts=self.attempts)
+        return False
+
+    async def burst_reserve_async(self, trigger_time, burst):
+        """`burst_reserve`的协程版本，每次提交是一个task"""
+        first = trigger_time - datetime.timedelta(seconds=burst['window'] / 2)
+        offsets = burst_offsets(burst)
+        won = asyncio.Event()
+        result = dict(status=False, attempt=None, latency=None, sent=0, abort=None)
+
+        async def attempt(no, release_time):
+            error = await PreciseTimer().wait_async(release_time.timestamp(), won)
+            if error is None:
+                return
+            if no == 1:
+                self.release_error = error
+            result['sent'] += 1
+            try:
+                reserve_result, error = await self._reserve_async(), None
+            except Exception as e:
+                reserve_result, error = None, e
+            if error is not None or not reserve_result.get('status'):
+                action, reason = self._attempt_failed('burst', no, reserve_result, error)
+                if action == ABORT and not won.is_set():
+                    won.set()
+                    result['abort'] = reason
+                return
+            if not result['status']:
+                won.set()
+                result.update(status=True, abort=None, attempt=no,
+                              latency=(datetime.datetime.now() - trigger_time).total_seconds())
+
+        await asyncio.gather(*[attempt(i + 1, first + datetime.timedelta(seconds=offset))
+                               for i, offset in enumerate(offsets)])
+        return result
+
+
+async def run_reserve(username, password, reserve_data, trigger_time=None, delay=0, assignment=None,
+                      alternatives=None):
+    """执行一个预约任务，与keep_reserve_job相同
+
+    :param float delay: 开始登录前等待的秒数
+    :param dispatch.Assignment assignment: 批处理中的名次
+    :param list alternatives: 备选的预约数据
+    :return: (AsyncReserveTem, 是否预约成功)
+    """
+    if delay > 0:
+        await asyncio.sleep(delay)
+    reserve = AsyncReserveTem()
+    loop = asyncio.get_running_loop()
+    try:
+        reserve.set_account(username, password, shared_session=True)
+        reserve.set_info(reserve_data, alternatives)
+        reserve.set_assignment(assignment)
+        # 检查日历可能需要请求，放到线程池中
+        if trigger_time is not None and not await loop.run_in_executor(None, reserve.still_possible):
+            return reserve, False
+        if not await reserve.warm_up_async():
+            return reserve, False
+        clock = ServerClock()
+        if trigger_time is not None and clock.is_stale():
+            # 校准是阻塞的，放到线程池中
+            await loop.run_in_executor(None, clock.calibrate)
+        return reserve, await reserve.fire_async(trigger_time)
+    except Exception as e:
+        logging.exception(e)
+        return reserve, False
+    finally:
+        reserve.release_session()
+
+
+def submit_reserve_job(username, password, reserve_data, trigger_time=None, alternatives=None):
+    """把预约任务交给AsyncEngine，立即返回，不占用scheduler的线程
+
+    :return: concurrent.futures.Future，结果为是否预约成功
+    """
+    async def job():
+        reserve, success = await run_reserve(username, password, reserve_data, trigger_time,
+                                             alternatives=alternatives)
+        logging.info('reserve job of %s finished: %s' % (username, success))
+        return success
+
+    return AsyncEngine().submit(job())
@@ -0,0 +1,91 @@
+import os
+import hmac
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from config import config
+import metrics
+
+
+class AuthCache(object):
+    """帐号验证结果的缓存，避免每次API调用都到“易约”登录一次
+
+    key是用户名+密码加盐后的哈希，不保存明文；
+    登录成功的结果缓存`config.AUTH_CACHE_TTL`秒，失败的结果缓存`config.AUTH_CACHE_NEGATIVE_TTL`秒，
+    最多保存`config.AUTH_CACHE_SIZE`条，超出时淘汰最久未使用的
+
+    单例
+    """
+    _instance = None
+    _new_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            # 可能在多个预约线程中同时第一次使用，初始化完成后才让其他线程看到
+            with cls._new_lock:
+                if cls._instance is None:
+                    instance = object.__new__(cls)
+                    # 盐只在进程内有效，重启后缓存全部失效
+                    instance.salt = os.urandom(16)
+                    instance.lock = threading.Lock()
+                    instance.entries = OrderedDict()  # key -> (result, expires_at, user_key)
+                    instance.hits = 0
+                    instance.misses = 0
+                    cls._instance = instance
+        return cls._instance
+
+    def _hash(self, *parts):
+        message = '\0'.join(parts).encode()
+        return hmac.new(self.salt, message, hashlib.sha256).digest()
+
+    def get(self, username, password):
+        """查询缓存
+
+        :return: 缓存的验证结果True/False，没有缓存或已过期返回None
+        """
+        key = self._hash(username, password)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, username, password, result):
+        """保存一次验证结果"""
+        ttl = config.AUTH_CACHE_TTL if result else config.AUTH_CACHE_NEGATIVE_TTL
+        key = self._hash(username, password)
+        with self.lock:
+            self.entries[key] = (bool(result), time.time() + ttl, self._hash(username))
+            self.entries.move_to_end(key)
+            while len(self.entries) > config.AUTH_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username, password=None):
+        """删除缓存，不传password时删除该用户的所有缓存（如修改了密码）"""
+        with self.lock:
+            if password is not None:
+                self.entries.pop(self._hash(username, password), None)
+            else:
+                user_key = self._hash(username)
+                for key in [k for k, v in self.entries.items() if v[2] == user_key]:
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(size=len(self.entries), hits=self.hits, misses=self.misses)
+
+
+metrics.registry.register(metrics.Gauge(
+    'tem_auth_cache', 'Credential cache size and hit/miss counts', lambda: {
+        (key,): value for key, value in AuthCache().stats().items()}, ['stat']))
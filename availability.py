@@ -0,0 +1,171 @@
+import json
+import time
+import logging
+import datetime
+import threading
+from urllib.parse import urlparse, urlencode
+
+from config import config
+from http_client import HttpClient
+from instrument import Instrument
+from jobstore import RESERVE_DATE_FORMAT
+from errors import ReserveException, SessionExpiredException
+
+# check的结果
+FREE = 'free'
+TAKEN = 'taken'
+UNKNOWN = 'unknown'  # 没有取到日历，不作判断
+
+
+def _minutes(hh_mm):
+    hour, minute = hh_mm.strip().split(':')
+    return int(hour) * 60 + int(minute)
+
+
+def parse_date(text):
+    """'%Y-%m-%d'或'%Y年%m月%d日'格式的日期，无法解析时返回None"""
+    for fmt in ('%Y-%m-%d', RESERVE_DATE_FORMAT):
+        try:
+            return datetime.datetime.strptime(text, fmt).date()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class AvailabilityCache(object):
+    """“易约”各仪器已被预约的时间段的缓存
+
+    按(仪器id, 日期)缓存，每个日期单独记录获取的时间，刷新时只请求过期的日期（连续的日期合并成一次请求）；
+    scheduler的定时任务定期刷新`Instrument.instrument_list`中所有仪器未来`config.AVAILABILITY_DAYS`天的日历
+
+    日历的地址`config.AVAILABILITY_PATH`，GET参数instrumentId, startDate, endDate（'%Y-%m-%d'），
+    返回JSON数组，每项有reserveDate（'%Y-%m-%d'或'%Y年%m月%d日'）, reserveStartTime, reserveEndTime；
+    需要登录，用`config.AVAILABILITY_USERNAME`帐号在自己的CookieJar上登录，没有设置帐号时不获取日历（check返回UNKNOWN）
+
+    单例
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.lock = threading.Lock()
+            # (instrument_id, date) -> (获取的时间, [(开始分钟, 结束分钟)])
+            cls._instance.calendars = {}
+            cls._instance.failed_at = {}  # instrument_id -> 最近一次获取失败的时间，有效期内不再请求
+            cls._instance.client = HttpClient()
+            cls._instance.account = None  # 已登录的ReserveTem，只用它的登录会话
+            cls._instance.account_lock = threading.Lock()
+        return cls._instance
+
+    def _session(self):
+        """查看日历用的已登录的CookieJar，会话过期时重新登录"""
+        # 用到时才导入，reserve.py导入了这个模块
+        from reserve import ReserveTem
+        with self.account_lock:
+            if self.account is None or self.account.username != config.AVAILABILITY_USERNAME:
+                self.account = ReserveTem()
+                self.account.set_account(config.AVAILABILITY_USERNAME, config.AVAILABILITY_PASSWORD)
+            if not self.account.session_valid() and not self.account.login():
+                raise ReserveException('availability account %s login failed' % config.AVAILABILITY_USERNAME)
+            return self.account.cookie
+
+    def _fetch(self, instrument_id, start, end):
+        """获取start到end（包含）的日历，返回{date: [(开始分钟, 结束分钟)]}"""
+        url = config.UPSTREAM_URL + config.AVAILABILITY_PATH + '?' + urlencode(dict(
+            instrumentId=instrument_id, startDate=start.isoformat(), endDate=end.isoformat()))
+        response = self.client.open(url, cookie_jar=self._session())
+        if urlparse(response.geturl()).path != urlparse(url).path:
+            # 被重定向到登录页面，会话已失效，下次重新登录
+            self.account.login_time = None
+            raise SessionExpiredException('availability session expired')
+        bookings = json.loads(response.read().decode('utf-8'))
+        result = {}
+        day = start
+        while day <= end:
+            result[day] = []
+            day += datetime.timedelta(days=1)
+        for booking in bookings:
+            day = parse_date(booking.get('reserveDate'))
+            if day in result:
+                result[day].append((_minutes(booking['reserveStartTime']), _minutes(booking['reserveEndTime'])))
+        return result
+
+    def refresh(self, instrument_id, dates, max_age=None):
+        """刷新过期的日期
+
+        :param str instrument_id: 仪器id
+        :param dates: datetime.date的集合
+        :param float max_age: 超过多少秒算过期，默认`config.AVAILABILITY_TTL`，0表示全部重新获取
+        """
+        if not config.AVAILABILITY_USERNAME:
+            return
+        max_age = config.AVAILABILITY_TTL if max_age is None else max_age
+        now = time.time()
+        with self.lock:
+            if now - self.failed_at.get(instrument_id, 0) < max_age:
+                return
+            stale = sorted(day for day in set(dates)
+                           if (instrument_id, day) not in self.calendars
+                           or now - self.calendars[(instrument_id, day)][0] >= max_age)
+        # 连续的日期一次请求
+        runs = []
+        for day in stale:
+            if runs and day - runs[-1][1] == datetime.timedelta(days=1):
+                runs[-1][1] = day
+            else:
+                runs.append([day, day])
+        for start, end in runs:
+            try:
+                calendar = self._fetch(instrument_id, start, end)
+            except Exception as e:
+                logging.warning('fetch availability of %s %s~%s failed: %s' % (instrument_id, start, end, e))
+                with self.lock:
+                    self.failed_at[instrument_id] = time.time()
+                return
+            fetched_at = time.time()
+            with self.lock:
+                for day, bookings in calendar.items():
+                    self.calendars[(instrument_id, day)] = (fetched_at, bookings)
+
+    def refresh_all(self):
+        """刷新所有仪器未来`config.AVAILABILITY_DAYS`天的日历"""
+        today = datetime.date.today()
+        dates = [today + datetime.timedelta(days=i) for i in range(config.AVAILABILITY_DAYS + 1)]
+        for instrument in Instrument.instrument_list:
+            self.refresh(instrument.instrument_id, dates)
+        # 过去的日期不再需要
+        with self.lock:
+            for key in [key for key in self.calendars if key[1] < today]:
+                del self.calendars[key]
+
+    def check(self, reserve_data, max_age=None):
+        """预约的时间段是否已被预约
+
+        :param dict reserve_data: 预约POST请求提交的数据
+        :param float max_age: 缓存超过多少秒时先刷新，None表示`config.AVAILABILITY_TTL`
+        :return: (FREE/TAKEN/UNKNOWN, 冲突的时间段'9:00-13:00'或None)
+        """
+        instrument_id = reserve_data.get('instrumentId')
+        day = parse_date(reserve_data.get('reserveDate'))
+        try:
+            start, end = _minutes(reserve_data['reserveStartTime']), _minutes(reserve_data['reserveEndTime'])
+        except (KeyError, AttributeError, ValueError):
+            return UNKNOWN, None
+        if day is None:
+            return UNKNOWN, None
+        self.refresh(instrument_id, [day], max_age)
+        with self.lock:
+            entry = self.calendars.get((instrument_id, day))
+        if entry is None:
+            return UNKNOWN, None
+        for booked_start, booked_end in entry[1]:
+            if start < booked_end and booked_start < end:
+                return TAKEN, '%d:%02d-%d:%02d' % (booked_start // 60, booked_start % 60,
+                                                   booked_end // 60, booked_end % 60)
+        return FREE, None
+
+
+def refresh_job():
+    """scheduler的定时任务，定期刷新日历"""
+    AvailabilityCache().refresh_all()
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from time import sleep
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
+from clock import ServerClock
+from scheduler import SchedulerHandler
+from reserve import ReserveTem, planned_posts
+from http_client import HttpClient
+from availability import AvailabilityCache, parse_date
+from dispatch import dispatch, resolution
+import event_log
+
+# 最近的批处理报告，最新的在最后
+reports = deque(maxlen=50)
+
+
+class ReserveBatch(object):
+    """开始预约时间相同的一批预约任务，一起执行
+
+    执行器的线程数等于任务数，不会因为scheduler线程池不够而排队；
+    各任务间隔`config.BATCH_WARMUP_STAGGER`秒依次登录，避免同时登录；
+    开始前一次刷新涉及的日历，去掉时间段已被预约的任务；
+    时间段（包括备选）互相重叠的任务按`config.DISPATCH_POLICY`排名次（见dispatch.py），按名次依次登录、依次提交，
+    名次靠前的第一次提交最早、并发提交最多；
+    `config.ENGINE = 'asyncio'`时所有任务在AsyncEngine的事件循环中执行，不另开线程
+    """
+
+    def __init__(self, trigger_time, jobs_kwargs, on_finished=None):
+        """
+        :param datetime.datetime trigger_time: 开始预约的（服务器）时间
+        :param list jobs_kwargs: 每个任务的kwargs，与keep_reserve_job的参数相同
+        :param on_finished: 可选，每个任务执行完后调用，参数为任务在jobs_kwargs中的序号，
+                如从jobstore中删除已认领的任务
+        """
+        self.trigger_time = trigger_time
+        self.jobs_kwargs = jobs_kwargs
+        self.on_finished = on_finished
+        self.assignments = dispatch(jobs_kwargs)
+
+    def _finished(self, assignment):
+        if self.on_finished is None:
+            return
+        try:
+            self.on_finished(assignment.index)
+        except Exception as e:
+            logging.exception(e)
+
+    def _login_order(self):
+        """按名次登录，各组的第一名最先"""
+        return sorted(self.assignments, key=lambda assignment: (assignment.rank, assignment.index))
+
+    def _run_one(self, assignment, delay):
+        sleep(delay)
+        kwargs = assignment.kwargs
+        reserve = ReserveTem()
+        try:
+            reserve.set_account(kwargs['username'], kwargs['password'], shared_session=True)
+            reserve.set_info(kwargs['reserve_data'], kwargs.get('alternatives'))
+            reserve.set_assignment(assignment)
+            success = reserve.still_possible() and reserve.warm_up() and reserve.fire(self.trigger_time)
+        except Exception as e:
+            logging.exception(e)
+            success = False
+        finally:
+            reserve.release_session()
+            self._finished(assignment)
+        return reserve, success
+
+    def _refresh_availability(self):
+        """一次刷新这批任务涉及的所有日历，之后各任务检查时间段时不用再请求"""
+        if config.AVAILABILITY_MODE == 'off':
+            return
+        dates = defaultdict(set)
+        for kwargs in self.jobs_kwargs:
+            reserve_data = kwargs['reserve_data']
+            day = parse_date(reserve_data.get('reserveDate'))
+            if day is not None:
+                dates[reserve_data.get('instrumentId')].add(day)
+        cache = AvailabilityCache()
+        for instrument_id, days in dates.items():
+            cache.refresh(instrument_id, days, config.AVAILABILITY_PRE_TRIGGER_MAX_AGE)
+
+    def planned_posts(self):
+        """开始预约时这一批同时发出的预约请求数（各任务的并发提交次数之和）"""
+        return sum(planned_posts(assignment.kwargs['reserve_data'], assignment) for assignment in self.assignments)
+
+    async def _run_one_async(self, assignment, delay):
+        from async_reserve import run_reserve
+        kwargs = assignment.kwargs
+        try:
+            return await run_reserve(kwargs['username'], kwargs['password'], kwargs['reserve_data'],
+                                     self.trigger_time, delay=delay, assignment=assignment,
+                                     alternatives=kwargs.get('alternatives'))
+        finally:
+            # on_finished可能读写jobstore，不在事件循环中执行
+            await asyncio.get_running_loop().run_in_executor(None, self._finished, assignment)
+
+    async def _run_all_async(self, order, stagger, posts):
+        from async_http import AsyncHttpClient
+        client = AsyncHttpClient()
+        await client.reserve(config.UPSTREAM_URL, posts)
+        try:
+            return await asyncio.gather(*[self._run_one_async(assignment, i * stagger)
+                                          for i, assignment in enumerate(order)])
+        finally:
+            client.unreserve(config.UPSTREAM_URL, posts)
+
+    def run(self, stagger=None):
+        """执行这一批任务
+
+        :param float stagger: 各任务登录的间隔（秒），默认按`config.BATCH_WARMUP_STAGGER`，
+                重启后补执行错过的任务时为0
+
+        :return: dict 批处理报告
+                jobs 任务数，success 成功数，dropped 因时间段已被预约而没有执行的任务数，
+                posts 开始预约时同时发出的预约请求数，
+                skew 各任务第一次提交（请求写入连接）的时间差（秒），
+                first_post_delay 最早的提交相对开始预约时间（本地）的延迟（秒），负数表示提前，
+                max_release_error 各任务第一次提交的最大释放误差（秒），
+                dispatch 排序策略和各组互相竞争的任务的名次（见dispatch.resolution），每项有是否成功
+        """
+        clock = ServerClock()
+        if clock.is_stale():
+            clock.calibrate()
+        self._refresh_availability()
+        count = len(self.jobs_kwargs)
+        if stagger is None:
+            stagger = min(config.BATCH_WARMUP_STAGGER, config.WARMUP_SECONDS / 2 / count)
+        order = self._login_order()
+        # 同时发出的预约请求不在连接池中排队：连接池临时增加这一批的请求数，各任务按自己的请求数预先建立连接
+        posts = self.planned_posts()
+        if config.ENGINE == 'asyncio':
+            # 只有使用asyncio时才导入
+            from async_reserve import AsyncEngine
+            results = AsyncEngine().run(self._run_all_async(order, stagger, posts))
+        else:
+            client = HttpClient()
+            client.reserve(config.UPSTREAM_URL, posts)
+            try:
+                with ThreadPoolExecutor(max_workers=count) as executor:
+                    futures = [executor.submit(self._run_one, assignment, i * stagger)
+                               for i, assignment in enumerate(order)]
+                    results = [future.result() for future in futures]
+            finally:
+                client.unreserve(config.UPSTREAM_URL, posts)
+        outcomes = {assignment.index: success for assignment, (reserve, success) in zip(order, results)}
+
+        target = clock.to_local(self.trigger_time)
+        first_posts = [reserve.first_post_at for reserve, success in results if reserve.first_post_at]
+        release_errors = [abs(reserve.release_error) for reserve, success in results
+                          if reserve.release_error is not None]
+        report = dict(
+            trigger_time=self.trigger_time.strftime('%Y-%m-%d %H:%M:%S'),
+            jobs=count,
+            posts=posts,
+            success=sum(1 for reserve, success in results if success),
+            dropped=sum(1 for reserve, success in results if reserve.dropped),
+            skew=(max(first_posts) - min(first_posts)).total_seconds() if first_posts else None,
+            first_post_delay=(min(first_posts) - target).total_seconds() if first_posts else None,
+            max_release_error=max(release_errors) if release_errors else None,
+            dispatch=resolution(self.assignments, outcomes)
+        )
+        reports.append(report)
+        event_log.emit('batch', **report)
+        return report
+
+
+def run_batch_job(trigger_time):
+    """scheduler的定时任务，认领开始预约时间为trigger_time的所有预约任务一起执行，每个任务执行完后从jobstore删除
+
+    :param datetime.datetime trigger_time: 开始预约的（服务器）时间
+    """
+    handler = SchedulerHandler()
+    jobs = handler.take_trigger_jobs(trigger_time)
+    if not jobs:
+        return None
+    return ReserveBatch(trigger_time, [job.kwargs for job in jobs],
+                        on_finished=lambda i: handler.finish_trigger_job(jobs[i].id)).run()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""预约热路径的基准测试
+
+在本地启动模拟的“易约”服务器（fake_upstream.py），多次运行keep_reserve_job，统计：
+    first_post: 开始预约时间到第一个预约请求到达服务器的时间（毫秒，负数表示提前到达）
+    attempts: 成功前服务器收到的预约请求数
+    success_rate: 预约成功的比例
+结果追加保存到--output文件（JSON lines），并和上一次相同参数的结果比较
+
+用法：python3 benchmark.py --runs 20 --latency 0.02 --error-rate 0.1
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import subprocess
+from concurrent.futures import Future
+
+import config as Config
+
+Config.config = Config.get_config('production')
+from config import config
+
+# 不写入真正的jobstore
+config.SCHEDULER_STORE_URL = 'sqlite://'
+
+from fake_upstream import FakeUpstream
+from instrument import Instrument
+from release import PreciseTimer
+from clock import ServerClock
+from reserve import keep_reserve_job
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_once(fake, no, instrument, lead, open_offset):
+    """运行一次keep_reserve_job，返回这一次的测量结果"""
+    trigger_time = datetime.datetime.now() + datetime.timedelta(seconds=lead)
+    fake.reset(open_time=trigger_time.timestamp() + open_offset)
+    username = 'bench%d_%d' % (no, int(time.time()))
+    reserve_data = dict(
+        reserveDate=(datetime.date.today() + datetime.timedelta(days=7)).strftime('%Y年%m月%d日'),
+        reserveStartTime='9:00',
+        reserveEndTime='13:00',
+        instrumentId=instrument.instrument_id,
+        ReserveReport='benchmark'
+    )
+    success = keep_reserve_job(username, 'password', reserve_data, trigger_time=trigger_time)
+    if isinstance(success, Future):
+        # asyncio引擎返回Future
+        success = success.result()
+
+    posts = [post for post in fake.reserve_posts if post[1] == username]
+    first_post = (posts[0][0] - trigger_time.timestamp()) * 1000 if posts else None
+    attempts = None
+    for i, post in enumerate(posts):
+        if post[2] == 'success':
+            attempts = i + 1
+            break
+    return dict(success=bool(success), first_post=first_post, attempts=attempts)
+
+
+def summarize(results):
+    first_posts = [r['first_post'] for r in results if r['first_post'] is not None]
+    attempts = [r['attempts'] for r in results if r['attempts'] is not None]
+    return dict(
+        runs=len(results),
+        success_rate=sum(1 for r in results if r['success']) / len(results),
+        first_post_p50=percentile(first_posts, 50),
+        first_post_p95=percentile(first_posts, 95),
+        first_post_max=max(first_posts) if first_posts else None,
+        attempts_p50=percentile(attempts, 50),
+        attempts_mean=sum(attempts) / len(attempts) if attempts else None,
+        release_error=PreciseTimer().stats()
+    )
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous(path, params):
+    """读取上一次参数相同的结果"""
+    previous = None
+    try:
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get('params') == params:
+                    previous = record
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def compare(summary, previous):
+    print('compared with %s (%s):' % (previous['time'], previous.get('revision')))
+    for key in ('success_rate', 'first_post_p50', 'first_post_p95', 'attempts_mean'):
+        old, new = previous['summary'].get(key), summary.get(key)
+        if old is None or new is None:
+            continue
+        print('  %-16s %10.3f -> %10.3f (%+.3f)' % (key, old, new, new - old))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='keep_reserve_job benchmark against a local fake upstream')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--instrument', default='OLD_F20', help='name in resources.instruments')
+    parser.add_argument('--latency', type=float, default=0.01, help='upstream latency per request (s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='upstream latency jitter (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='ratio of 500 responses')
+    parser.add_argument('--open-offset', type=float, default=0.0,
+                        help='window opens this many seconds after the trigger time (server clock)')
+    parser.add_argument('--lead', type=float, default=1.0, help='seconds from job start to trigger time')
+    parser.add_argument('--engine', default=config.ENGINE, choices=['thread', 'asyncio'])
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(filename='log_benchmark.log', level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    config.ENGINE = args.engine
+    fake = FakeUpstream(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    config.UPSTREAM_URL = fake.start()
+    instrument = Instrument.get(name=args.instrument)
+    # 先校准时钟，否则第一次运行时校准会占用等待时间
+    ServerClock().calibrate()
+
+    results = []
+    for i in range(args.runs):
+        result = run_once(fake, i, instrument, args.lead, args.open_offset)
+        results.append(result)
+        print('run %3d: success=%s first_post=%s attempts=%s' % (
+            i + 1, result['success'], result['first_post'] and '%.2fms' % result['first_post'],
+            result['attempts']))
+    fake.stop()
+
+    summary = summarize(results)
+    params = dict(instrument=args.instrument, latency=args.latency, jitter=args.jitter,
+                  error_rate=args.error_rate, open_offset=args.open_offset, lead=args.lead,
+                  engine=args.engine)
+    print(json.dumps(summary, indent=2))
+    previous = load_previous(args.output, params)
+    if previous:
+        compare(summary, previous)
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(dict(time=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                revision=git_revision(), params=params, summary=summary)) + '\n')
+    return summary
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+import time
+import datetime
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError
+
+from config import config
+import metrics
+from http_client import HttpClient
+
+
+class ServerClock(object):
+    """估计“易约”服务器时钟与本地时钟的偏差，以及请求的单程延迟
+
+    每次采样记录发出请求的本地时间t0、收到响应的本地时间t1和响应头中的Date（精确到秒）。
+    服务器在t0到t1之间生成Date，所以偏差offset（服务器时间 - 本地时间）满足：
+        Date - t1 <= offset < Date + 1 - t0
+    多次采样时把这些区间取交集，间隔错开采样可以卡住Date跳秒的时刻，把误差缩小到远小于1秒；
+    交集为空时（网络抖动或时钟跳变）按NTP的做法，取往返时间最短的一次采样估计
+
+    单例，所有预约任务共享同一个估计
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.lock = threading.Lock()
+            cls._instance.offset = 0.0  # 秒，服务器时间 - 本地时间
+            cls._instance.latency = 0.0  # 秒，请求的单程延迟
+            cls._instance.error = None  # 秒，offset的误差范围（±），None表示还未校准
+            cls._instance.sample_count = 0
+            cls._instance.calibrated_at = None
+        return cls._instance
+
+    @staticmethod
+    def _sample(url):
+        """采样一次，返回(t0, t1, server_timestamp)"""
+        t0 = time.time()
+        try:
+            headers = HttpClient().open(url, method='HEAD').info()
+        except HTTPError as e:
+            # 4xx/5xx的响应也带有Date
+            headers = e.headers
+        t1 = time.time()
+        return t0, t1, parsedate_to_datetime(headers['Date']).timestamp()
+
+    def calibrate(self, url=None, samples=None):
+        """采样服务器时间并更新估计
+
+        :param str url: 采样的地址，默认“易约”首页
+        :param int samples: 采样次数，默认config.CLOCK_SAMPLES
+        :return: 校准成功返回True，否则False（保留原来的估计）
+        """
+        url = url or config.UPSTREAM_URL + '/'
+        samples = samples or config.CLOCK_SAMPLES
+        results = []
+        for i in range(samples):
+            try:
+                results.append(self._sample(url))
+            except Exception as e:
+                logging.warning('clock sample no.%d failed: %s' % (i + 1, e))
+            if i < samples - 1:
+                # 错开采样在一秒内的相位，最后一次采样后不用等
+                sleep_time = (i + 1) / samples - (time.time() % 1)
+                time.sleep(sleep_time % 1)
+        if not results:
+            return False
+
+        low = max(date - t1 for t0, t1, date in results)
+        high = min(date + 1 - t0 for t0, t1, date in results)
+        t0, t1, date = min(results, key=lambda r: r[1] - r[0])
+        min_delay = t1 - t0
+        if low <= high:
+            offset, error = (low + high) / 2, (high - low) / 2
+        else:
+            offset, error = date + 0.5 - (t0 + t1) / 2, 0.5 + min_delay / 2
+
+        with self.lock:
+            self.offset = offset
+            self.latency = min_delay / 2
+            self.error = error
+            self.sample_count = len(results)
+            self.calibrated_at = datetime.datetime.now()
+        logging.info('server clock calibrated: offset %.3fs ±%.3fs, latency %.3fs, %d samples' % (
+            offset, error, min_delay / 2, len(results)))
+        return True
+
+    def is_stale(self):
+        """是否需要重新校准"""
+        if self.calibrated_at is None:
+            return True
+        age = (datetime.datetime.now() - self.calibrated_at).total_seconds()
+        return age > config.CLOCK_MAX_AGE
+
+    def to_local(self, server_time):
+        """服务器时间为server_time时，本地应该发出请求的时间
+
+        减去偏差，再提前单程延迟，使请求在server_time到达服务器
+
+        :param datetime.datetime server_time: 服务器时间
+        :return: datetime.datetime 本地时间
+        """
+        with self.lock:
+            shift = self.offset + self.latency
+        return server_time - datetime.timedelta(seconds=shift)
+
+    def status(self):
+        with self.lock:
+            return dict(
+                offset=self.offset,
+                latency=self.latency,
+                error=self.error,
+                samples=self.sample_count,
+                calibrated_at=self.calibrated_at.strftime('%Y-%m-%d %H:%M:%S') if self.calibrated_at else None
+            )
+
+
+def calibrate_job():
+    """scheduler的定时任务，定期校准服务器时钟"""
+    ServerClock().calibrate()
+
+
+metrics.registry.register(metrics.Gauge(
+    'tem_server_clock_seconds', 'Estimated server clock offset, one-way latency and error bound', lambda: {
+        (key,): ServerClock().status()[key] for key in ('offset', 'latency', 'error')}
+    if ServerClock().calibrated_at is not None else None, ['stat']))
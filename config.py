@@ -1,5 +1,102 @@
 class Config:
     INTERVAL = 1
+    # 预热时间：定时任务提前多少秒触发，先登录，到开始预约时间再提交预约
+    WARMUP_SECONDS = 30
+    # 登录会话的最长使用时间（秒），超过后提交预约前重新登录
+    SESSION_MAX_AGE = 600
+    # “易约”的地址，测试时可以换成本地的模拟服务器（fake_upstream.py）
+    UPSTREAM_URL = 'http://cem.ylab.cn'
+    # 服务器时钟校准：每次校准的采样次数、校准结果的有效期和定期校准的间隔（秒）
+    CLOCK_SAMPLES = 8
+    CLOCK_MAX_AGE = 3600
+    CLOCK_CALIBRATE_INTERVAL = 1800
+    # HTTP连接池：每个host的最大连接数、请求超时、空闲连接的保留时间（秒），
+    # 以及开始预约前多少秒预先建立连接
+    HTTP_POOL_SIZE = 10
+    HTTP_TIMEOUT = 10
+    HTTP_IDLE_TIMEOUT = 15
+    HTTP_PRE_OPEN_SECONDS = 2
+    # 帐号验证缓存：登录成功、失败结果的缓存时间（秒）和最大条数
+    AUTH_CACHE_TTL = 600
+    AUTH_CACHE_NEGATIVE_TTL = 30
+    AUTH_CACHE_SIZE = 1024
+    # scheduler中任务的默认设置
+    JOB_DEFAULTS = dict(misfire_grace_time=1, coalesce=True, max_instances=1)
+    # 重启时：先加载多少秒内触发的任务（其余在后台加载），开始预约时间已过多少秒以内的任务仍立即执行
+    RESTART_PRELOAD_SECONDS = 600
+    RESTART_MISFIRE_GRACE = 300
+    # 一条预约最多的备选时间段数
+    ALTERNATIVES_MAX = 5
+    # 每周重复的预约规则（recurring.py）：检查规则、生成下一个任务的间隔（秒），每个用户最多的规则数
+    RECURRING_MATERIALIZE_INTERVAL = 600
+    RECURRING_MAX_RULES = 20
+    # 批量预约一次最多的条数
+    BATCH_MAX_SIZE = 100
+    # jobstore（sqlite）连接池的最大连接数
+    JOBSTORE_POOL_SIZE = 4
+    # /api/scheduled_jobs分页时每页最多的任务数
+    JOBS_PAGE_MAX = 500
+    # 开始预约时间相同的任务合并执行：批处理任务比预热再提前的秒数，以及各任务依次登录的间隔（秒）
+    BATCH_PREPARE_SECONDS = 5
+    BATCH_WARMUP_STAGGER = 0.2
+    # 同一批中时间段互相重叠的任务的排序（dispatch.py）：'priority' 按优先级，'fifo' 按设定的先后，'round_robin' 各用户轮流；
+    # 每个名次第一次提交推迟的秒数，并发提交次数每个名次乘以的系数和最少的次数，以及各用户的优先级（默认0，越大越优先）
+    DISPATCH_POLICY = 'priority'
+    DISPATCH_RELEASE_STEP = 0.02
+    DISPATCH_BURST_DECAY = 0.5
+    DISPATCH_BURST_MIN = 1
+    USER_PRIORITIES = {}
+    # 高精度提交：自旋等待的最长时间（秒），保留的释放误差记录条数
+    RELEASE_SPIN_MAX = 0.02
+    RELEASE_ERROR_HISTORY = 1000
+    # 预约事件日志（JSON lines），与程序日志分开：文件名，切分方式'size'或'time'，
+    # 按大小切分时的文件大小，按时间切分时的间隔，保留的旧文件数
+    EVENT_LOG_FILE = 'reserve_events.jsonl'
+    EVENT_LOG_ROTATE = 'size'
+    EVENT_LOG_MAX_BYTES = 10 * 1024 * 1024
+    EVENT_LOG_WHEN = 'midnight'
+    EVENT_LOG_BACKUP_COUNT = 10
+    # 预约失败后的重试策略（见retry.py），动作：'retry_now', 'backoff', 'relogin', 'abort'
+    # RETRY_RULES按顺序匹配errorCode中包含的文字，RETRY_HTTP_RULES按HTTP状态码匹配，
+    # 都不匹配时用RETRY_DEFAULT；退避的等待时间从RETRY_BACKOFF_BASE开始每次加倍，最长RETRY_BACKOFF_MAX秒
+    RETRY_RULES = [
+        ('未开放', 'retry_now'),
+        ('未开始', 'retry_now'),
+        ('已被预约', 'abort'),
+        ('已被占用', 'abort'),
+        ('无权', 'abort'),
+        ('没有权限', 'abort'),
+    ]
+    RETRY_HTTP_RULES = {500: 'backoff', 502: 'backoff', 503: 'backoff', 504: 'backoff'}
+    RETRY_DEFAULT = 'backoff'
+    RETRY_BACKOFF_BASE = 0.5
+    RETRY_BACKOFF_MAX = 4
+    RETRY_NOW_DELAY = 0.05
+    # 已被预约时间段的缓存（availability.py）：'off' 不检查，'warn' 设定预约时提示，'reject' 设定预约时拒绝；
+    # 任何模式下（'off'除外）开始预约前都会去掉已被预约的任务
+    # 日历需要登录后才能查看，用AVAILABILITY_USERNAME/PASSWORD这个易约帐号登录，没有设置时不获取日历；
+    # 日历的地址（相对UPSTREAM_URL），缓存的天数、有效期和定期刷新的间隔（秒），开始预约前检查时缓存的最长有效期（秒）
+    AVAILABILITY_MODE = 'off'
+    AVAILABILITY_USERNAME = None
+    AVAILABILITY_PASSWORD = None
+    AVAILABILITY_PATH = '/user/reserveList.action'
+    AVAILABILITY_DAYS = 14
+    AVAILABILITY_TTL = 300
+    AVAILABILITY_REFRESH_INTERVAL = 120
+    AVAILABILITY_PRE_TRIGGER_MAX_AGE = 10
+    # scheduler的运行方式：'inline' 与web服务在同一进程中；'remote' 单独的scheduler进程（python main.py scheduler）
+    # 执行任务，web进程通过本地IPC调用它（scheduler_service.py），可以运行多个web进程
+    # IPC的地址：unix socket的路径（None表示jobstore文件名加'.sock'，只有所有者可以连接）；
+    # 认证密钥从环境变量ZJU_TEM_SCHEDULER_AUTHKEY或SCHEDULER_AUTHKEY_FILE文件（权限必须是0600）读取，没有时不能使用'remote'；
+    # 以及保证只有一个scheduler执行任务的锁文件（None表示jobstore文件名加'.lock'）
+    SCHEDULER_MODE = 'inline'
+    SCHEDULER_ADDRESS = None
+    SCHEDULER_AUTHKEY_FILE = None
+    SCHEDULER_LOCK_FILE = None
+    # 预约任务的执行方式：'thread' 每个任务占用一个线程；
+    # 'asyncio' 所有任务在一个事件循环中执行（async_reserve.py），以及此时每个host的最大连接数
+    ENGINE = 'thread'
+    ASYNC_HTTP_POOL_SIZE = 200
     ADMIN_USERNAME = 'root'
     ADMIN_PASSWORD = '00432791'
 
@@ -0,0 +1,147 @@
+from collections import defaultdict, OrderedDict
+
+from config import config
+from interval_index import minutes_of
+
+# 排序策略
+PRIORITY = 'priority'  # 优先级高的在前，相同时先设定的在前
+FIFO = 'fifo'  # 先设定的在前
+ROUND_ROBIN = 'round_robin'  # 各用户轮流，每个用户先设定的在前
+
+
+class Assignment(object):
+    """一个任务在互相竞争的任务中的名次，以及由名次决定的提交时间和并发次数"""
+    __slots__ = ('index', 'kwargs', 'rank', 'group', 'release_offset', 'burst_count')
+
+    def __init__(self, index, kwargs, rank, group=None):
+        """
+        :param int index: 任务在这一批中的位置
+        :param dict kwargs: 任务的kwargs
+        :param int rank: 名次，0最先
+        :param int group: 互相竞争的一组任务的编号（组中最小的index），见`collision_groups`
+        """
+        self.index = index
+        self.kwargs = kwargs
+        self.rank = rank
+        self.group = index if group is None else group
+        # 第一次提交比开始预约时间晚多少秒
+        self.release_offset = rank * config.DISPATCH_RELEASE_STEP
+        # 仪器设置了burst时的并发提交次数，None表示按仪器的设置
+        self.burst_count = None
+
+    def burst_for(self, burst):
+        """按名次减少的burst设置，名次越靠后并发提交越少，至少`config.DISPATCH_BURST_MIN`次"""
+        if burst is None:
+            return None
+        count = max(min(config.DISPATCH_BURST_MIN, burst['count']),
+                    int(burst['count'] * config.DISPATCH_BURST_DECAY ** self.rank))
+        return dict(burst, count=count)
+
+    def describe(self):
+        return dict(rank=self.rank, username=self.kwargs.get('username'),
+                    priority=self.kwargs.get('priority', 0), submitted_at=self.kwargs.get('submitted_at'),
+                    instrumentId=self.kwargs['reserve_data'].get('instrumentId'),
+                    reserveDate=self.kwargs['reserve_data'].get('reserveDate'),
+                    reserveStartTime=self.kwargs['reserve_data'].get('reserveStartTime'),
+                    release_offset=self.release_offset, burst_count=self.burst_count)
+
+
+def _submitted_at(kwargs):
+    # 旧任务没有submitted_at，比之后设定的任务都早
+    return kwargs.get('submitted_at') or 0
+
+
+def _order(indexed, policy):
+    """按策略排序[(index, kwargs)]"""
+    if policy == FIFO:
+        return sorted(indexed, key=lambda item: (_submitted_at(item[1]), item[0]))
+    if policy == ROUND_ROBIN:
+        queues = OrderedDict()
+        for item in sorted(indexed, key=lambda item: (_submitted_at(item[1]), item[0])):
+            queues.setdefault(item[1].get('username'), []).append(item)
+        result = []
+        for i in range(max(len(queue) for queue in queues.values())):
+            result.extend(queue[i] for queue in queues.values() if i < len(queue))
+        return result
+    if policy == PRIORITY:
+        return sorted(indexed, key=lambda item: (-item[1].get('priority', 0), _submitted_at(item[1]), item[0]))
+    raise ValueError('unknown dispatch policy: %s' % policy)
+
+
+def _windows(kwargs):
+    """任务会尝试的所有时间段（主预约和备选）：((仪器id, 实验日期), 开始分钟, 结束分钟)"""
+    for reserve_data in [kwargs['reserve_data']] + list(kwargs.get('alternatives') or []):
+        start = minutes_of(reserve_data.get('reserveStartTime'))
+        end = minutes_of(reserve_data.get('reserveEndTime'))
+        if start is None or end is None:
+            # 时间不正确时按整天算，与同一天的任务都竞争
+            start, end = 0, 24 * 60
+        yield (reserve_data.get('instrumentId'), reserve_data.get('reserveDate')), start, end
+
+
+def collision_groups(jobs_kwargs):
+    """互相竞争的任务分组：两个任务的时间段（包括备选）在同一仪器、同一实验日期重叠时竞争，
+    竞争关系传递，直接或间接竞争的任务在同一组
+
+    :param list jobs_kwargs: 每个任务的kwargs
+    :return: 每个任务所在组的编号（组中最小的位置），与jobs_kwargs一一对应
+    """
+    parent = list(range(len(jobs_kwargs)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    slots = defaultdict(list)
+    for index, kwargs in enumerate(jobs_kwargs):
+        for slot, start, end in _windows(kwargs):
+            slots[slot].append((start, end, index))
+    for windows in slots.values():
+        # 按开始时间扫描，与当前连在一起的时间段的最晚结束时间比较
+        first, reach = None, None
+        for start, end, index in sorted(windows):
+            if reach is not None and start < reach:
+                union(first, index)
+                reach = max(reach, end)
+            else:
+                first, reach = index, end
+    return [find(index) for index in range(len(jobs_kwargs))]
+
+
+def dispatch(jobs_kwargs, policy=None):
+    """给开始预约时间相同的一批任务排名次，只有互相竞争的任务（见`collision_groups`）才排序，
+    不和其他任务竞争的任务名次都是0
+
+    :param list jobs_kwargs: 每个任务的kwargs
+    :param str policy: PRIORITY, FIFO或ROUND_ROBIN，默认`config.DISPATCH_POLICY`
+    :return: list of Assignment，与jobs_kwargs一一对应
+    """
+    policy = policy or config.DISPATCH_POLICY
+    groups = defaultdict(list)
+    for index, group in enumerate(collision_groups(jobs_kwargs)):
+        groups[group].append((index, jobs_kwargs[index]))
+    assignments = [None] * len(jobs_kwargs)
+    for group, indexed in groups.items():
+        for rank, (index, kwargs) in enumerate(_order(indexed, policy)):
+            assignments[index] = Assignment(index, kwargs, rank, group)
+    return assignments
+
+
+def resolution(assignments, outcomes=None, policy=None):
+    """这一批的排序结果，按互相竞争的组分组、名次排序，记录在批处理报告中
+
+    :param dict outcomes: 任务的位置 -> 是否预约成功
+    :return: dict policy 排序策略，queues 各组的名次列表，按组中最先的任务排序
+    """
+    outcomes = outcomes or {}
+    queues = defaultdict(list)
+    for assignment in sorted(assignments, key=lambda assignment: (assignment.group, assignment.rank)):
+        queues[assignment.group].append(dict(assignment.describe(), success=outcomes.get(assignment.index)))
+    return dict(policy=policy or config.DISPATCH_POLICY, queues=[queues[group] for group in sorted(queues)])
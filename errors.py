@@ -8,3 +8,15 @@ class ReserveException(Exception):
     """ReserveTem中的异常，如调用顺序不符合要求
     """
     pass
+
+
+class SessionExpiredException(ReserveException):
+    """登录会话失效，预约请求被重定向到登录页面
+    """
+    pass
+
+
+class SchedulerException(Exception):
+    """scheduler进程相关异常，如已有另一个scheduler在运行、无法连接scheduler进程
+    """
+    pass
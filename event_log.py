@@ -0,0 +1,75 @@
+import json
+import queue
+import logging
+import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+from config import config
+
+# 预约事件单独的logger，不传给程序日志
+logger = logging.getLogger('reserve_events')
+logger.propagate = False
+logger.setLevel(logging.INFO)
+
+_listener = None
+
+
+class _PassThroughQueueHandler(QueueHandler):
+    """直接把record放入队列，格式化留给后台线程，预约线程只做一次入队"""
+
+    def prepare(self, record):
+        return record
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        event = dict(time=datetime.datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S.%f'))
+        if isinstance(record.msg, dict):
+            event.update(record.msg)
+        else:
+            event['message'] = record.getMessage()
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+def setup(filename=None):
+    """启动后台写入线程，之后emit的事件写入JSON lines文件
+
+    按`config.EVENT_LOG_ROTATE`切分文件：'size'按大小，'time'按时间；
+    没有调用setup时事件被丢弃
+
+    :param str filename: 日志文件，默认`config.EVENT_LOG_FILE`
+    """
+    global _listener
+    if _listener is not None:
+        return
+    filename = filename or config.EVENT_LOG_FILE
+    if config.EVENT_LOG_ROTATE == 'time':
+        handler = TimedRotatingFileHandler(filename, when=config.EVENT_LOG_WHEN,
+                                           backupCount=config.EVENT_LOG_BACKUP_COUNT, encoding='utf-8')
+    else:
+        handler = RotatingFileHandler(filename, maxBytes=config.EVENT_LOG_MAX_BYTES,
+                                      backupCount=config.EVENT_LOG_BACKUP_COUNT, encoding='utf-8')
+    handler.setFormatter(JsonLinesFormatter())
+    events = queue.SimpleQueue()
+    logger.addHandler(_PassThroughQueueHandler(events))
+    _listener = QueueListener(events, handler)
+    _listener.start()
+
+
+def shutdown():
+    """写完队列中剩余的事件后停止后台线程"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def emit(event, **fields):
+    """记录一条预约事件，不阻塞
+
+    :param str event: 事件类型，如'attempt', 'success'
+    :param fields: 事件的其他字段，不能包含密码
+    """
+    logger.info(dict(event=event, **fields))
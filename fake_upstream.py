@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""本地模拟的“易约”服务器，用于基准测试和压力测试
+
+模拟：
+    POST /doLogin.action 帐号正确时重定向到首页并设置cookie，错误时停留在登录页
+    POST /user/doReserve.action 未登录时重定向到登录页；
+        预约结果通过重定向地址中的errorType/errorCode返回（errorCode经过两次url编码）
+    GET /user/reserveList.action 已被预约的时间段（JSON），参数instrumentId, startDate, endDate，见availability.py；
+        未登录时重定向到登录页
+    HEAD/GET 其他地址 返回200，带Date响应头
+
+可以设置每个请求的延迟、500错误的比例和开放预约的时间
+
+单独运行：python3 fake_upstream.py [port]
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import datetime
+import threading
+from urllib.parse import parse_qs, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+NOT_OPEN = '预约尚未开放'
+SLOT_TAKEN = '该时间段已被预约'
+
+
+class FakeUpstream(object):
+    """模拟服务器的状态和设置，线程安全
+
+    :param dict accounts: 用户名 -> 密码，为None时任意帐号都能登录
+    :param float latency: 每个请求的延迟（秒）
+    :param float jitter: 延迟的随机波动（秒）
+    :param float error_rate: 返回500错误的比例
+    :param float open_time: 开放预约的时间（time.time()时间戳），之前的预约返回“未开放”
+    """
+
+    def __init__(self, accounts=None, latency=0.0, jitter=0.0, error_rate=0.0, open_time=0.0):
+        self.accounts = accounts
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.open_time = open_time
+        self.lock = threading.Lock()
+        self.sessions = {}  # session id -> username
+        self.bookings = {}  # (instrumentId, reserveDate, reserveStartTime) -> (username, reserveEndTime)
+        self.reserve_posts = []  # (到达时间, username, 结果)
+        self.login_count = 0
+        self.server = None
+
+    def reset(self, open_time=None):
+        """清空预约记录，开始新的一轮"""
+        with self.lock:
+            self.bookings.clear()
+            self.reserve_posts = []
+            self.login_count = 0
+            if open_time is not None:
+                self.open_time = open_time
+
+    def start(self, host='127.0.0.1', port=0):
+        """在后台线程中启动，返回服务器地址，如'http://127.0.0.1:18000'"""
+        self.server = _Server((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.upstream = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://%s:%d' % self.server.server_address[:2]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def delay(self):
+        seconds = self.latency + random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+    def login(self, username, password):
+        """返回session id，帐号错误返回None"""
+        with self.lock:
+            self.login_count += 1
+            if self.accounts is not None and self.accounts.get(username) != password:
+                return None
+            session = uuid.uuid4().hex
+            self.sessions[session] = username
+            return session
+
+    def logged_in(self, session):
+        with self.lock:
+            return session in self.sessions
+
+    def book(self, instrument_id, reserve_date, start_time, end_time, username='someone'):
+        """直接占用一个时间段，reserve_date为'%Y年%m月%d日'格式"""
+        with self.lock:
+            self.bookings[(instrument_id, reserve_date, start_time)] = (username, end_time)
+
+    def calendar(self, instrument_id, start, end):
+        """instrument_id在start到end（'%Y-%m-%d'，包含）之间已被预约的时间段"""
+        with self.lock:
+            bookings = list(self.bookings.items())
+        result = []
+        for (booked_id, reserve_date, start_time), (username, end_time) in bookings:
+            day = datetime.datetime.strptime(reserve_date, '%Y年%m月%d日').strftime('%Y-%m-%d')
+            if booked_id == instrument_id and start <= day <= end:
+                result.append(dict(reserveDate=reserve_date, reserveStartTime=start_time, reserveEndTime=end_time))
+        return result
+
+    def reserve(self, session, form, arrived_at):
+        """返回(是否已登录, errorType, errorCode)"""
+        with self.lock:
+            username = self.sessions.get(session)
+            if username is None:
+                return False, None, None
+            key = (form.get('instrumentId'), form.get('reserveDate'), form.get('reserveStartTime'))
+            if arrived_at < self.open_time:
+                result = ('error', NOT_OPEN)
+            elif key in self.bookings and self.bookings[key][0] != username:
+                result = ('error', SLOT_TAKEN)
+            else:
+                self.bookings[key] = (username, form.get('reserveEndTime'))
+                result = ('success', '')
+            self.reserve_posts.append((arrived_at, username, result[0]))
+            return (True,) + result
+
+
+class _Server(ThreadingHTTPServer):
+    # 同时建立数百个连接（asyncio引擎）时不丢弃
+    request_queue_size = 512
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def upstream(self):
+        return self.server.upstream
+
+    def _session(self):
+        for part in self.headers.get('Cookie', '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'JSESSIONID':
+                return value
+        return None
+
+    def _respond(self, status, location=None, cookie=None, body=b''):
+        self.send_response(status)
+        if location:
+            self.send_header('Location', location)
+        if cookie:
+            self.send_header('Set-Cookie', 'JSESSIONID=%s; Path=/' % cookie)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_POST(self):
+        arrived_at = time.time()
+        length = int(self.headers.get('Content-Length', 0))
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        self.upstream.delay()
+        if self.upstream.should_fail():
+            return self._respond(500, body=b'Internal Server Error')
+
+        path = self.path.split('?')[0]
+        if path == '/doLogin.action':
+            session = self.upstream.login(form.get('username'), form.get('password'))
+            if session is None:
+                return self._respond(200, body=b'login')
+            return self._respond(302, location='/user/index.action', cookie=session)
+        if path == '/user/doReserve.action':
+            logged_in, error_type, error_code = self.upstream.reserve(self._session(), form, arrived_at)
+            if not logged_in:
+                return self._respond(302, location='/login.action')
+            location = '/user/reserve.action?errorType=%s' % error_type
+            if error_code:
+                location += '&errorCode=' + quote(quote(error_code))
+            return self._respond(302, location=location)
+        self._respond(404)
+
+    def do_GET(self):
+        self.upstream.delay()
+        path, _, query = self.path.partition('?')
+        if self.command == 'GET' and path == '/user/reserveList.action':
+            if not self.upstream.logged_in(self._session()):
+                return self._respond(302, location='/login.action')
+            params = {k: v[0] for k, v in parse_qs(query).items()}
+            calendar = self.upstream.calendar(params.get('instrumentId'), params.get('startDate', ''),
+                                              params.get('endDate', ''))
+            return self._respond(200, body=json.dumps(calendar, ensure_ascii=False).encode('utf-8'))
+        self._respond(200, body=b'ok')
+
+    do_HEAD = do_GET
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 18000
+    fake = FakeUpstream()
+    print('fake upstream running at %s' % fake.start(port=port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
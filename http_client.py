@@ -0,0 +1,278 @@
+import io
+import time
+import datetime
+import threading
+import http.client
+from collections import deque
+from http.cookiejar import CookieJar
+from urllib.request import Request
+from urllib.parse import urlsplit, urljoin
+from urllib.error import HTTPError
+
+from config import config
+
+
+class Response(object):
+    """一次请求（跟随重定向之后）的结果，接口与urllib的响应对象相同：geturl() info() read()"""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self):
+        return self.body
+
+
+class PreparedRequest(object):
+    """构造好的请求：路径、请求头（包括cookie）和body都已确定，可以在多个线程中重复发送"""
+
+    def __init__(self, method, url, body, cookie_jar=None):
+        self.method = method
+        self.url = url
+        self.body = body
+        # cookie的处理借用urllib的Request
+        self.request = Request(url, data=body, method=method)
+        if body is not None:
+            self.request.add_header('Content-Type', 'application/x-www-form-urlencoded')
+        if cookie_jar is not None:
+            cookie_jar.add_cookie_header(self.request)
+        self.headers = dict(self.request.header_items())
+        parts = urlsplit(url)
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+
+
+class _HostPool(object):
+    """一个host的连接池，最多同时使用`size`个连接，空闲的连接保持keep-alive以便复用
+
+    批处理开始预约时同时发出的请求可能多于`size`，用`reserve`临时增加可以同时使用的连接数
+    """
+
+    def __init__(self, scheme, host, port, size):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.base_size = size
+        self.size = size
+        self.in_use = 0
+        self.condition = threading.Condition()
+        self.idle = deque()  # (connection, 放回的时间)
+
+    def _new_connection(self):
+        cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=config.HTTP_TIMEOUT)
+
+    def reserve(self, count):
+        """增加count个可以同时使用的连接，用完后调用`unreserve(count)`"""
+        with self.condition:
+            self.size += count
+            self.condition.notify_all()
+
+    def unreserve(self, count):
+        with self.condition:
+            self.size -= count
+            while len(self.idle) > self.size:
+                self.idle.popleft()[0].close()
+
+    def acquire(self):
+        """取出一个连接，返回(connection, 是否是复用的连接)"""
+        now = time.time()
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.in_use < self.size, timeout=config.HTTP_TIMEOUT):
+                raise http.client.HTTPException('connection pool of %s is exhausted' % self.host)
+            self.in_use += 1
+            while self.idle:
+                conn, released_at = self.idle.pop()
+                if now - released_at < config.HTTP_IDLE_TIMEOUT:
+                    return conn, True
+                conn.close()
+        return self._new_connection(), False
+
+    def release(self, conn, reusable=True):
+        with self.condition:
+            if reusable:
+                self.idle.append((conn, time.time()))
+                while len(self.idle) > self.size:
+                    self.idle.popleft()[0].close()
+            else:
+                conn.close()
+            self.in_use -= 1
+            self.condition.notify()
+
+    def pre_open(self, count):
+        """预先建立连接，使之后的请求不用再等待TCP握手"""
+        count = min(count, self.size)
+        conns = []
+        for i in range(count):
+            conn = self._new_connection()
+            conn.connect()
+            conns.append(conn)
+        now = time.time()
+        with self.condition:
+            self.idle.extend((conn, now) for conn in conns)
+            while len(self.idle) > self.size:
+                self.idle.popleft()[0].close()
+
+
+class HttpClient(object):
+    """访问“易约”的共享HTTP客户端，线程安全
+
+    每个host一个大小为`config.HTTP_POOL_SIZE`的keep-alive连接池；
+    预约任务的cookie按用户名分开保存，同一用户同时执行的任务共用一个CookieJar（登录会话），
+    没有任务在使用时删除，见`acquire_cookie_jar`
+
+    单例
+    """
+    _instance = None
+    _new_lock = threading.Lock()
+    redirect_codes = (301, 302, 303, 307, 308)
+    max_redirects = 10
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            # 可能在多个预约线程中同时第一次使用，初始化完成后才让其他线程看到
+            with cls._new_lock:
+                if cls._instance is None:
+                    instance = object.__new__(cls)
+                    instance.lock = threading.Lock()
+                    instance.pools = {}
+                    instance.jars = {}
+                    cls._instance = instance
+        return cls._instance
+
+    def acquire_cookie_jar(self, username):
+        """执行预约任务时使用的用户的CookieJar，不存在则新建；与`release_cookie_jar`成对调用"""
+        with self.lock:
+            entry = self.jars.get(username)
+            if entry is None:
+                entry = self.jars[username] = [CookieJar(), 0]  # [CookieJar, 正在使用的任务数]
+            entry[1] += 1
+            return entry[0]
+
+    def release_cookie_jar(self, username):
+        """任务不再使用用户的CookieJar，该用户没有正在执行的任务时删除"""
+        with self.lock:
+            entry = self.jars.get(username)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.jars[username]
+
+    def _pool(self, url):
+        parts = urlsplit(url)
+        default_port = 443 if parts.scheme == 'https' else 80
+        key = (parts.scheme, parts.hostname, parts.port or default_port)
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = self.pools[key] = _HostPool(*key, size=config.HTTP_POOL_SIZE)
+            return pool
+
+    def pre_open(self, url, count=1):
+        """在已知的请求高峰前预先建立到url所在host的连接
+
+        :param str url: 将要请求的地址
+        :param int count: 连接数，不超过连接池大小
+        """
+        self._pool(url).pre_open(count)
+
+    def reserve(self, url, count):
+        """临时增加到url所在host可以同时使用的连接数，如批处理同时发出的预约请求数，用完后调用`unreserve`"""
+        self._pool(url).reserve(count)
+
+    def unreserve(self, url, count):
+        self._pool(url).unreserve(count)
+
+    def prepare(self, url, data=None, cookie_jar=None, method=None):
+        """提前构造请求（编码、cookie头等），发送时不再做这些工作
+
+        cookie在构造时确定，cookie变化（如重新登录）后需要重新构造
+
+        :return: PreparedRequest
+        """
+        method = method or ('GET' if data is None else 'POST')
+        return PreparedRequest(method, url, data, cookie_jar)
+
+    def _send(self, prepared, cookie_jar, on_sent=None):
+        """发送一次请求，不跟随重定向，返回(status, reason, headers, body)
+
+        :param on_sent: 可选，请求写入连接（且这个连接返回了响应）后调用，参数为写入完成的时间（datetime）
+        """
+        pool = self._pool(prepared.url)
+        conn, reused = pool.acquire()
+        try:
+            try:
+                conn.request(prepared.method, prepared.path, prepared.body, prepared.headers)
+                sent_at = datetime.datetime.now()
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                if not reused:
+                    raise
+                # 复用的连接已被服务器关闭，换一个新连接重试一次
+                conn.close()
+                conn = pool._new_connection()
+                conn.request(prepared.method, prepared.path, prepared.body, prepared.headers)
+                sent_at = datetime.datetime.now()
+                response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            pool.release(conn, reusable=False)
+            raise
+        pool.release(conn, reusable=not response.will_close)
+        if on_sent is not None:
+            on_sent(sent_at)
+
+        if cookie_jar is not None:
+            cookie_jar.extract_cookies(response, prepared.request)
+        return response.status, response.reason, response.headers, data
+
+    def open(self, url, data=None, cookie_jar=None, method=None):
+        """发送请求并跟随重定向，和urllib的opener.open相同，4xx/5xx时抛出HTTPError
+
+        :param str url: 请求地址
+        :param bytes data: POST的数据，None时为GET请求
+        :param http.cookiejar.CookieJar cookie_jar: 使用的cookie
+        :param str method: 请求方法，默认根据data决定GET或POST
+        :return: Response
+        """
+        return self.open_prepared(self.prepare(url, data, cookie_jar, method), cookie_jar)
+
+    def open_prepared(self, prepared, cookie_jar=None, on_sent=None):
+        """发送`prepare`构造好的请求，其余与`open`相同
+
+        :param on_sent: 可选，第一个请求（不含重定向）写入连接后调用，见`_send`
+        """
+        for i in range(self.max_redirects + 1):
+            status, reason, headers, body = self._send(prepared, cookie_jar, on_sent if i == 0 else None)
+            response = handle_response(prepared, status, reason, headers, body, cookie_jar)
+            if isinstance(response, Response):
+                return response
+            prepared = response
+        raise HTTPError(prepared.url, status, 'too many redirects', headers, io.BytesIO(body))
+
+
+def handle_response(prepared, status, reason, headers, body, cookie_jar=None):
+    """处理一次请求的结果：重定向时返回要跟随的PreparedRequest，4xx/5xx时抛出HTTPError，否则返回Response
+
+    同步和异步的客户端共用
+    """
+    if status in HttpClient.redirect_codes and headers.get('Location'):
+        url = urljoin(prepared.url, headers['Location'])
+        method, data = prepared.method, prepared.body
+        if status not in (307, 308):
+            method, data = ('HEAD' if method == 'HEAD' else 'GET'), None
+        return PreparedRequest(method, url, data, cookie_jar)
+    if status >= 400:
+        raise HTTPError(prepared.url, status, reason, headers, io.BytesIO(body))
+    return Response(prepared.url, status, reason, headers, body)
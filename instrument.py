@@ -18,16 +18,38 @@ class Instrument(object):
                 周一为0，周二为1，周日为6（与datetime.weekday相同）
 
             datetime.time reserve_time: 仪器预约时间，开始预约该仪器的时间
+
+            dict burst: 开始预约时并发提交的设置（count, spacing, window），None表示不并发，
+                count为0时也不并发；设置不正确时抛出InstrumentException
         """
         # just for IDE can find attributes
-        name = cn_name = instrument_id = reserve_weekday = reserve_time = None
+        name = cn_name = instrument_id = reserve_weekday = reserve_time = burst = None
 
-        def __init__(self, name, cn_name, instrument_id, reserve_weekday, reserve_time):
+        def __init__(self, name, cn_name, instrument_id, reserve_weekday, reserve_time, burst=None):
             super().__setattr__('name', name)
             super().__setattr__('cn_name', cn_name)
             super().__setattr__('instrument_id', instrument_id)
             super().__setattr__('reserve_weekday', reserve_weekday)
             super().__setattr__('reserve_time', reserve_time)
+            super().__setattr__('burst', self._check_burst(name, burst))
+
+        @staticmethod
+        def _check_burst(name, burst):
+            """检查burst设置，返回使用的设置：count为整数且不小于0，spacing, window为不小于0的数"""
+            if burst is None:
+                return None
+            if not isinstance(burst, dict):
+                raise InstrumentException("invalid burst of '%s': should be a dict" % name)
+            try:
+                count, spacing, window = burst['count'], burst['spacing'], burst['window']
+            except KeyError as e:
+                raise InstrumentException("invalid burst of '%s': missing %s" % (name, e))
+            if not isinstance(count, int) or count < 0:
+                raise InstrumentException("invalid burst of '%s': count should be an integer >= 0" % name)
+            for key, value in (('spacing', spacing), ('window', window)):
+                if not isinstance(value, (int, float)) or value < 0:
+                    raise InstrumentException("invalid burst of '%s': %s should be a number >= 0" % (name, key))
+            return dict(burst) if count else None
 
         def __setattr__(self, key, value):
             raise AttributeError("can't set attribute to a OneInstrument instance after initial")
@@ -0,0 +1,121 @@
+import threading
+from bisect import bisect_left, bisect_right
+
+
+def minutes_of(hh_mm):
+    """'9:30' -> 570，格式不正确时返回None"""
+    try:
+        hour, minute = hh_mm.strip().split(':')
+        return int(hour) * 60 + int(minute)
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_minutes(minutes):
+    return '%d:%02d' % (minutes // 60, minutes % 60)
+
+
+class _Slot(object):
+    """一个(仪器id, 实验日期)下的所有时间段
+
+    intervals按开始时间排序，max_ends[i]是intervals[0..i]中最大的结束时间（不减），
+    查询与[start, end)重叠的时间段时：开始时间 < end 的是intervals的前缀（二分），
+    其中结束时间 > start 的只可能在max_ends第一次超过start之后（再二分），只需扫描这一段
+    """
+    __slots__ = ('intervals', 'max_ends')
+
+    def __init__(self):
+        self.intervals = []  # [(开始分钟, 结束分钟, job_id, 第几个时间段)]
+        self.max_ends = []
+
+    def add(self, interval):
+        i = bisect_left(self.intervals, interval)
+        self.intervals.insert(i, interval)
+        end = interval[1]
+        self.max_ends.insert(i, max(self.max_ends[i - 1], end) if i else end)
+        # 之后的max_ends只有小于end的要变成end，max_ends不减，遇到不小于end的就可以停止
+        j = i + 1
+        while j < len(self.max_ends) and self.max_ends[j] < end:
+            self.max_ends[j] = end
+            j += 1
+
+    def remove(self, interval):
+        i = bisect_left(self.intervals, interval)
+        if i == len(self.intervals) or self.intervals[i] != interval:
+            return
+        del self.intervals[i]
+        del self.max_ends[i]
+        # 重新计算之后的max_ends，某一项没有变化时之后的也不会变化
+        current = self.max_ends[i - 1] if i else -1
+        for j in range(i, len(self.intervals)):
+            current = max(current, self.intervals[j][1])
+            if current == self.max_ends[j]:
+                break
+            self.max_ends[j] = current
+
+    def overlapping(self, start, end):
+        stop = bisect_left(self.intervals, (end,))
+        first = bisect_right(self.max_ends, start, 0, stop)
+        return [interval for interval in self.intervals[first:stop] if interval[1] > start]
+
+
+class IntervalIndex(object):
+    """未执行的预约任务的实验时间段，按(仪器id, 实验日期)分组，用于发现我们自己的任务之间的冲突
+
+    SchedulerHandler启动时根据jobstore建立，任务添加、删除、执行时随索引一起维护
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.slots = {}  # (instrument_id, reserveDate) -> _Slot
+        self.job_intervals = {}  # job_id -> [((instrument_id, reserveDate), (开始分钟, 结束分钟, job_id, 第几个时间段))]
+
+    def add(self, job_id, windows):
+        """设定任务的所有时间段，替换之前的
+
+        :param list windows: [(slot, start_time, end_time)]，第0个是主时间段，之后依次是备选时间段；
+                             slot是(instrument_id, reserveDate)，时间是'9:00'的格式
+        """
+        with self.lock:
+            self.remove(job_id)
+            entries = []
+            for window, (slot, start_time, end_time) in enumerate(windows):
+                start, end = minutes_of(start_time), minutes_of(end_time)
+                if start is None or end is None or start >= end:
+                    continue
+                interval = (start, end, job_id, window)
+                self.slots.setdefault(slot, _Slot()).add(interval)
+                entries.append((slot, interval))
+            if entries:
+                self.job_intervals[job_id] = entries
+
+    def remove(self, job_id):
+        with self.lock:
+            for slot, interval in self.job_intervals.pop(job_id, ()):
+                self.slots[slot].remove(interval)
+                if not self.slots[slot].intervals:
+                    del self.slots[slot]
+
+    def clear(self):
+        with self.lock:
+            self.slots.clear()
+            self.job_intervals.clear()
+
+    def overlapping(self, slot, start_time, end_time):
+        """与[start_time, end_time)重叠的任务时间段
+
+        :return: list of (开始分钟, 结束分钟, job_id, 第几个时间段)，按开始时间排序；时间格式不正确时为空
+                 同一任务的多个时间段都重叠时各占一项
+        """
+        start, end = minutes_of(start_time), minutes_of(end_time)
+        if start is None or end is None:
+            return []
+        with self.lock:
+            index = self.slots.get(slot)
+            return index.overlapping(start, end) if index is not None else []
+
+    def intervals(self, slot):
+        """某(仪器id, 实验日期)的所有任务时间段，list of (开始分钟, 结束分钟, job_id, 第几个时间段)"""
+        with self.lock:
+            index = self.slots.get(slot)
+            return list(index.intervals) if index is not None else []
@@ -0,0 +1,60 @@
+import json
+
+from instrument import Instrument
+from jobstore import experiment_date_of
+from errors import InstrumentException
+
+
+class JobSummary(object):
+    """/api/scheduled_jobs返回的一个任务的信息
+
+    设置任务时（ReserveTem.set_job）生成一次，由SchedulerHandler按任务id缓存，
+    任务被删除或执行后随之删除；字段在生成时就格式化好，JSON也只序列化一次，
+    列表响应直接拼接各任务的JSON
+    """
+    __slots__ = ('job_id', 'fields', 'json')
+
+    def __init__(self, job_id, username, reserve_data, trigger_time, alternatives=None):
+        """
+        :param str job_id: 任务id
+        :param str username: 用户名
+        :param dict reserve_data: 预约POST请求提交的数据
+        :param datetime.datetime trigger_time: 开始预约的时间
+        :param list alternatives: 备选的预约数据
+        """
+        self.job_id = job_id
+        self.fields = dict(
+            id=job_id,
+            username=username,
+            trigger_time=trigger_time.strftime('%Y-%m-%d %H:%M:%S') if trigger_time else None,
+            **_slot_fields(reserve_data),
+            ReserveReport=reserve_data.get('ReserveReport'),
+            alternatives=[_slot_fields(alternative) for alternative in alternatives or []]
+        )
+        self.json = json.dumps(self.fields)
+
+    @classmethod
+    def from_kwargs(cls, job_id, kwargs, trigger_time):
+        """根据keep_reserve_job的kwargs生成"""
+        return cls(job_id, kwargs.get('username'), kwargs.get('reserve_data') or {}, trigger_time,
+                   kwargs.get('alternatives'))
+
+
+def _slot_fields(reserve_data):
+    """预约数据中列出任务时显示的字段：实验日期、时间段和仪器（中文名）"""
+    instrument_id = reserve_data.get('instrumentId')
+    try:
+        instrument = Instrument.get(instrument_id=instrument_id).cn_name
+    except InstrumentException:
+        instrument = instrument_id
+    return dict(
+        reserve_date=experiment_date_of(reserve_data.get('reserveDate')),
+        reserveStartTime=reserve_data.get('reserveStartTime'),
+        reserveEndTime=reserve_data.get('reserveEndTime'),
+        instrument=instrument
+    )
+
+
+def join(summaries):
+    """把多个JobSummary拼接成JSON数组"""
+    return '[%s]' % ', '.join(summary.json for summary in summaries)
@@ -0,0 +1,399 @@
+import time
+import json
+import pickle
+import sqlite3
+import datetime
+import threading
+from contextlib import contextmanager
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS reserve_jobs (
+        id TEXT PRIMARY KEY,
+        next_run_time REAL,
+        username TEXT,
+        instrument_id TEXT,
+        experiment_date TEXT,
+        trigger_time TEXT,
+        kwargs TEXT,
+        job_state BLOB NOT NULL,
+        claimed_at REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS ix_reserve_jobs_next_run_time ON reserve_jobs (next_run_time)',
+    'CREATE INDEX IF NOT EXISTS ix_reserve_jobs_username ON reserve_jobs (username)',
+    'CREATE INDEX IF NOT EXISTS ix_reserve_jobs_slot ON reserve_jobs (instrument_id, experiment_date)',
+    'CREATE INDEX IF NOT EXISTS ix_reserve_jobs_trigger_time ON reserve_jobs (trigger_time)',
+]
+_COLUMNS = 'id, next_run_time, username, instrument_id, experiment_date, trigger_time, kwargs, job_state'
+# 旧版本使用的SQLAlchemyJobStore的表，启动时迁移到reserve_jobs
+_LEGACY_TABLE = 'apscheduler_jobs'
+
+# 任务的排序，暂停的任务（next_run_time为NULL）排在最后
+_ORDER_KEY = 'IFNULL(next_run_time, 1e300)'
+
+RESERVE_DATE_FORMAT = '%Y年%m月%d日'
+
+
+def sqlite_path(url):
+    """'sqlite:///jobs.sqlite' -> 'jobs.sqlite'，'sqlite://' -> ':memory:'"""
+    if not url.startswith('sqlite://'):
+        raise ValueError('only sqlite urls are supported: %s' % url)
+    return url[len('sqlite:///'):] or ':memory:'
+
+
+def experiment_date_of(reserve_date):
+    """'%Y年%m月%d日'格式的实验日期转换为'%Y-%m-%d'，无法解析时返回None"""
+    try:
+        return datetime.datetime.strptime(reserve_date, RESERVE_DATE_FORMAT).strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+class ReserveJobStore(BaseJobStore):
+    """预约任务的jobstore，直接使用sqlite
+
+    - WAL模式，Flask的请求线程读取时不会被scheduler的写入阻塞；
+      连接放在一个有上限的连接池中，各线程借用，用完归还，不随请求线程增加
+    - 用户名、仪器id、实验日期（'%Y-%m-%d'）、开始预约时间是单独的列，都有索引，
+      按这些条件查询时只读取列，不用反序列化任务
+    - 任务的kwargs（预约信息）保存为JSON，其余的状态（触发器等）pickle后保存，
+      kwargs无法保存为JSON时整个状态pickle
+    - 批处理执行的任务先认领（claimed_at），不再由scheduler单独触发，执行完再删除，
+      进程在这之间退出时重启后还能找到它们，见`claim_jobs`
+    - 启动时把旧版本SQLAlchemyJobStore的任务迁移过来
+
+    :param str url: 'sqlite:///文件路径'，'sqlite://'为内存数据库（只用于测试）
+    :param int pool_size: 最多同时打开的连接数
+    """
+
+    def __init__(self, url, pool_size=4, pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        super().__init__()
+        self.path = sqlite_path(url)
+        self.pickle_protocol = pickle_protocol
+        # 内存数据库只能有一个连接，所有线程共用
+        self._memory = self.path == ':memory:'
+        self._pool_size = 1 if self._memory else max(pool_size, 1)
+        self._pool_slots = threading.BoundedSemaphore(self._pool_size)
+        self._pool_lock = threading.Lock()
+        self._idle = []  # 空闲的连接
+        self._local = threading.local()  # 当前线程借用的连接，同一线程嵌套使用时不再借
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        if not self._memory:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @contextmanager
+    def _connection(self):
+        """从连接池借一个连接，连接都在使用中时等待"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            yield connection
+            return
+        self._pool_slots.acquire()
+        try:
+            with self._pool_lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                connection = self._connect()
+            self._local.connection = connection
+            try:
+                yield connection
+            finally:
+                self._local.connection = None
+                with self._pool_lock:
+                    self._idle.append(connection)
+        finally:
+            self._pool_slots.release()
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        with self._connection() as connection:
+            with connection:
+                for statement in _SCHEMA:
+                    connection.execute(statement)
+                columns = [row[1] for row in connection.execute('PRAGMA table_info(reserve_jobs)')]
+                if 'claimed_at' not in columns:
+                    # 没有认领功能的版本建的表
+                    connection.execute('ALTER TABLE reserve_jobs ADD COLUMN claimed_at REAL')
+        self._migrate_legacy()
+
+    def _migrate_legacy(self):
+        with self._connection() as connection:
+            exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+                                        (_LEGACY_TABLE,)).fetchone()
+            if not exists:
+                return
+            rows = connection.execute('SELECT id, job_state FROM %s' % _LEGACY_TABLE).fetchall()
+            jobs = []
+            for job_id, job_state in rows:
+                try:
+                    jobs.append(self._reconstitute_job(pickle.loads(job_state)))
+                except BaseException:
+                    self._logger.exception('Unable to migrate job "%s" -- skipping it', job_id)
+            with connection:
+                connection.executemany('INSERT OR IGNORE INTO reserve_jobs (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                                       % _COLUMNS, [self._row(job) for job in jobs])
+                connection.execute('DROP TABLE %s' % _LEGACY_TABLE)
+        self._logger.info('migrated %d jobs from %s', len(jobs), _LEGACY_TABLE)
+
+    def shutdown(self):
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _row(self, job):
+        state = job.__getstate__()
+        kwargs = dict(state['kwargs'])
+        trigger_time = kwargs.pop('trigger_time', None)
+        if trigger_time is not None and not isinstance(trigger_time, datetime.datetime):
+            kwargs_json = None
+        else:
+            try:
+                kwargs_json = json.dumps(kwargs, ensure_ascii=False, separators=(',', ':'))
+            except (TypeError, ValueError):
+                kwargs_json = None
+        if kwargs_json is not None:
+            # kwargs单独保存，不再pickle
+            state['kwargs'] = {}
+        if not isinstance(trigger_time, datetime.datetime):
+            trigger_time = None
+        reserve_data = kwargs.get('reserve_data')
+        if not isinstance(reserve_data, dict):
+            reserve_data = {}
+        return (
+            job.id,
+            datetime_to_utc_timestamp(job.next_run_time),
+            kwargs.get('username'),
+            reserve_data.get('instrumentId'),
+            experiment_date_of(reserve_data.get('reserveDate')),
+            trigger_time.isoformat(sep=' ') if trigger_time is not None else None,
+            kwargs_json,
+            pickle.dumps(state, self.pickle_protocol)
+        )
+
+    def _reconstitute_job(self, state):
+        job = Job.__new__(Job)
+        job.__setstate__(state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _job_from_row(self, trigger_time, kwargs_json, job_state):
+        state = pickle.loads(job_state)
+        if kwargs_json is not None:
+            state['kwargs'] = json.loads(kwargs_json)
+            if trigger_time is not None:
+                state['kwargs']['trigger_time'] = datetime.datetime.fromisoformat(trigger_time)
+        return self._reconstitute_job(state)
+
+    def _get_jobs(self, where='', params=()):
+        jobs = []
+        failed_job_ids = []
+        with self._connection() as connection:
+            sql = ('SELECT id, trigger_time, kwargs, job_state FROM reserve_jobs %s ORDER BY %s, id'
+                   % (where, _ORDER_KEY))
+            rows = connection.execute(sql, params).fetchall()
+            for job_id, trigger_time, kwargs_json, job_state in rows:
+                try:
+                    jobs.append(self._job_from_row(trigger_time, kwargs_json, job_state))
+                except BaseException:
+                    self._logger.exception('Unable to restore job "%s" -- removing it', job_id)
+                    failed_job_ids.append(job_id)
+            if failed_job_ids:
+                with connection:
+                    connection.executemany('DELETE FROM reserve_jobs WHERE id = ?',
+                                           [(job_id,) for job_id in failed_job_ids])
+        return jobs
+
+    def lookup_job(self, job_id):
+        jobs = self._get_jobs('WHERE id = ?', (job_id,))
+        return jobs[0] if jobs else None
+
+    def lookup_jobs(self, job_ids):
+        """按id一次读取多个任务，不存在的id忽略"""
+        job_ids = list(job_ids)
+        jobs = []
+        # sqlite一条语句的参数个数有限制
+        for i in range(0, len(job_ids), 500):
+            chunk = job_ids[i:i + 500]
+            jobs.extend(self._get_jobs('WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk))
+        return jobs
+
+    def get_due_jobs(self, now):
+        """到了触发时间的任务，已认领的任务由批处理执行，不包括在内"""
+        return self._get_jobs('WHERE next_run_time <= ? AND claimed_at IS NULL', (datetime_to_utc_timestamp(now),))
+
+    def get_next_run_time(self):
+        with self._connection() as connection:
+            row = connection.execute('SELECT MIN(next_run_time) FROM reserve_jobs '
+                                     'WHERE next_run_time IS NOT NULL AND claimed_at IS NULL').fetchone()
+        return utc_timestamp_to_datetime(row[0]) if row and row[0] is not None else None
+
+    def claim_jobs(self, job_ids):
+        """认领任务：标记为已认领，之后scheduler不再单独触发（`get_due_jobs`不返回），
+        任务仍留在jobstore中，执行完后由认领者删除
+
+        :param job_ids: 要认领的job id
+        :return: 认领到的job id的列表，已被认领或不存在的任务不包括在内
+        """
+        claimed_at = time.time()
+        claimed = []
+        with self._connection() as connection:
+            with connection:
+                for job_id in job_ids:
+                    cursor = connection.execute('UPDATE reserve_jobs SET claimed_at = ? '
+                                                'WHERE id = ? AND claimed_at IS NULL', (claimed_at, job_id))
+                    if cursor.rowcount:
+                        claimed.append(job_id)
+        return claimed
+
+    def get_claimed_jobs(self):
+        """已认领但还没有执行完（删除）的任务"""
+        return self._get_jobs('WHERE claimed_at IS NOT NULL')
+
+    def get_all_jobs(self):
+        return self._get_jobs()
+
+    def get_index_rows(self, next_run_before=None):
+        """所有任务的索引列，不反序列化任务
+
+        :param datetime.datetime next_run_before: 只读取在此之前（包含）触发的任务，None表示全部
+        :return: list of (job_id, username, instrument_id, experiment_date, trigger_time)，
+                experiment_date为'%Y-%m-%d'，trigger_time为datetime
+        """
+        sql = 'SELECT id, username, instrument_id, experiment_date, trigger_time FROM reserve_jobs'
+        params = ()
+        if next_run_before is not None:
+            sql += ' WHERE next_run_time <= ?'
+            params = (datetime_to_utc_timestamp(next_run_before),)
+        with self._connection() as connection:
+            rows = connection.execute(sql, params).fetchall()
+        return [(job_id, username, instrument_id, experiment_date,
+                 datetime.datetime.fromisoformat(trigger_time) if trigger_time else None)
+                for job_id, username, instrument_id, experiment_date, trigger_time in rows]
+
+    def query_job_ids(self, username=None, instrument_id=None, date_from=None, date_to=None,
+                      trigger_from=None, trigger_to=None, after=None, limit=None):
+        """按索引列筛选任务，按(next_run_time, id)排序，只读取列，不反序列化任务
+
+        :param str username: 用户名，None表示所有用户
+        :param str instrument_id: 仪器id
+        :param datetime.date date_from: 实验日期的范围（包含两端）
+        :param datetime.date date_to:
+        :param datetime.datetime trigger_from: 开始预约时间的范围（包含两端）
+        :param datetime.datetime trigger_to:
+        :param tuple after: 游标，只返回排在它之后的任务
+        :param int limit: 最多返回的任务数
+        :return: list of (job_id, 游标)
+        """
+        conditions, params = [], []
+        for column, op, value in (('username', '=', username),
+                                  ('instrument_id', '=', instrument_id),
+                                  ('experiment_date', '>=', date_from and date_from.isoformat()),
+                                  ('experiment_date', '<=', date_to and date_to.isoformat()),
+                                  ('trigger_time', '>=', trigger_from and trigger_from.isoformat(sep=' ')),
+                                  ('trigger_time', '<=', trigger_to and trigger_to.isoformat(sep=' '))):
+            if value is not None:
+                conditions.append('%s %s ?' % (column, op))
+                params.append(value)
+        if after is not None:
+            conditions.append('(%s > ? OR (%s = ? AND id > ?))' % (_ORDER_KEY, _ORDER_KEY))
+            params.extend([after[0], after[0], after[1]])
+        sql = 'SELECT id, %s FROM reserve_jobs' % _ORDER_KEY
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY %s, id' % _ORDER_KEY
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        with self._connection() as connection:
+            rows = connection.execute(sql, params).fetchall()
+        return [(job_id, (order_key, job_id)) for job_id, order_key in rows]
+
+    def get_summary_rows(self, job_ids=None):
+        """任务的kwargs和开始预约时间，用于生成JobSummary，kwargs保存为JSON的任务不用反序列化
+
+        :param job_ids: 只读取这些任务，None表示全部
+        :return: list of (job_id, kwargs, 开始预约时间)，
+                旧任务没有开始预约时间，用触发时间代替
+        """
+        with self._connection() as connection:
+            if job_ids is None:
+                rows = connection.execute('SELECT id, next_run_time, trigger_time, kwargs FROM reserve_jobs').fetchall()
+            else:
+                job_ids = list(job_ids)
+                rows = []
+                for i in range(0, len(job_ids), 500):
+                    chunk = job_ids[i:i + 500]
+                    rows.extend(connection.execute(
+                        'SELECT id, next_run_time, trigger_time, kwargs FROM reserve_jobs WHERE id IN (%s)'
+                        % ','.join('?' * len(chunk)), chunk).fetchall())
+        result = []
+        for job_id, next_run_time, trigger_time, kwargs_json in rows:
+            if kwargs_json is None:
+                job = self.lookup_job(job_id)
+                if job is None:
+                    continue
+                kwargs = job.kwargs
+            else:
+                kwargs = json.loads(kwargs_json)
+            if trigger_time is not None:
+                trigger_time = datetime.datetime.fromisoformat(trigger_time)
+            else:
+                trigger_time = kwargs.get('trigger_time') or (
+                    datetime.datetime.fromtimestamp(next_run_time) if next_run_time is not None else None)
+            result.append((job_id, kwargs, trigger_time))
+        return result
+
+    def add_job(self, job):
+        self.add_jobs([job])
+
+    def add_jobs(self, jobs):
+        """在一个事务中添加多个任务，任一id冲突时全部回滚；写入后任务属于这个jobstore，与读出的任务相同
+
+        :param list jobs: apscheduler.job.Job的列表
+        """
+        rows = [self._row(job) for job in jobs]
+        if not rows:
+            return
+        with self._connection() as connection:
+            try:
+                with connection:
+                    connection.executemany('INSERT INTO reserve_jobs (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                                           % _COLUMNS, rows)
+            except sqlite3.IntegrityError:
+                raise ConflictingIdError(', '.join(job.id for job in jobs))
+        for job in jobs:
+            job._jobstore_alias = self._alias
+
+    def update_job(self, job):
+        row = self._row(job)
+        with self._connection() as connection:
+            with connection:
+                cursor = connection.execute(
+                    'UPDATE reserve_jobs SET next_run_time = ?, username = ?, instrument_id = ?, '
+                    'experiment_date = ?, trigger_time = ?, kwargs = ?, job_state = ? WHERE id = ?',
+                    row[1:] + row[:1])
+        if cursor.rowcount == 0:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        with self._connection() as connection:
+            with connection:
+                cursor = connection.execute('DELETE FROM reserve_jobs WHERE id = ?', (job_id,))
+        if cursor.rowcount == 0:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        with self._connection() as connection:
+            with connection:
+                connection.execute('DELETE FROM reserve_jobs')
+
+    def __repr__(self):
+        return '<%s (path=%s)>' % (self.__class__.__name__, self.path)
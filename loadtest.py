@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""api的压力测试
+
+模拟开放预约前的请求高峰：多个客户端同时按比例调用/api/reserve, /api/scheduled_jobs, /api/login_test，
+“易约”换成本地模拟的服务器（fake_upstream.py），jobstore为临时的sqlite文件；
+客户端数从1开始加倍到--clients（或按--levels），每一级运行--duration秒，统计每个接口：
+    throughput: 每秒完成的请求数
+    p50/p95/p99: 延迟（毫秒）
+    errors: HTTP状态不是200/304，或返回的code不是0的请求数
+结果追加保存到--output文件（JSON lines），并和上一次相同参数的结果比较
+
+--target inprocess: 每个客户端一个Flask test_client，不经过网络
+--target local: 在localhost启动多线程的开发服务器（与main.py相同），客户端通过HTTP请求
+
+用法：python3 loadtest.py --clients 32 --duration 10 --mix reserve=3,scheduled_jobs=5,login_test=2
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+import http.client
+from collections import defaultdict
+from urllib.parse import urlencode
+
+# benchmark切换到production配置，并提供统计、保存结果用的函数
+from benchmark import percentile, git_revision, load_previous
+from config import config
+
+from fake_upstream import FakeUpstream
+from instrument import Instrument
+
+ENDPOINTS = ('reserve', 'scheduled_jobs', 'login_test')
+
+
+def parse_mix(text):
+    """'reserve=3,scheduled_jobs=5,login_test=2' -> {endpoint: 权重}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ENDPOINTS:
+            raise argparse.ArgumentTypeError('unknown endpoint: %s' % name)
+        mix[name.strip()] = float(weight or 1)
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError('mix has no positive weight')
+    return mix
+
+
+def client_levels(clients, levels=None):
+    """各级的客户端数：1, 2, 4, ...直到clients（包含）"""
+    if levels:
+        return [int(level) for level in levels.split(',')]
+    result = [1]
+    while result[-1] * 2 < clients:
+        result.append(result[-1] * 2)
+    if result[-1] != clients:
+        result.append(clients)
+    return result
+
+
+class InProcessSession(object):
+    """通过Flask test_client请求，每个客户端一个"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, fields, headers=None):
+        """:return: (HTTP状态, body, 响应头)"""
+        if method == 'GET':
+            response = self.client.get(path, query_string=fields, headers=headers)
+        else:
+            response = self.client.post(path, data=fields, headers=headers)
+        return response.status_code, response.get_data(), response.headers
+
+
+class HttpSession(object):
+    """通过HTTP请求本地的服务器，开发服务器每个请求后关闭连接，每次新建连接"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def request(self, method, path, fields, headers=None):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            headers = dict(headers or {})
+            body = None
+            if method == 'GET':
+                path += '?' + urlencode(fields)
+            else:
+                body = urlencode(fields)
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            return response.status, response.read(), response.headers
+        finally:
+            connection.close()
+
+
+def start_local_server(app):
+    """在后台线程中启动多线程的开发服务器，返回(server, host, port)"""
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='loadtest-server', daemon=True).start()
+    return server, '127.0.0.1', server.server_port
+
+
+class Client(object):
+    """一个客户端：按权重随机选择接口，请求完成后立即发出下一个请求（闭环）"""
+
+    def __init__(self, no, session, mix, users, cold_login_rate, instruments):
+        self.no = no
+        self.session = session
+        self.endpoints = list(mix)
+        self.weights = [mix[endpoint] for endpoint in self.endpoints]
+        self.users = users
+        self.cold_login_rate = cold_login_rate
+        self.instruments = instruments
+        self.random = random.Random(no)
+        self.etags = {}  # username -> 上一次/api/scheduled_jobs的ETag，像浏览器一样带上If-None-Match
+        self.cold_logins = 0
+        self.samples = []  # (endpoint, 延迟秒数, 是否成功)
+
+    def _reserve(self, username):
+        # 实验日期在14天以后，开始预约时间一定还没到，任务不会在测试中执行
+        day = datetime.date.today() + datetime.timedelta(days=self.random.randint(14, 60))
+        start = self.random.choice((8, 9, 10, 13, 14, 15))
+        return self.session.request('POST', '/api/reserve', dict(
+            username=username, password='password', instrument=self.random.choice(self.instruments),
+            reserve_date=day.isoformat(), start_time='%d:00' % start, end_time='%d:00' % (start + 2),
+            report='loadtest'))
+
+    def _scheduled_jobs(self, username):
+        headers = {'If-None-Match': self.etags[username]} if username in self.etags else None
+        status, body, response_headers = self.session.request(
+            'GET', '/api/scheduled_jobs', dict(username=username, password='password'), headers)
+        if response_headers.get('ETag'):
+            self.etags[username] = response_headers['ETag']
+        return status, body, response_headers
+
+    def _login_test(self, username):
+        if self.random.random() < self.cold_login_rate:
+            # 没有缓存的帐号，需要登录模拟服务器
+            self.cold_logins += 1
+            username = 'cold%d_%d_%d' % (self.no, self.cold_logins, int(time.time()))
+        return self.session.request('GET', '/api/login_test', dict(username=username, password='password'))
+
+    def request_once(self):
+        endpoint = self.random.choices(self.endpoints, self.weights)[0]
+        username = self.random.choice(self.users)
+        start = time.perf_counter()
+        try:
+            status, body, _ = getattr(self, '_' + endpoint)(username)
+            ok = status == 304 or (status == 200 and json.loads(body).get('code') == 0)
+        except Exception as e:
+            logging.warning('%s request failed: %s' % (endpoint, e))
+            ok = False
+        self.samples.append((endpoint, time.perf_counter() - start, ok))
+
+    def run(self, deadline):
+        while time.perf_counter() < deadline:
+            self.request_once()
+
+
+def summarize(samples, elapsed):
+    """按接口统计一级的结果，'all'为所有接口合计"""
+    groups = defaultdict(list)
+    for endpoint, seconds, ok in samples:
+        groups[endpoint].append((seconds, ok))
+        groups['all'].append((seconds, ok))
+    summary = {}
+    for endpoint, items in sorted(groups.items()):
+        latencies = [seconds * 1000 for seconds, ok in items]
+        summary[endpoint] = dict(
+            requests=len(items),
+            errors=sum(1 for seconds, ok in items if not ok),
+            throughput=len(items) / elapsed,
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            p99=percentile(latencies, 99),
+        )
+    return summary
+
+
+def run_level(clients, make_session, duration, mix, users, cold_login_rate, instruments):
+    """clients个客户端同时运行duration秒"""
+    workers = [Client(no, make_session(), mix, users, cold_login_rate, instruments) for no in range(clients)]
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=worker.run, args=(deadline,), name='loadtest-client-%d' % worker.no)
+               for worker in workers]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return summarize([sample for worker in workers for sample in worker.samples], elapsed)
+
+
+def print_level(clients, summary):
+    print('clients=%d' % clients)
+    for endpoint, stats in summary.items():
+        print('  %-15s %7d req %5d err %9.1f req/s  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms' % (
+            endpoint, stats['requests'], stats['errors'], stats['throughput'], stats['p50'], stats['p95'],
+            stats['p99']))
+
+
+def compare(levels, previous):
+    print('compared with %s (%s):' % (previous['time'], previous.get('revision')))
+    old_levels = dict((level['clients'], level['summary']) for level in previous['levels'])
+    for level in levels:
+        old = old_levels.get(level['clients'], {}).get('all')
+        new = level['summary'].get('all')
+        if not old or not new:
+            continue
+        print('  clients=%-4d throughput %9.1f -> %9.1f req/s (%+.1f%%)  p99 %8.2f -> %8.2fms' % (
+            level['clients'], old['throughput'], new['throughput'],
+            (new['throughput'] / old['throughput'] - 1) * 100 if old['throughput'] else 0, old['p99'], new['p99']))
+
+
+def preload_jobs(count, users, instruments):
+    """预先写入count个任务，让任务列表接近高峰时的规模"""
+    from reserve import ReserveTem
+    from jobstore import RESERVE_DATE_FORMAT
+    rng = random.Random(0)
+    for i, username in enumerate(users):
+        n = count // len(users) + (1 if i < count % len(users) else 0)
+        if not n:
+            continue
+        reservations = []
+        for _ in range(n):
+            day = datetime.date.today() + datetime.timedelta(days=rng.randint(14, 60))
+            instrument = Instrument.get(name=rng.choice(instruments))
+            reserve_data = dict(reserveDate=day.strftime(RESERVE_DATE_FORMAT), reserveStartTime='9:00',
+                                reserveEndTime='11:00', instrumentId=instrument.instrument_id,
+                                ReserveReport='loadtest')
+            reservations.append((reserve_data, datetime.datetime.now() + datetime.timedelta(days=7), None))
+        reserve = ReserveTem()
+        reserve.set_account(username, 'password')
+        reserve.set_jobs(reservations)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='api load test against a local fake upstream')
+    parser.add_argument('--target', default='inprocess', choices=['inprocess', 'local'])
+    parser.add_argument('--clients', type=int, default=16, help='max concurrent clients, levels double from 1')
+    parser.add_argument('--levels', help='explicit client counts, e.g. 1,4,16 (overrides --clients)')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per level')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('reserve=3,scheduled_jobs=5,login_test=2'),
+                        help='endpoint weights')
+    parser.add_argument('--users', type=int, default=50, help='number of distinct accounts')
+    parser.add_argument('--cold-login-rate', type=float, default=0.1,
+                        help='ratio of /api/login_test calls with an uncached account')
+    parser.add_argument('--preload', type=int, default=0, help='jobs written before the first level')
+    parser.add_argument('--latency', type=float, default=0.02, help='upstream latency per request (s)')
+    parser.add_argument('--engine', default=config.ENGINE, choices=['thread', 'asyncio'])
+    parser.add_argument('--output', default='loadtest_results.jsonl')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(filename='log_loadtest.log', level=logging.INFO,
+                        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+    config.ENGINE = args.engine
+    # 真实的sqlite文件（同步写入），而不是内存数据库
+    store_dir = tempfile.mkdtemp(prefix='loadtest-')
+    config.SCHEDULER_STORE_URL = 'sqlite:///' + os.path.join(store_dir, 'jobs.sqlite')
+    fake = FakeUpstream(latency=args.latency)
+    config.UPSTREAM_URL = fake.start()
+
+    from scheduler import SchedulerHandler
+    from flask import Flask
+    from api import api
+    SchedulerHandler().start()
+    app = Flask(__name__)
+    app.register_blueprint(api)
+
+    users = ['load%d' % i for i in range(args.users)]
+    instruments = [instrument.name for instrument in Instrument.instrument_list]
+    if args.preload:
+        preload_jobs(args.preload, users, instruments)
+
+    server = None
+    if args.target == 'local':
+        server, host, port = start_local_server(app)
+        make_session = lambda: HttpSession(host, port)
+    else:
+        make_session = lambda: InProcessSession(app)
+
+    levels = []
+    for clients in client_levels(args.clients, args.levels):
+        summary = run_level(clients, make_session, args.duration, args.mix, users, args.cold_login_rate,
+                            instruments)
+        print_level(clients, summary)
+        levels.append(dict(clients=clients, summary=summary))
+    if server is not None:
+        server.shutdown()
+    SchedulerHandler().scheduler.shutdown(wait=False)
+    fake.stop()
+    shutil.rmtree(store_dir, ignore_errors=True)
+
+    params = dict(target=args.target, levels=[level['clients'] for level in levels], duration=args.duration,
+                  mix=args.mix, users=args.users, cold_login_rate=args.cold_login_rate, preload=args.preload,
+                  latency=args.latency, engine=args.engine)
+    previous = load_previous(args.output, params)
+    if previous:
+        compare(levels, previous)
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(dict(time=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                revision=git_revision(), params=params, levels=levels)) + '\n')
+    return levels
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
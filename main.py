@@ -3,27 +3,44 @@
 import sys
 import logging
 
-from flask import Flask
-
 import config
 
-if len(sys.argv) > 1 and sys.argv[1] == 'debug':
+# python main.py [debug] [scheduler]
+# scheduler: 只运行scheduler进程（config.SCHEDULER_MODE = 'remote'时），不运行web服务
+if 'debug' in sys.argv[1:]:
     config.config = config.get_config('debug')
 else:
     config.config = config.get_config('production')
 
 
-from scheduler import SchedulerHandler
-from api import api
+import event_log
 
-# TODO: 预约信息的log和程序log分开
+# 程序log写入log_tem.log，预约信息写入单独的事件日志（后台线程写入，不阻塞预约）
 logging.basicConfig(filename='log_tem.log', level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+event_log.setup()
+
+# 重启时尽快执行错过的和即将触发的任务：scheduler先启动，之后才导入Flask和API；scheduler进程完全不导入
+if __name__ == '__main__':
+    if 'scheduler' in sys.argv[1:]:
+        import scheduler_service
+        scheduler_service.serve()
+        sys.exit(0)
+    if config.config.SCHEDULER_MODE == 'inline':
+        from scheduler import SchedulerHandler
+        SchedulerHandler().start()
+    else:
+        # 没有IPC的认证密钥时不启动
+        from scheduler import get_handler
+        get_handler()
+
+from flask import Flask
+from api import api
+
 app = Flask(__name__)
 app.register_blueprint(api)
 
 
 if __name__ == '__main__':
-    scheduler = SchedulerHandler()
-    scheduler.start()
-    app.run(host='0.0.0.0', port=17910, debug=config.config.debug, threaded=True)
+    # 不使用reloader：reloader的父进程也会执行到这里，启动第二个scheduler
+    app.run(host='0.0.0.0', port=17910, debug=config.config.debug, threaded=True, use_reloader=False)
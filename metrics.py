@@ -0,0 +1,184 @@
+import re
+import bisect
+import threading
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}  # label values tuple -> value
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _labels_str(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"')
+                                              .replace('\n', '\\n')) for name, value in pairs)
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        with self.lock:
+            items = sorted(self.children.items())
+        for key, value in items:
+            lines.extend(self._expose_child(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.children[key] = self.children.get(key, 0) + amount
+
+    def _expose_child(self, key, value):
+        return ['%s%s %s' % (self.name, self._labels_str(key), _format(value))]
+
+
+class Gauge(_Metric):
+    """取值在导出时由callback计算，callback返回数值，或{标签值tuple: 数值}"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def expose(self):
+        value = self.callback()
+        if value is None:
+            value = {}
+        elif not isinstance(value, dict):
+            value = {(): value}
+        with self.lock:
+            self.children = {key: v for key, v in value.items() if v is not None}
+        return super().expose()
+
+    def _expose_child(self, key, value):
+        return ['%s%s %s' % (self.name, self._labels_str(key), _format(value))]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # 只记录落在哪个桶，导出时再累加
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            child = self.children.get(key)
+            if child is None:
+                child = self.children[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            child[0][index] += 1
+            child[1] += value
+            child[2] += 1
+
+    def _expose_child(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else _format(bound)
+            lines.append('%s_bucket%s %d' % (self.name, self._labels_str(key, [('le', le)]), cumulative))
+        lines.append('%s_sum%s %s' % (self.name, self._labels_str(key), _format(total)))
+        lines.append('%s_count%s %d' % (self.name, self._labels_str(key), count))
+        return lines
+
+
+def _format(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Registry(object):
+    """进程内的指标，按Prometheus的文本格式导出"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+_SAMPLE_NAME = re.compile(r'[a-zA-Z_:][a-zA-Z0-9_:]*')
+
+
+def _with_label(line, name, value):
+    """给一行样本加上一个标签"""
+    end = _SAMPLE_NAME.match(line).end()
+    label = '%s="%s"' % (name, value)
+    if line[end:end + 1] == '{':
+        return line[:end + 1] + label + ',' + line[end + 1:]
+    return line[:end] + '{' + label + '}' + line[end:]
+
+
+def merge(expositions):
+    """合并多个进程导出的指标，同名的指标合并成一组（HELP、TYPE只保留一份），样本加上process标签区分进程
+
+    :param list expositions: [(进程名, Prometheus文本格式的指标)]
+    :return: str
+    """
+    families = {}  # 指标名 -> ({'HELP'/'TYPE': 注释行}, [样本])
+    for process, text in expositions:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                # '# HELP 指标名 说明'或'# TYPE 指标名 类型'
+                kind, name = line.split(' ', 3)[1:3]
+                family = families.setdefault(name, ({}, []))
+                family[0].setdefault(kind, line)
+            elif line and family is not None:
+                family[1].append(_with_label(line, 'process', process))
+    lines = []
+    for comments, samples in families.values():
+        lines.extend(comments.values())
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+login_seconds = registry.register(Histogram(
+    'tem_login_seconds', 'Upstream login latency, including retries', ['result']))
+reserve_post_seconds = registry.register(Histogram(
+    'tem_reserve_post_seconds', 'Latency of one reservation POST', ['result']))
+reserve_attempts = registry.register(Histogram(
+    'tem_reserve_attempts', 'Reservation POSTs sent per job', buckets=(1, 2, 3, 5, 8, 13, 21)))
+reserve_jobs = registry.register(Counter(
+    'tem_reserve_jobs_total', 'Finished reservation jobs', ['result']))
+trigger_lateness_seconds = registry.register(Histogram(
+    'tem_trigger_lateness_seconds', 'First POST time minus the local trigger time (negative is early)',
+    buckets=(-1, -.5, -.25, -.1, -.05, -.01, -.001, 0, .001, .01, .05, .1, .25, .5, 1, 5)))
+upstream_errors = registry.register(Counter(
+    'tem_upstream_errors_total', 'Upstream error responses by known errorCode (RETRY_RULES keyword or other) '
+    'or HTTP status', ['code']))
+api_request_seconds = registry.register(Histogram(
+    'tem_api_request_seconds', 'API endpoint latency', ['endpoint', 'status']))
@@ -0,0 +1,119 @@
+import os
+import time
+import logging
+import datetime
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
+from clock import ServerClock
+import metrics
+import event_log
+from apscheduler.jobstores.base import JobLookupError
+
+_imported_at = time.time()
+# 启动过程各阶段距进程启动的秒数：ready scheduler启动完成，indexed 所有任务的索引建立完成，first_fire 第一个预约任务开始执行
+startup = dict(ready=None, indexed=None, first_fire=None)
+_lock = threading.Lock()
+
+
+def process_started_at():
+    """进程的启动时间（时间戳），从/proc读取；取不到时用本模块导入的时间"""
+    try:
+        with open('/proc/self/stat') as f:
+            # 进程名可能包含空格，从最后一个')'之后开始数，starttime是第22个字段
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return _imported_at
+
+
+def mark(stage):
+    """记录启动过程到达某阶段的时间，每个阶段只记录第一次"""
+    with _lock:
+        if startup.get(stage) is not None:
+            return
+        startup[stage] = round(time.time() - process_started_at(), 3)
+    logging.info('startup %s after %.3fs' % (stage, startup[stage]))
+    event_log.emit('startup', stage=stage, seconds=startup[stage])
+
+
+def _run_overdue(groups, finish):
+    from batch import ReserveBatch
+    from reserve import keep_reserve_job
+
+    def run_group(trigger_time, jobs):
+        if trigger_time is None:
+            # 旧任务没有开始预约时间，登录后立即预约
+            for job in jobs:
+                try:
+                    keep_reserve_job(**job.kwargs)
+                finally:
+                    finish(job.id)
+            return
+        ReserveBatch(trigger_time, [job.kwargs for job in jobs],
+                     on_finished=lambda i: finish(jobs[i].id)).run(stagger=0)
+
+    mark('first_fire')
+    with ThreadPoolExecutor(max_workers=len(groups), thread_name_prefix='catch-up') as executor:
+        for trigger_time, jobs in groups.items():
+            executor.submit(run_group, trigger_time, jobs)
+
+
+def _remove(store, job_id):
+    try:
+        store.remove_job(job_id)
+    except JobLookupError:
+        pass
+
+
+def catch_up(store, now=None, finish=None):
+    """scheduler启动前处理重启期间错过触发时间的预约任务，之后scheduler不会再因misfire跳过它们
+
+    包括已被批处理认领、但重启前还没有执行完的任务（不论触发时间）；
+    开始预约时间距现在不超过`config.RESTART_MISFIRE_GRACE`秒（或还没到）的任务在jobstore中认领，
+    按开始预约时间分组，各组同时在后台执行（ReserveBatch，不错开登录），每个任务执行完后调用finish；
+    更早的任务删除并记录事件
+
+    :param ReserveJobStore store: 预约任务的jobstore
+    :param datetime.datetime now: 当前（本地）时间，默认现在
+    :param finish: 执行完一个任务后调用，参数为job id，默认直接从store中删除
+    :return: (立即执行的任务数, 错过的任务数)
+    """
+    now = now or datetime.datetime.now()
+    finish = finish or (lambda job_id: _remove(store, job_id))
+    clock = ServerClock()
+    groups = defaultdict(list)
+    missed = 0
+    for job in store.get_claimed_jobs() + store.get_due_jobs(now.astimezone()):
+        kwargs = job.kwargs
+        if not kwargs.get('username'):
+            # 不是预约任务，交给scheduler按misfire设置处理
+            continue
+        trigger_time = kwargs.get('trigger_time')
+        late = (now - clock.to_local(trigger_time)).total_seconds() if trigger_time is not None else 0
+        if late <= config.RESTART_MISFIRE_GRACE:
+            groups[trigger_time].append(job)
+            continue
+        missed += 1
+        _remove(store, job.id)
+        reserve_data = kwargs.get('reserve_data') or {}
+        event_log.emit('missed', username=kwargs['username'], instrumentId=reserve_data.get('instrumentId'),
+                       reserveDate=reserve_data.get('reserveDate'), late=late)
+        metrics.reserve_jobs.inc(result='missed')
+    # scheduler恢复执行前认领，不会再单独触发；已认领的任务忽略
+    store.claim_jobs([job.id for jobs in groups.values() for job in jobs])
+    count = sum(len(jobs) for jobs in groups.values())
+    if groups:
+        threading.Thread(target=_run_overdue, args=(dict(groups), finish), name='catch-up', daemon=True).start()
+    if count or missed:
+        logging.warning('restart catch-up: %d overdue jobs started, %d missed' % (count, missed))
+    return count, missed
+
+
+metrics.registry.register(metrics.Gauge(
+    'tem_startup_seconds', 'Seconds from process start to scheduler ready, fully indexed and first fired job',
+    lambda: {(stage,): seconds for stage, seconds in startup.items()}, ['stage']))
@@ -0,0 +1,242 @@
+import time
+import logging
+import sqlite3
+import datetime
+import threading
+from uuid import uuid4
+
+from config import config
+from jobstore import RESERVE_DATE_FORMAT, sqlite_path
+from interval_index import minutes_of
+from instrument import Instrument
+from errors import InstrumentException
+import event_log
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS recurring_rules ('
+    ' id TEXT PRIMARY KEY,'
+    ' username TEXT NOT NULL,'
+    ' password TEXT NOT NULL,'
+    ' instrument_id TEXT NOT NULL,'
+    ' weekday INTEGER NOT NULL,'
+    ' start_time TEXT NOT NULL,'
+    ' end_time TEXT NOT NULL,'
+    ' report TEXT NOT NULL,'
+    ' end_date TEXT NOT NULL,'
+    ' created_at REAL NOT NULL,'
+    ' last_date TEXT,'  # 最近一次生成任务的实验日期，'%Y-%m-%d'
+    ' job_id TEXT,'  # 最近一次生成的任务
+    ' trigger_time TEXT,'  # 该任务的开始预约时间，'%Y-%m-%d %H:%M:%S'
+    ' error TEXT)',
+    'CREATE INDEX IF NOT EXISTS ix_recurring_rules_username ON recurring_rules (username)',
+)
+_COLUMNS = ('id', 'username', 'password', 'instrument_id', 'weekday', 'start_time', 'end_time', 'report', 'end_date',
+            'created_at', 'last_date', 'job_id', 'trigger_time', 'error')
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def next_date(rule, now=None):
+    """规则下一个要生成任务的实验日期：今天或上次生成的日期之后，第一个是规则的周几的日期；
+    今天的实验开始时间已过时从明天算起
+
+    :param datetime.datetime now: 当前时间，默认datetime.datetime.now()
+    :return: datetime.date，超过结束日期时为None
+    """
+    now = now or datetime.datetime.now()
+    start = now.date()
+    if now.hour * 60 + now.minute >= minutes_of(rule['start_time']):
+        start += datetime.timedelta(days=1)
+    if rule['last_date']:
+        start = max(start, datetime.date.fromisoformat(rule['last_date']) + datetime.timedelta(days=1))
+    day = start + datetime.timedelta(days=(rule['weekday'] - start.weekday()) % 7)
+    return day if day <= datetime.date.fromisoformat(rule['end_date']) else None
+
+
+class RecurringRules(object):
+    """每周重复的预约规则：仪器、周几、实验时间段、结束日期
+
+    规则只保存一次（与jobstore同一个sqlite文件中的recurring_rules表），不预先生成所有日期的任务；
+    每条规则同一时间最多有一个未执行的预约任务：上一个任务执行或被删除后，
+    `materialize`按`ReserveTime.get_time`为下一个实验日期生成任务，scheduler的定时任务定期检查所有规则
+
+    web进程和scheduler进程（`config.SCHEDULER_MODE = 'remote'`时）都可以读写规则，
+    生成任务通过`get_handler`；两边同时生成同一规则的任务时只有一个生效，见`materialize`
+
+    单例
+    """
+    _instance = None
+    _new_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            with cls._new_lock:
+                if cls._instance is None:
+                    instance = object.__new__(cls)
+                    instance.path = sqlite_path(config.SCHEDULER_STORE_URL)
+                    instance.lock = threading.RLock()
+                    instance.connection = None
+                    cls._instance = instance
+        return cls._instance
+
+    def _connect(self):
+        """所有线程共用一个连接，用锁串行化；规则的读写很少"""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            with self.connection:
+                for statement in _SCHEMA:
+                    self.connection.execute(statement)
+        return self.connection
+
+    def _query(self, where='', params=()):
+        with self.lock:
+            rows = self._connect().execute('SELECT %s FROM recurring_rules %s ORDER BY created_at'
+                                           % (', '.join(_COLUMNS), where), params).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, rule_id):
+        rules = self._query('WHERE id = ?', (rule_id,))
+        return rules[0] if rules else None
+
+    def rules(self, username=None):
+        """用户的规则，username为None时所有规则"""
+        if username is None:
+            return self._query()
+        return self._query('WHERE username = ?', (username,))
+
+    def add(self, username, password, instrument_id, weekday, start_time, end_time, end_date, report='tem'):
+        """添加规则，并立即生成第一个任务
+
+        :param int weekday: 实验日期是周几，周一是0
+        :param datetime.date end_date: 最后一个实验日期（包含）
+        :return: 规则（dict）
+        """
+        rule = dict(id=uuid4().hex, username=username, password=password, instrument_id=instrument_id,
+                    weekday=weekday, start_time=start_time, end_time=end_time, report=report,
+                    end_date=end_date.isoformat(), created_at=time.time(), last_date=None, job_id=None,
+                    trigger_time=None, error=None)
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('INSERT INTO recurring_rules (%s) VALUES (%s)'
+                                   % (', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))),
+                                   [rule[column] for column in _COLUMNS])
+        event_log.emit('recurring_added', rule_id=rule['id'], username=username, instrumentId=instrument_id,
+                       weekday=weekday, reserveStartTime=start_time, reserveEndTime=end_time,
+                       end_date=rule['end_date'])
+        return self.materialize(rule)
+
+    def remove(self, rule_id, username):
+        """删除规则以及它未执行的任务，只能删除自己的规则（管理员可以删除所有规则）
+
+        :return: 是否删除
+        """
+        rule = self.get(rule_id)
+        if rule is None or (username != rule['username'] and username != config.ADMIN_USERNAME):
+            return False
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('DELETE FROM recurring_rules WHERE id = ?', (rule_id,))
+        if rule['job_id']:
+            from scheduler import get_handler
+            get_handler().remove_job(rule['job_id'], rule['username'])
+        event_log.emit('recurring_removed', rule_id=rule_id, username=rule['username'])
+        return True
+
+    def _pending(self, rule):
+        """规则最近生成的任务还没有执行"""
+        from scheduler import get_handler
+        return bool(rule['job_id']) and rule['job_id'] in get_handler().get_user_job_ids(rule['username'])
+
+    def _update(self, rule, **values):
+        """更新规则，只有last_date没有被其他进程、线程改过时才更新
+
+        :return: 是否更新
+        """
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                cursor = connection.execute(
+                    'UPDATE recurring_rules SET %s WHERE id = ? AND IFNULL(last_date, \'\') = ?'
+                    % ', '.join('%s = ?' % column for column in values),
+                    list(values.values()) + [rule['id'], rule['last_date'] or ''])
+        if cursor.rowcount:
+            rule.update(values)
+        return bool(cursor.rowcount)
+
+    def materialize(self, rule, now=None):
+        """规则没有未执行的任务时，为下一个实验日期生成预约任务
+
+        先生成任务，再按last_date条件更新规则；更新失败说明同时有另一处生成了同一日期的任务，删除自己生成的
+
+        :return: 规则（dict），已更新
+        """
+        # 用到时才导入
+        from reserve import ReserveTem, ReserveTime
+        from scheduler import get_handler
+        if self._pending(rule):
+            return rule
+        day = next_date(rule, now)
+        if day is None:
+            # 已过结束日期，规则保留，列出时显示已结束
+            if rule['job_id']:
+                self._update(rule, job_id=None, trigger_time=None)
+            return rule
+        try:
+            instrument = Instrument.get(instrument_id=rule['instrument_id'])
+        except InstrumentException as e:
+            self._update(rule, error=str(e))
+            return rule
+        reserve_time = ReserveTime.get_time(instrument, day)
+        reserve = ReserveTem()
+        reserve.set_account(rule['username'], rule['password'])
+        reserve.set_info(dict(reserveDate=day.strftime(RESERVE_DATE_FORMAT), reserveStartTime=rule['start_time'],
+                              reserveEndTime=rule['end_time'], instrumentId=rule['instrument_id'],
+                              ReserveReport=rule['report']))
+        try:
+            job = reserve.set_job(reserve_time)
+        except Exception as e:
+            logging.exception(e)
+            self._update(rule, error='生成任务失败：%s' % e)
+            return rule
+        if job is None:
+            # 帐号验证失败，下次检查时再试
+            self._update(rule, error='帐号或密码错误')
+            return rule
+        if not self._update(rule, last_date=day.isoformat(), job_id=job.id,
+                            trigger_time=reserve_time.strftime(_TIME_FORMAT), error=None):
+            get_handler().remove_job(job.id, rule['username'])
+            return self.get(rule['id']) or rule
+        event_log.emit('recurring_materialized', rule_id=rule['id'], username=rule['username'], job_id=job.id,
+                       instrumentId=rule['instrument_id'], reserveDate=rule['last_date'],
+                       trigger_time=rule['trigger_time'])
+        return rule
+
+    def materialize_all(self, now=None):
+        """检查所有规则，为没有未执行任务的规则生成下一个任务"""
+        for rule in self.rules():
+            try:
+                self.materialize(rule, now)
+            except Exception as e:
+                logging.exception('materialize recurring rule %s failed: %s' % (rule['id'], e))
+
+    def describe(self, rule):
+        """返回给前端的规则，不含密码；upcoming为下一个未执行的任务，没有时为None"""
+        try:
+            instrument = Instrument.get(instrument_id=rule['instrument_id']).name
+        except InstrumentException:
+            instrument = None
+        upcoming = None
+        if self._pending(rule):
+            upcoming = dict(job_id=rule['job_id'], reserve_date=rule['last_date'], trigger_time=rule['trigger_time'])
+        finished = upcoming is None and next_date(rule) is None
+        return dict(rule_id=rule['id'], username=rule['username'], instrument=instrument,
+                    instrument_id=rule['instrument_id'], weekday=rule['weekday'], start_time=rule['start_time'],
+                    end_time=rule['end_time'], report=rule['report'], end_date=rule['end_date'],
+                    upcoming=upcoming, finished=finished, error=rule['error'])
+
+
+def materialize_job():
+    """scheduler的定时任务，定期为重复规则生成下一个任务"""
+    RecurringRules().materialize_all()
@@ -0,0 +1,121 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from config import config
+import metrics
+
+
+class PreciseTimer(object):
+    """高精度等待：先sleep到目标时间前一小段，再自旋到目标时间
+
+    sleep的唤醒有调度抖动，自旋的时长（spin_margin）根据实测的sleep超时校准，
+    自旋时每轮调用sleep(0)让出GIL，不影响其他同时等待的线程
+
+    每次等待的释放误差（实际释放时间 - 目标时间）记录在release_errors中
+
+    单例
+    """
+    _instance = None
+    _new_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            # 可能在多个预约线程中同时第一次使用，初始化完成后才让其他线程看到
+            with cls._new_lock:
+                if cls._instance is None:
+                    instance = object.__new__(cls)
+                    instance.lock = threading.Lock()
+                    instance.spin_margin = config.RELEASE_SPIN_MAX
+                    instance.calibrated = False
+                    instance.release_errors = deque(maxlen=config.RELEASE_ERROR_HISTORY)
+                    cls._instance = instance
+        return cls._instance
+
+    def calibrate(self, samples=20):
+        """测量sleep(1ms)的最大超时，作为自旋时长"""
+        overshoot = 0
+        for i in range(samples):
+            start = time.perf_counter()
+            time.sleep(0.001)
+            overshoot = max(overshoot, time.perf_counter() - start - 0.001)
+        self.spin_margin = min(max(overshoot * 2, 0.001), config.RELEASE_SPIN_MAX)
+        self.calibrated = True
+        logging.info('precise timer calibrated: spin margin %.2fms' % (self.spin_margin * 1000))
+
+    def wait(self, target, cancel_event=None):
+        """等待到target（time.time()的时间戳）
+
+        :param float target: 目标时间戳
+        :param threading.Event cancel_event: 可选，被set时提前结束等待
+        :return: 释放误差（秒），被取消返回None
+        """
+        if not self.calibrated:
+            self.calibrate()
+        coarse = target - time.time() - self.spin_margin
+        if coarse > 0:
+            if cancel_event is not None:
+                if cancel_event.wait(coarse):
+                    return None
+            else:
+                time.sleep(coarse)
+        # 换算到单调时钟上自旋
+        deadline = time.perf_counter() + (target - time.time())
+        while time.perf_counter() < deadline:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            time.sleep(0)
+        return self._record(target)
+
+    async def wait_async(self, target, cancel_event=None):
+        """`wait`的协程版本，在事件循环中等待，自旋时每轮让出事件循环
+
+        :param float target: 目标时间戳
+        :param asyncio.Event cancel_event: 可选，被set时提前结束等待
+        :return: 释放误差（秒），被取消返回None
+        """
+        if not self.calibrated:
+            # 校准会阻塞约20ms，不能在事件循环中执行；AsyncEngine启动时已校准，这里只是兜底
+            await asyncio.get_running_loop().run_in_executor(None, self.calibrate)
+        coarse = target - time.time() - self.spin_margin
+        if coarse > 0:
+            if cancel_event is not None:
+                try:
+                    await asyncio.wait_for(cancel_event.wait(), coarse)
+                    return None
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(coarse)
+        deadline = time.perf_counter() + (target - time.time())
+        while time.perf_counter() < deadline:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            await asyncio.sleep(0)
+        return self._record(target)
+
+    def _record(self, target):
+        error = time.time() - target
+        with self.lock:
+            self.release_errors.append(error)
+        return error
+
+    def stats(self):
+        """最近释放误差的统计（毫秒）"""
+        with self.lock:
+            errors = sorted(abs(e) * 1000 for e in self.release_errors)
+        if not errors:
+            return dict(count=0, spin_margin=self.spin_margin * 1000)
+        return dict(
+            count=len(errors),
+            spin_margin=self.spin_margin * 1000,
+            median=errors[len(errors) // 2],
+            max=errors[-1]
+        )
+
+
+metrics.registry.register(metrics.Gauge(
+    'tem_release_error_milliseconds', 'Recent precise release errors', lambda: {
+        (key,): value for key, value in PreciseTimer().stats().items()}, ['stat']))
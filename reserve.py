@@ -1,14 +1,26 @@
 import datetime
-from urllib.request import HTTPCookieProcessor, build_opener
+import threading
+from uuid import uuid4
+from http.cookiejar import CookieJar
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, urlencode, parse_qs, unquote
 from urllib.error import HTTPError
-from http.cookiejar import CookieJar
-from time import sleep
+from time import sleep, perf_counter, time
 
 from config import config
 import logging
-from scheduler import SchedulerHandler
-from errors import ReserveException
+from scheduler import get_handler
+from clock import ServerClock
+from http_client import HttpClient
+from auth_cache import AuthCache
+from availability import AvailabilityCache, TAKEN
+from release import PreciseTimer
+from retry import RetryPolicy, ABORT, RELOGIN, BACKOFF
+import metrics
+import event_log
+from instrument import Instrument
+from job_summary import JobSummary
+from errors import ReserveException, SessionExpiredException, InstrumentException
 
 
 class ReserveTime:
@@ -37,90 +49,279 @@ class ReserveTime:
         return trigger_datetime if trigger_datetime > now else now
 
 
-def keep_reserve_job(username, password, reserve_data):
-    """scheduler的定时任务，到预约时间触发，实现预约功能
+def wait_until(target_time, cancel_event=None):
+    """阻塞到指定时间，target_time为None或已过去时立即返回
+
+    :param datetime.datetime target_time: 等待到的时间
+    :param threading.Event cancel_event: 可选，被set时提前结束等待
+    :return: 被cancel_event取消返回False，否则True
+    """
+    if target_time is None:
+        return True
+    delta = (target_time - datetime.datetime.now()).total_seconds()
+    if delta > 0:
+        if cancel_event is not None:
+            return not cancel_event.wait(delta)
+        sleep(delta)
+    return cancel_event is None or not cancel_event.is_set()
+
+
+def burst_offsets(burst):
+    """并发提交的各次提交相对窗口开始的秒数，超出窗口的不发送；为空时不并发"""
+    if burst is None:
+        return []
+    return [i * burst['spacing'] for i in range(burst['count']) if i * burst['spacing'] <= burst['window']]
+
+
+def burst_of(reserve_data, assignment=None):
+    """预约仪器的burst设置，仪器不存在、未设置或没有要发送的提交时返回None；
+    有批处理中的名次时按名次减少并发次数（见dispatch.Assignment.burst_for）"""
+    try:
+        burst = Instrument.get(instrument_id=reserve_data.get('instrumentId')).burst
+    except InstrumentException:
+        return None
+    if assignment is not None:
+        burst = assignment.burst_for(burst)
+    return burst if burst_offsets(burst) else None
+
+
+def planned_posts(reserve_data, assignment=None):
+    """开始预约时同时发出的预约请求数：设置了burst时为并发提交的次数，否则为1"""
+    return len(burst_offsets(burst_of(reserve_data, assignment))) or 1
+
+
+def keep_reserve_job(username, password, reserve_data, trigger_time=None, priority=0, submitted_at=None,
+                     alternatives=None):
+    """scheduler的定时任务，实现预约功能
+
+    分两个阶段：任务在预约时间前`config.WARMUP_SECONDS`秒触发，先登录预热；
+    到trigger_time时只提交预约请求，如果会话已失效则重新登录；
+    预热前检查时间段是否已被预约，已被预约时换备选的时间段，都已被预约时不再预约
 
     :param str username: 登录“易约”的用户名
     :param str password: 登录“易约”的密码
     :param dict reserve_data: POST请求提交的数据
+    :param datetime.datetime trigger_time: 开始预约的时间，为None时（旧任务）登录后立即预约
+    :param int priority: 优先级，submitted_at: 设定的时间戳，只在批处理排序时使用（见dispatch.py）
+    :param list alternatives: 备选的预约数据，按顺序尝试，见`ReserveTem.set_info`
+    :return: 是否预约成功；`config.ENGINE = 'asyncio'`时交给事件循环执行，返回结果的Future
     """
+    if config.ENGINE == 'asyncio':
+        from async_reserve import submit_reserve_job
+        return submit_reserve_job(username, password, reserve_data, trigger_time, alternatives)
     reserve = ReserveTem()
-    reserve.set_account(username, password)
-    reserve.set_info(reserve_data)
-    reserve.keep_reserve()
+    reserve.set_account(username, password, shared_session=True)
+    try:
+        reserve.set_info(reserve_data, alternatives)
+        if trigger_time is not None and not reserve.still_possible():
+            return False
+        if not reserve.warm_up():
+            return False
+        clock = ServerClock()
+        if trigger_time is not None and clock.is_stale():
+            clock.calibrate()
+        return reserve.fire(trigger_time)
+    finally:
+        reserve.release_session()
 
 
 class ReserveTem(object):
     def __init__(self):
-        self.login_url = 'http://cem.ylab.cn/doLogin.action'  # GET or POST
-        self.reserve_url = 'http://cem.ylab.cn/user/doReserve.action'  # POST
+        self.login_url = config.UPSTREAM_URL + '/doLogin.action'  # GET or POST
+        self.reserve_url = config.UPSTREAM_URL + '/user/doReserve.action'  # POST
 
-        self.cookie = CookieJar()
-        self.handler = HTTPCookieProcessor(self.cookie)
-        self.opener = build_opener(self.handler)
+        # 共享的keep-alive连接池
+        self.client = HttpClient()
+        self.cookie = None
+        self.shared_session = False  # self.cookie是否是用户共享的CookieJar，见`set_account`
 
         self.username = ''
         self.password = ''
         self.account_checked = None  # True: correct, False: wrong, None: haven't try
+        self.login_time = None  # 最近一次登录成功的时间
+        self.first_post_at = None  # 第一次预约请求写入连接的时间
+        self.release_error = None  # 第一次提交的释放误差（秒）
+        self.prepared = None  # 提前构造好的预约请求
+        self.attempts = 0  # 已发出的预约请求数
+        self.retry_policy = RetryPolicy()  # 按失败原因决定如何重试
+        self.dropped = False  # 开始预约前发现时间段已被预约
+        self.assignment = None  # 批处理中同一仪器竞争的名次（dispatch.Assignment），None表示不排序
+        self.lock = threading.Lock()
         self.reserve_data = {}
+        self.alternatives = []  # 还没有尝试的备选预约数据
 
-        self.scheduler = SchedulerHandler()
+        self.scheduler = get_handler()
 
-    def set_account(self, username, password):
+    def set_account(self, username, password, shared_session=False):
+        """设置帐号
+
+        :param bool shared_session: 执行预约时为True，使用该用户共享的CookieJar，同一用户同时执行的任务共用登录会话，
+                用完后调用`release_session`；
+                只验证帐号时（API、设定任务）为False，在新的CookieJar上登录，
+                不会带上预约任务已登录的会话cookie（可能让错误的密码也被重定向、判定为登录成功），也不会重置那个会话
+        """
         if not username or not password:
             raise ReserveException('username and password can not be empty')
+        self.release_session()
         self.username = username
         self.password = password
         self.account_checked = None
+        if shared_session:
+            self.cookie = HttpClient().acquire_cookie_jar(username)
+        else:
+            self.cookie = CookieJar()
+        self.shared_session = shared_session
+
+    def release_session(self):
+        """不再使用用户共享的CookieJar，见`set_account`"""
+        if self.shared_session:
+            self.shared_session = False
+            HttpClient().release_cookie_jar(self.username)
+
+    def set_info(self, reserve_data, alternatives=None):
+        """设置预约数据
 
-    def set_info(self, reserve_data):
+        :param dict reserve_data: 预约POST请求提交的数据
+        :param list alternatives: 备选的预约数据（其他时间段、仪器或日期），reserve_data不可能预约成功时
+                （重试策略中的ABORT，如已被预约）按顺序换下一个，使用同一个登录会话和同样的尝试次数
+        """
+        self.reserve_data = reserve_data
+        self.alternatives = list(alternatives or [])
+
+    def next_alternative(self, reason):
+        """换到下一个备选的预约数据，没有备选时返回False"""
+        if not self.alternatives:
+            return False
+        reserve_data = self.alternatives.pop(0)
+        self._event('fallback', reason=reason, to=dict(
+            (key, reserve_data.get(key)) for key in ('instrumentId', 'reserveDate', 'reserveStartTime', 'reserveEndTime')))
         self.reserve_data = reserve_data
+        if self.prepared is not None:
+            self.prepare()
+        return True
+
+    def set_assignment(self, assignment):
+        """设置批处理中的名次：名次靠后的第一次提交更晚、并发提交更少"""
+        self.assignment = assignment
+
+    def release_offset(self):
+        """第一次提交比开始预约时间晚多少秒"""
+        return self.assignment.release_offset if self.assignment is not None else 0
 
     def login(self):
-        login_data = urlencode(dict(
-            origUrl='',
-            origType='',
-            rememberMe='false',
-            username=self.username,
-            password=self.password
-        )).encode()
-        # 尝试登录 有可能出现服务器500错误，所以尝试多次
+        login_data = self._login_data()
+        start = perf_counter()
+        # 尝试登录 有可能出现服务器500错误，所以尝试多次，按重试策略退避；4xx等不可恢复的错误直接抛出
         for i in range(config.LOGIN_TRY_TIME):
             try:
-                login_result = self.opener.open(self.login_url, login_data)
+                login_result = self.client.open(self.login_url, login_data, self.cookie)
                 break
             except HTTPError as e:
-                logging.warning('HTTPError: login try no.%s failed: %s' % (i + 1, str(e)))
+                error = e
+                delay = self._login_retry_delay(i, e, start)
                 if i < config.LOGIN_TRY_TIME - 1:
-                    sleep((i + 1) / 2)
+                    sleep(delay)
         else:
-            logging.warning('login failed: exceed max try times')
+            self._login_exhausted(start)
+            raise error
+        return self._login_done(login_result, start)
+
+    def _login_data(self):
+        return urlencode(dict(
+            origUrl='',
+            origType='',
+            rememberMe='false',
+            username=self.username,
+            password=self.password
+        )).encode()
+
+    def _login_retry_delay(self, i, e, start):
+        """第i+1次登录请求出错：不可恢复的错误直接抛出，否则返回下一次尝试前等待的秒数"""
+        logging.warning('HTTPError: login try no.%s failed: %s' % (i + 1, str(e)))
+        if self.retry_policy.classify_exception(e) == ABORT:
+            metrics.login_seconds.observe(perf_counter() - start, result='error')
             raise e
+        return self.retry_policy.delay(BACKOFF, i)
+
+    def _login_exhausted(self, start):
+        logging.warning('login failed: exceed max try times')
+        metrics.login_seconds.observe(perf_counter() - start, result='error')
 
+    def _login_done(self, login_result, start):
+        """根据登录请求的结果更新登录状态，返回帐号是否正确"""
         if login_result.geturl() != self.login_url:
             # 重定向则登录成功
             self.account_checked = True
-            return True
+            self.login_time = datetime.datetime.now()
+            # cookie变了，预约请求需要重新构造
+            self.prepared = None
         else:
             self.account_checked = False
+            self.login_time = None
+        # 每次真正登录的结果都更新到帐号验证缓存
+        AuthCache().put(self.username, self.password, self.account_checked)
+        metrics.login_seconds.observe(perf_counter() - start,
+                                      result='success' if self.account_checked else 'failure')
+        return self.account_checked
+
+    def session_valid(self):
+        """登录会话是否还可以直接使用（登录过且未超过`config.SESSION_MAX_AGE`）"""
+        if self.login_time is None:
             return False
+        age = (datetime.datetime.now() - self.login_time).total_seconds()
+        return age < config.SESSION_MAX_AGE
 
     def _reserve(self):
         """must call set_account, set_info and login before this method
 
+        可以在多个线程中同时调用，每次调用使用连接池中单独的连接
+
         :return: 返回一个dict
                 status=True/False 是否预约成功，
                 msg 服务器返回的errorCode 即错误信息
         """
+        prepared = self._before_post()
+        start = perf_counter()
+        try:
+            location = self.client.open_prepared(prepared, self.cookie, self._post_sent).geturl()
+        except Exception as e:
+            self._post_failed(e, start)
+            raise
+        return self._reserve_result(location, start)
+
+    def _before_post(self):
+        """检查并计数一次预约提交，返回要发送的请求"""
         if self.username == '':
             raise ReserveException('must set account before reserve')
         if self.reserve_data == {}:
             raise ReserveException('must set reserve data before reserve')
-        post_data = urlencode(self.reserve_data).encode()
-        location = self.opener.open(self.reserve_url, post_data).geturl()
+        prepared = self.prepared or self.prepare()
+        with self.lock:
+            self.attempts += 1
+        return prepared
+
+    def _post_sent(self, sent_at):
+        """预约请求已写入连接，记录第一次发出的时间；在连接池中排队的时间不算"""
+        with self.lock:
+            if self.first_post_at is None or sent_at < self.first_post_at:
+                self.first_post_at = sent_at
+
+    def _post_failed(self, e, start):
+        metrics.reserve_post_seconds.observe(perf_counter() - start, result='error')
+        if isinstance(e, HTTPError):
+            metrics.upstream_errors.inc(code='HTTP %d' % e.code)
+
+    def _reserve_result(self, location, start):
+        """根据预约请求最后重定向到的地址得出预约结果，见`_reserve`"""
+        if 'login' in urlparse(location).path.lower():
+            # 被重定向到登录页面，说明会话已失效
+            self.login_time = None
+            metrics.reserve_post_seconds.observe(perf_counter() - start, result='expired')
+            raise SessionExpiredException('session expired, redirected to %s' % location)
         result = parse_qs(urlparse(location).query)
         if 'success' in result.get('errorType', [''])[0]:
             # 预约成功
+            metrics.reserve_post_seconds.observe(perf_counter() - start, result='success')
             return dict(status=True, msg='预约成功')
         else:
             msg = ''
@@ -128,45 +329,277 @@ class ReserveTem(object):
                 msg = unquote(unquote(result.get('errorCode')[0]))
             except TypeError as e:
                 logging.exception(e)
-            logging.info(msg)
+            metrics.reserve_post_seconds.observe(perf_counter() - start, result='failure')
+            # errorCode的原文记录在事件日志中（见_attempt_failed），指标只按已知的错误分类，标签的取值有限
+            metrics.upstream_errors.inc(code=self.retry_policy.known_code(msg))
             return dict(status=False, msg=msg)
 
+    def prepare(self):
+        """提前编码预约数据、构造请求，提交时直接发送"""
+        self.prepared = self.client.prepare(self.reserve_url, urlencode(self.reserve_data).encode(), self.cookie)
+        return self.prepared
+
+    def still_possible(self):
+        """开始预约前检查时间段是否已被其他人预约（见availability.py），已被预约时换下一个备选，
+        都已被预约时记录事件并返回False
+
+        取不到日历时返回True
+        """
+        if config.AVAILABILITY_MODE == 'off':
+            return True
+        while True:
+            status, conflict = AvailabilityCache().check(self.reserve_data, config.AVAILABILITY_PRE_TRIGGER_MAX_AGE)
+            if status != TAKEN:
+                return True
+            if not self.next_alternative('时间段已被预约（%s）' % conflict):
+                break
+        self.dropped = True
+        self._event('dropped', reason='时间段已被预约', conflict=conflict)
+        metrics.reserve_jobs.inc(result='dropped')
+        return False
+
     def keep_reserve(self):
         """reserve many times until success or exceed max try time
 
         :return: return True if reserve successfully else False
         """
+        if not self.warm_up():
+            return False
+        return self.fire()
+
+    def warm_up(self):
+        """预热阶段：登录并保持会话可用，预约时间到时直接提交
 
+        :return: 登录成功返回True，否则False
+        """
         try:
-            self.login()
+            return self.login()
         except HTTPError as e:
             return False
         except Exception as e:
             logging.exception(e)
             return False
 
-        log_str = 'reserve date: %s time: %s-%s' % (
-                  self.reserve_data['reserveDate'],
-                  self.reserve_data['reserveStartTime'],
-                  self.reserve_data['reserveEndTime'])
+    def fire(self, trigger_time=None):
+        """提交阶段，见`_fire`，并记录尝试次数、触发延迟等指标"""
+        success = self._fire(trigger_time)
+        self._fire_done(trigger_time, success)
+        return success
+
+    def _fire_done(self, trigger_time, success):
+        metrics.reserve_jobs.inc(result='success' if success else 'failure')
+        if self.attempts:
+            metrics.reserve_attempts.observe(self.attempts)
+        if trigger_time is not None and self.first_post_at is not None:
+            target = ServerClock().to_local(trigger_time)
+            metrics.trigger_lateness_seconds.observe((self.first_post_at - target).total_seconds())
+
+    def _fire(self, trigger_time=None):
+        """提交阶段：到trigger_time时多次提交预约请求直到成功或超过最大尝试次数
+
+        仪器设置了burst时先在trigger_time附近并发提交，失败后再逐次尝试；
+        会话失效（超时或被重定向到登录页面）时在此处重新登录；
+        提交前构造好请求，用PreciseTimer等待到提交时间，释放误差记录在self.release_error
+
+        :param datetime.datetime trigger_time: 开始预约的（服务器）时间，None表示立即提交
+        :return: return True if reserve successfully else False
+        """
+        if trigger_time is not None:
+            # 按服务器时钟偏差和单程延迟换算成本地发出请求的时间，再按批处理中的名次错开
+            trigger_time = ServerClock().to_local(trigger_time) + datetime.timedelta(seconds=self.release_offset())
+        burst = self.get_burst() if trigger_time is not None else None
+        if trigger_time is not None:
+            # 开始预约前预先建立连接，并发提交时每次提交一个连接
+            wait_until(trigger_time - datetime.timedelta(seconds=config.HTTP_PRE_OPEN_SECONDS))
+            try:
+                self.client.pre_open(self.reserve_url, len(burst_offsets(burst)) or 1)
+            except Exception as e:
+                logging.warning('pre-open connections failed: %s' % e)
+        if not self.session_valid():
+            self._event('relogin', reason='session expired before reserve')
+            if not self.warm_up():
+                return False
+        self.prepare()
+        if burst is None and trigger_time is not None:
+            self.release_error = PreciseTimer().wait(trigger_time.timestamp())
+
+        if burst is not None:
+            done = self._burst_done(self.burst_reserve(trigger_time, burst))
+            if done is not None:
+                return done
 
+        backoff_count = 0
         for i in range(config.TRY_TIME):
             try:
                 reserve_result = self._reserve()
+            except Exception as e:
+                action, reason = self._attempt_failed('sequential', i + 1, error=e)
+            else:
                 if reserve_result.get('status'):
-                    logging.info('reserve success! %s' % log_str)
+                    self._event('success', mode='sequential', attempt=i + 1, release_error=self.release_error)
                     return True
-                else:
-                    logging.info('reserve failed no.%d, error message:%s %s' % (
-                        i + 1, reserve_result.get('msg'), log_str))
-            except Exception as e:
-                logging.exception(e)
+                action, reason = self._attempt_failed('sequential', i + 1, reserve_result)
+            if action == ABORT:
+                if self.next_alternative(reason):
+                    continue
+                self._event('failed', reason=reason, attempts=self.attempts)
+                return False
+            if action == RELOGIN and self.warm_up():
+                continue
             if i < config.TRY_TIME - 1:
-                sleep(config.INTERVAL)
-        else:
-            logging.warning('超过最大尝试次数，预约失败！%s' % log_str)
+                sleep(self.retry_policy.delay(action, backoff_count))
+                if action == BACKOFF:
+                    backoff_count += 1
+        self._event('failed', reason='超过最大尝试次数', attempts=self.attempts)
         return False
 
+    def _burst_done(self, burst_result):
+        """处理并发提交的结果：成功返回True，不可恢复的失败返回False，
+        需要继续逐次尝试（包括不可恢复的失败但还有备选）返回None"""
+        if burst_result.get('status'):
+            self._event('success', mode='burst', attempt=burst_result['attempt'],
+                        latency=burst_result['latency'], release_error=self.release_error)
+            return True
+        self._event('burst_failed', sent=burst_result['sent'])
+        if burst_result.get('abort'):
+            if self.next_alternative(burst_result['abort']):
+                return None
+            # 时间段已被预约等不可恢复的失败，不再逐次尝试
+            self._event('failed', reason=burst_result['abort'], attempts=self.attempts)
+            return False
+        return None
+
+    def _attempt_failed(self, mode, no, reserve_result=None, error=None):
+        """记录一次没有成功的提交，按重试策略分类
+
+        :param str mode: 'sequential'或'burst'
+        :param int no: 第几次提交
+        :param dict reserve_result: `_reserve`的返回值
+        :param Exception error: 提交时的异常
+        :return: (动作, 失败原因)
+        """
+        if error is None:
+            reason = reserve_result.get('msg')
+            action = self.retry_policy.classify_result(reason)
+            self._event('attempt', mode=mode, attempt=no, msg=reason, action=action)
+            return action, reason
+        reason = str(error)
+        action = self.retry_policy.classify_exception(error)
+        if action == RELOGIN and mode == 'sequential':
+            self._event('relogin', attempt=no, reason=reason)
+        else:
+            self._event('attempt', mode=mode, attempt=no, error=reason, action=action)
+            if mode == 'sequential' and action != RELOGIN:
+                logging.error(reason, exc_info=error)
+        return action, reason
+
+    def _event(self, event, **fields):
+        """记录一条预约事件，附带帐号和预约信息（不含密码）"""
+        event_log.emit(event, username=self.username,
+                       instrumentId=self.reserve_data.get('instrumentId'),
+                       reserveDate=self.reserve_data.get('reserveDate'),
+                       reserveStartTime=self.reserve_data.get('reserveStartTime'),
+                       reserveEndTime=self.reserve_data.get('reserveEndTime'), **fields)
+
+    def get_burst(self):
+        """预约仪器的burst设置，仪器不存在、未设置或没有要发送的提交时返回None；
+        设置了名次时按名次减少并发次数"""
+        burst = burst_of(self.reserve_data, self.assignment)
+        if self.assignment is not None:
+            self.assignment.burst_count = burst['count'] if burst else None
+        return burst
+
+    def burst_reserve(self, trigger_time, burst):
+        """在trigger_time附近并发提交多次预约，第一次成功后取消其余还未发出的提交
+
+        每次提交使用连接池中单独的连接，共享已登录的cookie；
+        有一次提交的失败属于重试策略中的ABORT（如时间段已被预约）时，其余还未发出的提交也取消
+
+        :param datetime.datetime trigger_time: 开始预约的时间
+        :param dict burst: 并发设置，见resources.instruments
+        :return: dict status=True/False 是否预约成功，
+                attempt 成功的是第几次提交，
+                latency 成功的提交在trigger_time之后多少秒返回，
+                sent 实际发出的提交次数，
+                abort 不可恢复的失败原因，没有则为None
+        """
+        first = trigger_time - datetime.timedelta(seconds=burst['window'] / 2)
+        offsets = burst_offsets(burst)
+        won = threading.Event()  # 成功或不可恢复的失败后set，取消其余的提交
+        lock = threading.Lock()
+        result = dict(status=False, attempt=None, latency=None, sent=0, abort=None)
+        if not offsets:
+            return result
+
+        def abort(reason):
+            with lock:
+                if not won.is_set():
+                    won.set()
+                    result['abort'] = reason
+
+        def attempt(no, release_time):
+            error = PreciseTimer().wait(release_time.timestamp(), won)
+            if error is None:
+                return
+            if no == 1:
+                self.release_error = error
+            with lock:
+                result['sent'] += 1
+            try:
+                reserve_result = self._reserve()
+            except Exception as e:
+                reserve_result, error = None, e
+            else:
+                error = None
+            if error is not None or not reserve_result.get('status'):
+                action, reason = self._attempt_failed('burst', no, reserve_result, error)
+                if action == ABORT:
+                    abort(reason)
+                return
+            with lock:
+                # 已经在途的提交仍可能成功，即使其他提交判定为不可恢复
+                if not result['status']:
+                    won.set()
+                    result.update(status=True, abort=None, attempt=no,
+                                  latency=(datetime.datetime.now() - trigger_time).total_seconds())
+
+        with ThreadPoolExecutor(max_workers=len(offsets)) as executor:
+            for i, offset in enumerate(offsets):
+                executor.submit(attempt, i + 1, first + datetime.timedelta(seconds=offset))
+        return result
+
+    def _job_spec(self, reserve_data, reserve_time, alternatives=None):
+        """定时任务的(job_id, func, run_date, kwargs, summary)
+
+        run_date为None，由scheduler按它自己校准的服务器时钟换算，并提前触发，留出登录预热的时间
+        （web进程与scheduler进程分开时，web进程的时钟没有校准）；
+        kwargs中记录用户的优先级（`config.USER_PRIORITIES`）和设定的时间，批处理时用来排序；
+        同时生成列出任务时使用的JobSummary
+        """
+        job_id = uuid4().hex
+        return job_id, keep_reserve_job, None, dict(
+            username=self.username, password=self.password, reserve_data=reserve_data,
+            trigger_time=reserve_time, priority=config.USER_PRIORITIES.get(self.username, 0),
+            submitted_at=time(), alternatives=list(alternatives or [])), JobSummary(
+            job_id, self.username, reserve_data, reserve_time, alternatives)
+
+    def check_account(self):
+        """验证帐号（debug时不验证），结果保存在account_checked，之后设定任务时不再重复验证
+
+        :return: 帐号是否正确
+        """
+        if not self.username:
+            raise ReserveException('must set account before set job')
+        if config.debug:
+            return True
+        if self.account_checked is None:
+            cached = AuthCache().get(self.username, self.password)
+            if cached is None:
+                self.login()
+            else:
+                self.account_checked = cached
+        return self.account_checked
+
     def set_job(self, reserve_time):
         """设置预约定时任务
 
@@ -179,14 +612,20 @@ class ReserveTem(object):
             raise ReserveException('must set account before set job')
         if self.reserve_data == {}:
             raise ReserveException('must set reserve data before set job')
-        if config.debug:
-            checked = True
-        else:
-            if self.account_checked is None:
-                self.login()
-            checked = self.account_checked
-        if checked:
-            job = self.scheduler.add_job(keep_reserve_job, 'date', run_date=reserve_time, kwargs=dict(
-                username=self.username, password=self.password, reserve_data=self.reserve_data))
-            return job
+        if self.check_account():
+            job_id, func, run_date, kwargs, summary = self._job_spec(self.reserve_data, reserve_time, self.alternatives)
+            return self.scheduler.add_job(func, 'date', id=job_id, run_date=run_date, kwargs=kwargs, summary=summary)
         return None
+
+    def set_jobs(self, reservations):
+        """批量设置同一帐号的预约定时任务，帐号只验证一次，所有任务在一个事务中写入
+
+        必须先调用`set_account()`
+
+        :param list reservations: [(reserve_data, reserve_time, alternatives)]
+        :return: list of apscheduler.job.Job，帐号错误时返回None
+        """
+        if not self.check_account():
+            return None
+        return self.scheduler.add_jobs([self._job_spec(reserve_data, reserve_time, alternatives)
+                                        for reserve_data, reserve_time, alternatives in reservations])
@@ -1,22 +1,30 @@
 import datetime
 
+# burst: 开始预约时并发提交的设置，为None时只按顺序逐次尝试
+#   count: 并发提交的次数
+#   spacing: 相邻两次提交的间隔（秒）
+#   window: 提交分布的时间窗口（秒），以开始预约时间为中心，超出窗口的提交不发送
+
 instruments = [
     dict(
         name='OLD_F20',
         cn_name='场发射透射电镜F20-118（老F20）',
         instrument_id='28ad18ae3ebb4f91b1d52553019ca381',
         reserve_weekday=5,
-        reserve_time=datetime.time(hour=12)
+        reserve_time=datetime.time(hour=12),
+        burst=dict(count=6, spacing=0.1, window=0.6)
     ), dict(
         name='NEW_F20',
         cn_name='场发射透射电镜F20-112（新F20）',
         instrument_id='563e690aae7b41dfb6da1880f291e65b',
         reserve_weekday=5,
-        reserve_time=datetime.time(hour=12)
+        reserve_time=datetime.time(hour=12),
+        burst=dict(count=6, spacing=0.1, window=0.6)
     ), dict(
         name='FIB',
         cn_name='双束聚焦微纳加工仪FIB',
         instrument_id='23ba4d2d9470434a905b4049ef457648',
         reserve_weekday=0,
-        reserve_time=datetime.time(hour=8)
+        reserve_time=datetime.time(hour=8),
+        burst=dict(count=3, spacing=0.2, window=0.6)
     )]
@@ -0,0 +1,69 @@
+import socket
+from urllib.error import HTTPError, URLError
+
+from config import config
+from errors import SessionExpiredException
+
+# 重试动作
+RETRY_NOW = 'retry_now'  # 立即重试，如预约还未开放
+BACKOFF = 'backoff'  # 指数退避后重试，如服务器500错误
+RELOGIN = 'relogin'  # 重新登录后立即重试，如会话失效
+ABORT = 'abort'  # 不再重试，如时间段已被预约、帐号无权预约
+
+ACTIONS = (RETRY_NOW, BACKOFF, RELOGIN, ABORT)
+
+
+class RetryPolicy(object):
+    """根据“易约”返回的errorCode或HTTP错误决定如何重试
+
+    分类表默认取自config：
+        RETRY_RULES: [(errorCode中包含的文字, 动作)]，按顺序匹配第一条
+        RETRY_HTTP_RULES: {HTTP状态码: 动作}
+        RETRY_DEFAULT: 都不匹配时的动作
+
+    可以传入自己的分类表，或继承后重写classify_result/classify_exception/delay
+    """
+
+    def __init__(self, rules=None, http_rules=None, default=None):
+        self.rules = list(config.RETRY_RULES if rules is None else rules)
+        self.http_rules = dict(config.RETRY_HTTP_RULES if http_rules is None else http_rules)
+        self.default = default or config.RETRY_DEFAULT
+        for action in [a for _, a in self.rules] + list(self.http_rules.values()) + [self.default]:
+            if action not in ACTIONS:
+                raise ValueError('unknown retry action: %s' % action)
+
+    def classify_result(self, msg):
+        """预约失败时服务器返回的errorCode对应的动作"""
+        for keyword, action in self.rules:
+            if keyword in (msg or ''):
+                return action
+        return self.default
+
+    def known_code(self, msg):
+        """errorCode匹配的分类规则中的文字，都不匹配时为'other'；取值有限，用作指标的标签"""
+        for keyword, action in self.rules:
+            if keyword in (msg or ''):
+                return keyword
+        return 'other'
+
+    def classify_exception(self, e):
+        """请求异常对应的动作"""
+        if isinstance(e, SessionExpiredException):
+            return RELOGIN
+        if isinstance(e, HTTPError):
+            return self.http_rules.get(e.code, BACKOFF if e.code >= 500 else ABORT)
+        if isinstance(e, (URLError, socket.timeout, ConnectionError, OSError)):
+            return BACKOFF
+        return self.default
+
+    def delay(self, action, backoff_count=0):
+        """下一次重试前等待的秒数
+
+        :param str action: 动作
+        :param int backoff_count: 之前已经退避的次数
+        """
+        if action == BACKOFF:
+            return min(config.RETRY_BACKOFF_BASE * 2 ** backoff_count, config.RETRY_BACKOFF_MAX)
+        if action == RETRY_NOW:
+            return config.RETRY_NOW_DELAY
+        return 0
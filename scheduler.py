@@ -1,41 +1,472 @@
+import os
+import fcntl
+import datetime
+import threading
+from uuid import uuid4
+from collections import defaultdict
+
 from config import config
+from clock import calibrate_job, ServerClock
+from availability import refresh_job as availability_job
+from jobstore import ReserveJobStore, RESERVE_DATE_FORMAT, sqlite_path
+from job_summary import JobSummary
+from errors import SchedulerException
+from interval_index import IntervalIndex
+from apscheduler.job import Job
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.schedulers.base import STATE_STOPPED
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.events import JobEvent, EVENT_JOB_ADDED, EVENT_JOB_REMOVED, EVENT_ALL_JOBS_REMOVED, EVENT_JOB_SUBMITTED
+
+
+class ReserveScheduler(BackgroundScheduler):
+    """BackgroundScheduler加上一次写入多个任务"""
+
+    def add_jobs(self, jobs, jobstore='default'):
+        """把构造好的任务在jobstore的一个事务中写入，与add_job一样通知监听者（EVENT_JOB_ADDED）并唤醒scheduler
+
+        :param list jobs: apscheduler.job.Job的列表
+        :param str jobstore: jobstore的别名，jobstore需要支持add_jobs（ReserveJobStore）
+        """
+        with self._jobstores_lock:
+            self._lookup_jobstore(jobstore).add_jobs(jobs)
+        for job in jobs:
+            self._dispatch_event(JobEvent(EVENT_JOB_ADDED, job.id, jobstore))
+        self.wakeup()
 
 
 class SchedulerHandler(object):
+    """scheduler的单例封装
+
+    维护用户任务的索引：用户名 -> job id，(仪器id, 实验日期) -> job id，开始预约时间 -> job id，
+    添加任务时写入，任务被删除或执行完（date任务执行时会被scheduler删除）时通过事件移除，
+    所以按用户查询、删除任务只需读取该用户自己的任务，而不用把所有任务都反序列化一遍
+
+    开始预约时间相同的任务合并成一批：每个开始预约时间对应一个内存中的批处理任务，
+    比这些任务更早触发，在jobstore中认领这些任务后一起执行，每个任务执行完后才删除，见batch.py
+
+    任务列表变化时增加版本号，列表没有变化时API可以不读取jobstore，见`get_version`；
+    列出任务时使用缓存的JobSummary，与索引一起维护
+
+    各任务的实验时间段也按(仪器id, 实验日期)建立区间索引（interval_index.py），
+    用于发现我们自己的任务之间时间重叠，见`get_conflicts`
+
+    启动时对jobstore加文件锁，同一个jobstore只能有一个scheduler在执行任务；
+    `config.SCHEDULER_MODE = 'remote'`时只在scheduler进程中启动，web进程通过`get_handler`
+    得到转发给scheduler进程的RemoteSchedulerHandler（见scheduler_service.py）
+    """
     _instance = None
-    scheduler = BackgroundScheduler()
+    scheduler = ReserveScheduler(job_defaults=config.JOB_DEFAULTS)
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = object.__new__(cls)
-            cls.scheduler.add_jobstore('sqlalchemy', url=config.SCHEDULER_STORE_URL)
+            cls._instance.store = ReserveJobStore(url=config.SCHEDULER_STORE_URL,
+                                                   pool_size=config.JOBSTORE_POOL_SIZE)
+            cls.scheduler.add_jobstore(cls._instance.store)
+            # 程序内部的定时任务，不持久化，也不出现在用户的任务列表中
+            cls.scheduler.add_jobstore('memory', alias='memory')
+            cls._instance.index_lock = threading.RLock()
+            cls._instance.user_jobs = defaultdict(set)  # username -> {job_id}
+            cls._instance.slot_jobs = defaultdict(set)  # (instrument_id, reserveDate) -> {job_id}
+            cls._instance.trigger_jobs = defaultdict(set)  # trigger_time -> {job_id}
+            cls._instance.job_keys = {}  # job_id -> (username, (instrument_id, reserveDate), trigger_time)
+            cls._instance.summaries = {}  # job_id -> JobSummary，列出任务时按需从jobstore的列生成
+            cls._instance.intervals = IntervalIndex()  # (instrument_id, reserveDate) -> 实验时间段
+            # 任务列表的版本：任务添加、删除、执行（date任务执行后被删除）时增加，用于/api/scheduled_jobs的ETag；
+            # 每个用户记录自己的任务最后一次变化时的版本，boot_id区分重启前后的版本
+            cls._instance.boot_id = uuid4().hex[:8]
+            cls._instance.version = 0
+            cls._instance.user_versions = {}
+            cls._instance.cleared_version = 0
+            cls.scheduler.add_listener(cls._instance._on_job_event, EVENT_JOB_REMOVED | EVENT_ALL_JOBS_REMOVED)
+            cls._instance.lock_file = None
+            # 启动时在后台建立索引，完成前依赖完整索引的查询等待
+            cls._instance.index_ready = threading.Event()
+            cls._instance.index_ready.set()
         return cls._instance
 
+    def _acquire_lock(self):
+        """对jobstore加排他的文件锁，直到进程退出；内存中的jobstore不加锁
+
+        :raise SchedulerException: 已有另一个scheduler在使用这个jobstore
+        """
+        path = config.SCHEDULER_LOCK_FILE
+        if path is None:
+            store_path = sqlite_path(config.SCHEDULER_STORE_URL)
+            if store_path == ':memory:':
+                return
+            path = store_path + '.lock'
+        lock_file = open(path, 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.seek(0)
+            owner = lock_file.read().strip()
+            lock_file.close()
+            raise SchedulerException('another scheduler (pid %s) is running on %s' % (owner or '?', path))
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self.lock_file = lock_file
+
     def start(self):
-        return self.scheduler.start()
+        """启动scheduler，重启时尽快执行错过的和即将触发的任务：
+
+        1. 加锁，暂停状态启动scheduler，处理重启期间错过触发时间的任务和已认领但没有执行完的任务（recovery.catch_up），
+           宽限时间内的立即并行执行，不再按misfire跳过
+        2. 只为`config.RESTART_PRELOAD_SECONDS`秒内触发的任务建立索引、设置批处理任务，开始执行任务
+        3. 其余任务的索引在后台线程中建立，完成前依赖完整索引的查询会等待
+        """
+        if self.lock_file is None:
+            self._acquire_lock()
+        # 用到时才导入
+        import recovery
+        result = self.scheduler.start(paused=True)
+        recovery.catch_up(self.store, finish=self.finish_trigger_job)
+        self.index_ready.clear()
+        preloaded = self._load_index(
+            datetime.datetime.now().astimezone() + datetime.timedelta(seconds=config.RESTART_PRELOAD_SECONDS))
+        self.scheduler.add_listener(self._on_job_submitted, EVENT_JOB_SUBMITTED)
+        self.scheduler.resume()
+        recovery.mark('ready')
+        threading.Thread(target=self._load_remaining_index, args=(preloaded,), name='load-index', daemon=True).start()
+        self.scheduler.add_job(calibrate_job, 'interval', seconds=config.CLOCK_CALIBRATE_INTERVAL,
+                               next_run_time=datetime.datetime.now(), id='clock_calibrate',
+                               jobstore='memory', replace_existing=True)
+        if config.AVAILABILITY_MODE != 'off' and config.AVAILABILITY_USERNAME:
+            self.scheduler.add_job(availability_job, 'interval', seconds=config.AVAILABILITY_REFRESH_INTERVAL,
+                                   next_run_time=datetime.datetime.now(), id='availability_refresh',
+                                   jobstore='memory', replace_existing=True)
+        self.scheduler.add_job('recurring:materialize_job', 'interval', seconds=config.RECURRING_MATERIALIZE_INTERVAL,
+                               next_run_time=datetime.datetime.now(), id='recurring_materialize',
+                               jobstore='memory', replace_existing=True)
+        return result
+
+    def _bump_version(self, username=None):
+        with self.index_lock:
+            self.version += 1
+            if username is None:
+                # 所有用户的任务都可能变了
+                self.user_versions.clear()
+                self.cleared_version = self.version
+            else:
+                self.user_versions[username] = self.version
+
+    def get_version(self, username):
+        """用户任务列表的版本，版本不变说明任务列表没有变化；管理员为所有任务的版本
+
+        :return: str
+        """
+        with self.index_lock:
+            if username == config.ADMIN_USERNAME:
+                version = self.version
+            else:
+                version = max(self.user_versions.get(username, 0), self.cleared_version)
+        return '%s-%d' % (self.boot_id, version)
+
+    def _clear_index(self):
+        with self.index_lock:
+            self._bump_version()
+            self.summaries.clear()
+            self.user_jobs.clear()
+            self.slot_jobs.clear()
+            self.trigger_jobs.clear()
+            self.job_keys.clear()
+            self.intervals.clear()
+
+    def _load_index(self, next_run_before=None, scheduled=()):
+        """根据jobstore中已有的任务建立索引，只读取jobstore的索引列和JSON格式的kwargs，不反序列化任务，
+        并为这些任务设置批处理任务
+
+        :param datetime.datetime next_run_before: 只加载在此之前触发的任务，并清空原有的索引；
+                None表示加载所有任务，已有的索引保留
+        :param scheduled: 已经设置了批处理任务的开始预约时间，不再重新设置
+        :return: 设置了批处理任务的开始预约时间的集合
+        """
+        store = self.store
+        with self.index_lock:
+            if next_run_before is not None:
+                self._clear_index()
+            rows = store.get_index_rows(next_run_before)
+            for job_id, username, instrument_id, experiment_date, trigger_time in rows:
+                if username is None:
+                    continue
+                reserve_date = (datetime.datetime.strptime(experiment_date, '%Y-%m-%d').strftime(RESERVE_DATE_FORMAT)
+                                if experiment_date else None)
+                self._index_keys(job_id, username, (instrument_id, reserve_date), trigger_time)
+            for job_id, kwargs, _ in store.get_summary_rows(
+                    [row[0] for row in rows] if next_run_before is not None else None):
+                if job_id in self.job_keys:
+                    self._index_interval(job_id, kwargs)
+            triggers = set(row[4] for row in rows if row[1] is not None and row[4] is not None)
+        for trigger_time in triggers - set(scheduled):
+            self._schedule_batch(trigger_time)
+        return triggers
+
+    def _load_remaining_index(self, scheduled):
+        import recovery
+        try:
+            self._load_index(scheduled=scheduled)
+        finally:
+            self.index_ready.set()
+        recovery.mark('indexed')
+
+    def _wait_index(self):
+        self.index_ready.wait()
+
+    def _on_job_submitted(self, event):
+        if event.jobstore == 'default' or event.job_id.startswith('batch-'):
+            import recovery
+            recovery.mark('first_fire')
+
+    def _index_add(self, job_id, kwargs):
+        username = kwargs.get('username')
+        if username is None:
+            return
+        reserve_data = kwargs.get('reserve_data', {})
+        slot = (reserve_data.get('instrumentId'), reserve_data.get('reserveDate'))
+        with self.index_lock:
+            self._index_keys(job_id, username, slot, kwargs.get('trigger_time'))
+            self._index_interval(job_id, kwargs)
+
+    def _index_interval(self, job_id, kwargs):
+        # 主时间段和备选时间段都要索引，备选时间段可能是另一仪器、另一实验日期
+        windows = [kwargs.get('reserve_data') or {}] + list(kwargs.get('alternatives') or [])
+        self.intervals.add(job_id, [((data.get('instrumentId'), data.get('reserveDate')),
+                                     data.get('reserveStartTime'), data.get('reserveEndTime')) for data in windows])
+
+    def _index_keys(self, job_id, username, slot, trigger_time):
+        with self.index_lock:
+            self.user_jobs[username].add(job_id)
+            self.slot_jobs[slot].add(job_id)
+            if trigger_time is not None:
+                self.trigger_jobs[trigger_time].add(job_id)
+            self.job_keys[job_id] = (username, slot, trigger_time)
+            self._bump_version(username)
+
+    def _index_remove(self, job_id):
+        with self.index_lock:
+            self.summaries.pop(job_id, None)
+            self.intervals.remove(job_id)
+            keys = self.job_keys.pop(job_id, None)
+            if keys is None:
+                return
+            username, slot, trigger_time = keys
+            self._bump_version(username)
+            for index, key in ((self.user_jobs, username), (self.slot_jobs, slot),
+                               (self.trigger_jobs, trigger_time)):
+                if key in index:
+                    index[key].discard(job_id)
+                    if not index[key]:
+                        del index[key]
+
+    def _on_job_event(self, event):
+        if event.code == EVENT_ALL_JOBS_REMOVED:
+            if event.alias in (None, 'default'):
+                self._clear_index()
+        elif event.jobstore == 'default':
+            self._index_remove(event.job_id)
+
+    @staticmethod
+    def _run_date_of(trigger_time, lead=0):
+        """开始预约时间为trigger_time（服务器时间）的任务在本地的触发时间
+
+        按本进程（scheduler进程）校准的服务器时钟换算，提前预热时间和lead秒，已经过了的为现在
+        """
+        run_date = ServerClock().to_local(trigger_time) - datetime.timedelta(seconds=config.WARMUP_SECONDS + lead)
+        return max(run_date, datetime.datetime.now())
+
+    def _schedule_batch(self, trigger_time):
+        """为开始预约时间为trigger_time的任务设置批处理任务，已存在时更新触发时间
 
-    def add_job(self, *args, **kwargs):
-        return self.scheduler.add_job(*args, **kwargs)
+        批处理任务比任务本身（预热时间）再提前`config.BATCH_PREPARE_SECONDS`秒触发
+        """
+        if self.scheduler.state == STATE_STOPPED:
+            # 启动时会根据索引统一设置
+            return
+        run_date = self._run_date_of(trigger_time, config.BATCH_PREPARE_SECONDS)
+        self.scheduler.add_job('batch:run_batch_job', 'date', run_date=run_date,
+                               kwargs=dict(trigger_time=trigger_time),
+                               id='batch-%s' % trigger_time.strftime('%Y%m%d%H%M%S%f'),
+                               jobstore='memory', replace_existing=True, misfire_grace_time=None)
+
+    def _cache_summary(self, summary):
+        with self.index_lock:
+            # 任务可能已经执行完被删除了
+            if summary.job_id in self.job_keys:
+                self.summaries[summary.job_id] = summary
+
+    def add_job(self, *args, summary=None, **kwargs):
+        """添加任务，参数与BackgroundScheduler.add_job相同
+
+        :param JobSummary summary: 预约任务的信息，用于列出任务
+
+        预约任务（kwargs中有trigger_time）没有给出run_date时，按scheduler进程校准的时钟计算
+        """
+        trigger_time = (kwargs.get('kwargs') or {}).get('trigger_time')
+        if kwargs.get('run_date') is None and trigger_time is not None:
+            kwargs['run_date'] = self._run_date_of(trigger_time)
+        job = self.scheduler.add_job(*args, **kwargs)
+        if kwargs.get('jobstore', 'default') == 'default':
+            self._index_add(job.id, job.kwargs)
+            if summary is not None:
+                self._cache_summary(summary)
+            if job.kwargs.get('trigger_time') is not None:
+                self._schedule_batch(job.kwargs['trigger_time'])
+        return job
+
+    def add_jobs(self, job_specs):
+        """批量添加date任务，在jobstore的一个事务中写入
+
+        :param list job_specs: [(job_id, func, run_date, kwargs, summary)]，
+                run_date为None时按kwargs中的trigger_time计算，见`add_job`
+        :return: list of apscheduler.job.Job
+        """
+        if self.scheduler.state == STATE_STOPPED:
+            # scheduler启动前任务只是暂存，没有写入jobstore
+            return [self.add_job(func, 'date', id=job_id, run_date=run_date, kwargs=kwargs, summary=summary)
+                    for job_id, func, run_date, kwargs, summary in job_specs]
+
+        now = datetime.datetime.now(self.scheduler.timezone)
+        jobs = []
+        for job_id, func, run_date, kwargs, summary in job_specs:
+            if run_date is None:
+                run_date = self._run_date_of(kwargs['trigger_time'])
+            trigger = DateTrigger(run_date=run_date, timezone=self.scheduler.timezone)
+            jobs.append(Job(self.scheduler, id=job_id, func=func, trigger=trigger, executor='default',
+                            args=(), kwargs=kwargs, next_run_time=trigger.get_next_fire_time(None, now),
+                            **config.JOB_DEFAULTS))
+        self.scheduler.add_jobs(jobs)
+        for job, spec in zip(jobs, job_specs):
+            self._index_add(job.id, job.kwargs)
+            if spec[4] is not None:
+                self._cache_summary(spec[4])
+        for trigger_time in set(job.kwargs['trigger_time'] for job in jobs
+                                if job.kwargs.get('trigger_time') is not None):
+            self._schedule_batch(trigger_time)
+        return jobs
+
+    def take_trigger_jobs(self, trigger_time):
+        """认领开始预约时间为trigger_time的所有任务，由批处理任务执行
+
+        任务仍留在jobstore中，只标记为已认领，scheduler不再单独触发；
+        批处理执行完每个任务后调用`finish_trigger_job`删除，在这之前进程退出的话，重启时由recovery.catch_up重新执行
+
+        :return: list of apscheduler.job.Job
+        """
+        with self.index_lock:
+            job_ids = set(self.trigger_jobs.get(trigger_time, ()))
+        # 已经单独触发执行了、或已被另一批认领的任务不再取出
+        claimed = set(self.store.claim_jobs(job_ids))
+        return [job for job in self._get_jobs_by_ids(job_ids) if job.id in claimed]
+
+    def finish_trigger_job(self, job_id):
+        """已认领的任务执行完，从jobstore中删除"""
+        try:
+            self.scheduler.remove_job(job_id, jobstore='default')
+        except JobLookupError:
+            # 执行期间被用户删除了
+            pass
+
+    def clock_status(self):
+        """预约任务使用的（本进程的）服务器时钟的校准状态，见ServerClock.status"""
+        return ServerClock().status()
+
+    def metrics_exposition(self):
+        """本进程的指标（登录、预约、触发延迟等），Prometheus文本格式"""
+        # 用到时才导入
+        import metrics
+        return metrics.registry.expose()
+
+    def get_user_job_ids(self, username):
+        self._wait_index()
+        with self.index_lock:
+            return set(self.user_jobs.get(username, ()))
+
+    def get_slot_job_ids(self, instrument_id, reserve_date):
+        """某仪器某实验日期（'%Y年%m月%d日'格式）的所有任务id"""
+        self._wait_index()
+        with self.index_lock:
+            return set(self.slot_jobs.get((instrument_id, reserve_date), ()))
+
+    def get_conflicts(self, reserve_data):
+        """已设定的任务中，与reserve_data同一仪器、同一实验日期且实验时间重叠的任务时间段（含备选时间段）
+
+        :param dict reserve_data: 预约POST请求提交的数据
+        :return: list of (开始分钟, 结束分钟, job_id, username, window)，按开始时间排序，
+                 window是任务的第几个时间段重叠：0为主时间段，i为第i个备选时间段
+        """
+        slot = (reserve_data.get('instrumentId'), reserve_data.get('reserveDate'))
+        self._wait_index()
+        with self.index_lock:
+            return [(start, end, job_id, self.job_keys[job_id][0], window)
+                    for start, end, job_id, window in self.intervals.overlapping(
+                        slot, reserve_data.get('reserveStartTime'), reserve_data.get('reserveEndTime'))
+                    if job_id in self.job_keys]
+
+    def get_slot_intervals(self, instrument_id, reserve_date):
+        """某仪器某实验日期（'%Y年%m月%d日'格式）所有任务的实验时间段（含备选时间段）
+
+        :return: list of (开始分钟, 结束分钟, job_id, username, window)，按开始时间排序，window见`get_conflicts`
+        """
+        self._wait_index()
+        with self.index_lock:
+            return [(start, end, job_id, self.job_keys[job_id][0], window)
+                    for start, end, job_id, window in self.intervals.intervals((instrument_id, reserve_date))
+                    if job_id in self.job_keys]
+
+    def _get_jobs_by_ids(self, job_ids):
+        if self.scheduler.state == STATE_STOPPED:
+            jobs = [self.scheduler.get_job(job_id, jobstore='default') for job_id in job_ids]
+            jobs = [job for job in jobs if job is not None]
+        else:
+            # 按主键一次读取
+            jobs = self.store.lookup_jobs(job_ids)
+        found = set(job.id for job in jobs)
+        for job_id in set(job_ids) - found:
+            # 添加后立即执行完的任务，事件可能先于索引写入
+            self._index_remove(job_id)
+        return jobs
 
     def get_jobs(self, username):
-        all_jobs = self.scheduler.get_jobs()
         if username == config.ADMIN_USERNAME:
-            jobs = all_jobs
-        else:
-            # TODO: 把job_id添加到用户下存储
-            jobs = []
-            for job in all_jobs:
-                if job.kwargs['username'] == username:
-                    jobs.append(job)
+            return self.scheduler.get_jobs(jobstore='default')
+        jobs = self._get_jobs_by_ids(self.get_user_job_ids(username))
+        jobs.sort(key=lambda job: (job.next_run_time is None, job.next_run_time or 0, job.id))
         return jobs
 
+    def query_summaries(self, username, limit=None, cursor=None, **filters):
+        """按条件查询用户的任务（管理员为所有任务），在jobstore中按索引列筛选、分页，返回缓存的JobSummary
+
+        :param str username: 用户名
+        :param int limit: 每页的任务数，None表示全部
+        :param tuple cursor: 上一页返回的游标
+        :param filters: instrument_id, date_from, date_to, trigger_from, trigger_to，见ReserveJobStore.query_job_ids
+        :return: (list of JobSummary, 下一页的游标)，没有下一页时游标为None
+        """
+        store = self.store
+        rows = store.query_job_ids(username=None if username == config.ADMIN_USERNAME else username,
+                                   after=cursor, limit=None if limit is None else limit + 1, **filters)
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][1]
+        job_ids = [job_id for job_id, _ in rows]
+        with self.index_lock:
+            summaries = {job_id: self.summaries.get(job_id) for job_id in job_ids}
+        missing = [job_id for job_id, summary in summaries.items() if summary is None]
+        if missing:
+            for job_id, kwargs, trigger_time in store.get_summary_rows(missing):
+                summary = summaries[job_id] = JobSummary.from_kwargs(job_id, kwargs, trigger_time)
+                self._cache_summary(summary)
+        return [summaries[job_id] for job_id in job_ids if summaries[job_id] is not None], next_cursor
+
     def get_job(self, job_id, username):
-        job = self.scheduler.get_job(job_id)
-        if username == config.ADMIN_USERNAME or job.kwargs['username'] == username:
-            return job
-        else:
+        if username != config.ADMIN_USERNAME and job_id not in self.get_user_job_ids(username):
             return None
+        return self.scheduler.get_job(job_id, jobstore='default')
 
     def remove_job(self, job_id, username):
         job = self.get_job(job_id, username)
@@ -47,8 +478,21 @@ class SchedulerHandler(object):
 
     def remove_all_jobs(self, username):
         if username == config.ADMIN_USERNAME:
-            self.scheduler.remove_all_jobs()
+            self.scheduler.remove_all_jobs(jobstore='default')
+            for job in self.scheduler.get_jobs(jobstore='memory'):
+                if job.id.startswith('batch-'):
+                    job.remove()
         else:
-            jobs = self.get_jobs(username)
-            for job in jobs:
-                job.remove()
+            for job_id in self.get_user_job_ids(username):
+                try:
+                    self.scheduler.remove_job(job_id, jobstore='default')
+                except JobLookupError:
+                    self._index_remove(job_id)
+
+
+def get_handler():
+    """按`config.SCHEDULER_MODE`返回本进程的SchedulerHandler，或转发给scheduler进程的RemoteSchedulerHandler"""
+    if config.SCHEDULER_MODE == 'remote':
+        from scheduler_service import RemoteSchedulerHandler
+        return RemoteSchedulerHandler()
+    return SchedulerHandler()
@@ -0,0 +1,223 @@
+import os
+import stat
+import logging
+import threading
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+from config import config
+from scheduler import SchedulerHandler
+from jobstore import sqlite_path
+from errors import SchedulerException
+
+AUTHKEY_ENV = 'ZJU_TEM_SCHEDULER_AUTHKEY'
+
+# web进程可以调用的SchedulerHandler方法
+METHODS = frozenset([
+    'add_job', 'add_jobs', 'get_version', 'query_summaries', 'get_conflicts', 'get_slot_intervals',
+    'get_user_job_ids', 'get_jobs', 'get_job', 'remove_job', 'remove_all_jobs', 'clock_status',
+    'metrics_exposition',
+])
+# 重复执行没有副作用的方法，连接断开后可以在新连接上重试
+_RETRYABLE = frozenset([
+    'get_version', 'query_summaries', 'get_conflicts', 'get_slot_intervals', 'get_user_job_ids', 'get_jobs',
+    'get_job', 'clock_status', 'metrics_exposition',
+])
+
+
+def scheduler_address():
+    """IPC的地址，`config.SCHEDULER_ADDRESS`为None时是jobstore文件名加'.sock'"""
+    if config.SCHEDULER_ADDRESS is not None:
+        return config.SCHEDULER_ADDRESS
+    store_path = sqlite_path(config.SCHEDULER_STORE_URL)
+    if store_path == ':memory:':
+        raise SchedulerException('remote scheduler needs a jobstore file or config.SCHEDULER_ADDRESS')
+    return os.path.abspath(store_path) + '.sock'
+
+
+def scheduler_authkey():
+    """IPC的认证密钥：环境变量`AUTHKEY_ENV`，或`config.SCHEDULER_AUTHKEY_FILE`文件的内容
+
+    消息都用pickle传递，能连接的人就能在scheduler进程中执行代码，所以没有密钥时不启动
+
+    :raise SchedulerException: 没有设置密钥，或密钥文件其他用户可以读写
+    """
+    key = os.environ.get(AUTHKEY_ENV, '').strip()
+    if not key and config.SCHEDULER_AUTHKEY_FILE:
+        try:
+            mode = os.stat(config.SCHEDULER_AUTHKEY_FILE).st_mode
+            if mode & (stat.S_IRWXG | stat.S_IRWXO):
+                raise SchedulerException('scheduler authkey file %s must be readable only by its owner (0600)'
+                                         % config.SCHEDULER_AUTHKEY_FILE)
+            with open(config.SCHEDULER_AUTHKEY_FILE) as f:
+                key = f.read().strip()
+        except OSError as e:
+            raise SchedulerException('can not read scheduler authkey file: %s' % e)
+    if not key:
+        raise SchedulerException('remote scheduler needs an authkey: set %s or config.SCHEDULER_AUTHKEY_FILE'
+                                 % AUTHKEY_ENV)
+    return key.encode('utf-8')
+
+
+def _listen(address, authkey):
+    """在address监听；unix socket创建时就只有所有者可以连接，之前的scheduler留下的socket文件先删除
+    （此时已持有jobstore的锁，不会有其他scheduler在用）"""
+    if not isinstance(address, str):
+        return Listener(address, authkey=authkey)
+    if os.path.exists(address):
+        os.unlink(address)
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    finally:
+        os.umask(umask)
+    os.chmod(address, 0o600)
+    return listener
+
+
+def _serve_connection(handler, connection):
+    """处理一个web进程的连接：每个请求是(方法名, args, kwargs)，返回('ok', 结果)或('error', 异常)"""
+    with connection:
+        while True:
+            try:
+                method, args, kwargs = connection.recv()
+            except (EOFError, OSError):
+                return
+            if method not in METHODS:
+                connection.send(('error', SchedulerException('unknown method: %s' % method)))
+                continue
+            try:
+                result = ('ok', getattr(handler, method)(*args, **kwargs))
+            except Exception as e:
+                logging.exception(e)
+                result = ('error', e)
+            try:
+                connection.send(result)
+            except OSError:
+                return
+            except Exception as e:
+                # 结果或异常无法pickle，pickle失败时还没有发送
+                connection.send(('error', SchedulerException('%s: %s' % (method, e))))
+
+
+def serve():
+    """scheduler进程：启动SchedulerHandler（加锁，同一jobstore只有一个scheduler），
+    在`scheduler_address`监听web进程的调用，每个连接一个线程
+
+    :raise SchedulerException: 已有另一个scheduler在运行，或没有设置认证密钥
+    """
+    # 先检查，没有密钥时不启动scheduler
+    address, authkey = scheduler_address(), scheduler_authkey()
+    # 本进程就是scheduler进程，预约任务中用到的get_handler都返回本地的SchedulerHandler
+    config.SCHEDULER_MODE = 'inline'
+    handler = SchedulerHandler()
+    handler.start()
+    with _listen(address, authkey) as listener:
+        logging.info('scheduler listening on %s' % (listener.address,))
+        while True:
+            try:
+                connection = listener.accept()
+            except AuthenticationError as e:
+                logging.warning('rejected scheduler client: %s' % e)
+                continue
+            except OSError as e:
+                logging.warning('accept scheduler client failed: %s' % e)
+                continue
+            threading.Thread(target=_serve_connection, args=(handler, connection),
+                             name='scheduler-client', daemon=True).start()
+
+
+class RemoteSchedulerHandler(object):
+    """`config.SCHEDULER_MODE = 'remote'`时web进程中代替SchedulerHandler，
+    方法调用通过本地IPC（multiprocessing.connection）转发给scheduler进程，参数和结果用pickle传递，
+    连接需要认证密钥（见`scheduler_authkey`）
+
+    每个线程使用自己的连接，连接断开时重新连接；只有`_RETRYABLE`中的方法会在新连接上重试，
+    添加、删除任务不重试，避免重复执行
+
+    单例
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            # 没有认证密钥时报错，web进程不启动
+            address, authkey = scheduler_address(), scheduler_authkey()
+            cls._instance = object.__new__(cls)
+            cls._instance.address = address
+            cls._instance.authkey = authkey
+            cls._instance.local = threading.local()
+        return cls._instance
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            try:
+                connection = Client(self.address, authkey=self.authkey)
+            except (OSError, AuthenticationError) as e:
+                raise SchedulerException('can not connect to scheduler at %s: %s' % (self.address, e))
+            self.local.connection = connection
+        return connection
+
+    def _close(self):
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except OSError:
+                pass
+
+    def _call(self, method, *args, **kwargs):
+        retries = 1 if method in _RETRYABLE else 0
+        for i in range(retries + 1):
+            connection = self._connection()
+            try:
+                connection.send((method, args, kwargs))
+                status, result = connection.recv()
+            except (EOFError, OSError) as e:
+                self._close()
+                if i < retries:
+                    continue
+                raise SchedulerException('scheduler call %s failed: %s' % (method, e))
+            if status == 'error':
+                raise result
+            return result
+
+    def add_job(self, *args, summary=None, **kwargs):
+        return self._call('add_job', *args, summary=summary, **kwargs)
+
+    def add_jobs(self, job_specs):
+        return self._call('add_jobs', job_specs)
+
+    def get_version(self, username):
+        return self._call('get_version', username)
+
+    def query_summaries(self, username, limit=None, cursor=None, **filters):
+        return self._call('query_summaries', username, limit=limit, cursor=cursor, **filters)
+
+    def get_conflicts(self, reserve_data):
+        return self._call('get_conflicts', reserve_data)
+
+    def get_slot_intervals(self, instrument_id, reserve_date):
+        return self._call('get_slot_intervals', instrument_id, reserve_date)
+
+    def get_user_job_ids(self, username):
+        return self._call('get_user_job_ids', username)
+
+    def get_jobs(self, username):
+        return self._call('get_jobs', username)
+
+    def get_job(self, job_id, username):
+        return self._call('get_job', job_id, username)
+
+    def remove_job(self, job_id, username):
+        return self._call('remove_job', job_id, username)
+
+    def remove_all_jobs(self, username):
+        return self._call('remove_all_jobs', username)
+
+    def clock_status(self):
+        return self._call('clock_status')
+
+    def metrics_exposition(self):
+        return self._call('metrics_exposition')
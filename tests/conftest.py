@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config as Config
+
+# 测试都在debug配置下运行，jobstore在内存中，不检查日历，不定期校准时钟
+Config.config = Config.get_config('debug')
+Config.config.SCHEDULER_STORE_URL = 'sqlite://'
+Config.config.AVAILABILITY_MODE = 'off'
+Config.config.CLOCK_CALIBRATE_INTERVAL = 10 ** 6
+
+from config import config
+from fake_upstream import FakeUpstream
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    """本地模拟的“易约”服务器，config.UPSTREAM_URL指向它"""
+    fake = FakeUpstream()
+    monkeypatch.setattr(config, 'UPSTREAM_URL', fake.start())
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture(scope='session')
+def scheduler_handler():
+    """整个测试进程共用的SchedulerHandler（单例，只能启动一次），jobstore在内存中；
+    启动时的时钟校准等请求发给模拟服务器"""
+    from scheduler import SchedulerHandler
+    fake = FakeUpstream()
+    upstream_url, config.UPSTREAM_URL = config.UPSTREAM_URL, fake.start()
+    handler = SchedulerHandler()
+    if not handler.scheduler.running:
+        handler.start()
+    yield handler
+    config.UPSTREAM_URL = upstream_url
+    fake.stop()
@@ -0,0 +1,74 @@
+import pytest
+
+from config import config
+from instrument import Instrument
+from reserve import ReserveTem, keep_reserve_job
+
+DAY = '2030年01月02日'
+
+
+def reserve_data(instrument, start_time, end_time):
+    return dict(reserveDate=DAY, reserveStartTime=start_time, reserveEndTime=end_time,
+                instrumentId=Instrument.get(name=instrument).instrument_id, ReserveReport='test')
+
+
+@pytest.fixture
+def events(monkeypatch):
+    """ReserveTem记录的事件，(事件, 字段)"""
+    recorded = []
+    monkeypatch.setattr(ReserveTem, '_event', lambda self, event, **fields: recorded.append((event, fields)))
+    return recorded
+
+
+def run(*args, **kwargs):
+    result = keep_reserve_job(*args, **kwargs)
+    return result.result(30) if hasattr(result, 'result') else result
+
+
+@pytest.mark.parametrize('engine', ['thread', 'asyncio'])
+def test_fallback_to_next_alternative(fake_upstream, events, monkeypatch, engine):
+    monkeypatch.setattr(config, 'ENGINE', engine)
+    monkeypatch.setattr(config, 'TRY_TIME', 5)
+    primary = reserve_data('OLD_F20', '9:00', '13:00')
+    taken = reserve_data('OLD_F20', '13:00', '17:00')
+    other_instrument = reserve_data('NEW_F20', '9:00', '13:00')
+    for data in (primary, taken):
+        fake_upstream.book(data['instrumentId'], DAY, data['reserveStartTime'], data['reserveEndTime'])
+
+    assert run('alice', 'p', primary, alternatives=[taken, other_instrument])
+
+    fallbacks = [fields['to'] for event, fields in events if event == 'fallback']
+    assert [(to['instrumentId'], to['reserveStartTime']) for to in fallbacks] == [
+        (taken['instrumentId'], '13:00'), (other_instrument['instrumentId'], '9:00')]
+    assert fake_upstream.bookings[(other_instrument['instrumentId'], DAY, '9:00')] == ('alice', '13:00')
+    # 三次提交用同一次登录
+    assert fake_upstream.login_count == 1
+    assert [result for _, username, result in fake_upstream.reserve_posts] == ['error', 'error', 'success']
+
+
+def test_all_alternatives_taken(fake_upstream, events, monkeypatch):
+    monkeypatch.setattr(config, 'ENGINE', 'thread')
+    monkeypatch.setattr(config, 'TRY_TIME', 5)
+    primary = reserve_data('OLD_F20', '9:00', '13:00')
+    alternative = reserve_data('OLD_F20', '13:00', '17:00')
+    for data in (primary, alternative):
+        fake_upstream.book(data['instrumentId'], DAY, data['reserveStartTime'], data['reserveEndTime'])
+
+    assert not run('alice', 'p', primary, alternatives=[alternative])
+    assert len(fake_upstream.reserve_posts) == 2
+    assert events[-1][0] == 'failed'
+
+
+def test_next_alternative_rebuilds_prepared_request(fake_upstream):
+    reserve = ReserveTem()
+    reserve.set_account('alice', 'p')
+    primary = reserve_data('OLD_F20', '9:00', '13:00')
+    alternative = reserve_data('OLD_F20', '13:00', '17:00')
+    reserve.set_info(primary, [alternative])
+    prepared = reserve.prepare()
+
+    assert reserve.next_alternative('taken')
+    assert reserve.reserve_data is alternative
+    assert reserve.prepared is not prepared
+    assert not reserve.next_alternative('taken')
+    assert reserve.reserve_data is alternative
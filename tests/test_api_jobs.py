@@ -0,0 +1,90 @@
+import json
+
+import pytest
+from flask import Flask
+
+from config import config
+
+
+@pytest.fixture(scope='module')
+def client(scheduler_handler):
+    """web服务和scheduler在同一进程中"""
+    from api import api
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    return app.test_client()
+
+
+def reserve(client, username, day, start_time='9:00', end_time='13:00', instrument='OLD_F20'):
+    result = client.post('/api/reserve', data=dict(
+        username=username, password='x', instrument=instrument, reserve_date=day, start_time=start_time,
+        end_time=end_time, reserve_time='2030-01-01 00:00:00')).get_json(force=True)
+    assert result['code'] == 0, result
+    return result['job_id']
+
+
+def list_jobs(client, query, etag=None):
+    headers = {'If-None-Match': etag} if etag else {}
+    return client.get('/api/scheduled_jobs?' + query, headers=headers)
+
+
+def test_pagination_and_etag(client):
+    user, other = config.TEST_USERS
+    job_ids = [reserve(client, user, '2031-02-%02d' % (i + 1)) for i in range(5)]
+    query = 'username=%s&password=x&date_from=2031-02-01&date_to=2031-02-28' % user
+
+    response = list_jobs(client, query + '&limit=2')
+    page = response.get_json(force=True)
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+    assert len(page['jobs']) == 2 and page['next_cursor']
+    seen = [job['id'] for job in page['jobs']]
+    while page['next_cursor']:
+        page = list_jobs(client, query + '&limit=2&cursor=' + page['next_cursor']).get_json(force=True)
+        seen.extend(job['id'] for job in page['jobs'])
+    assert sorted(seen) == sorted(job_ids)
+
+    # 没有变化时304，其他用户的任务变化不影响
+    assert list_jobs(client, query + '&limit=2', etag).status_code == 304
+    reserve(client, other, '2031-02-10', instrument='FIB')
+    assert list_jobs(client, query + '&limit=2', etag).status_code == 304
+    # 查询参数不同时ETag不同
+    assert list_jobs(client, query + '&limit=3', etag).status_code == 200
+    # 自己的任务变化后重新返回
+    reserve(client, user, '2031-02-20')
+    assert list_jobs(client, query + '&limit=2', etag).status_code == 200
+
+
+def test_bad_cursor(client):
+    result = list_jobs(client, 'cursor=zzz').get_json(force=True)
+    assert result['code'] == -5
+    assert json.loads(list_jobs(client, 'limit=0').data)['code'] == -5
+
+
+def test_conflicts_include_alternative_windows(client):
+    user, other = config.TEST_USERS
+    result = client.post('/api/reserve', data=dict(
+        username=user, password='x', instrument='OLD_F20', reserve_date='2031-03-01', start_time='9:00',
+        end_time='13:00', reserve_time='2030-01-01 00:00:00',
+        alternatives=json.dumps([dict(start_time='14:00', end_time='17:00')]))).get_json(force=True)
+    assert result['code'] == 0 and 'conflicts' not in result
+    job_id = result['job_id']
+
+    # 新预约的备选时间段与已设定任务的备选时间段重叠
+    result = client.post('/api/reserve', data=dict(
+        username=other, password='x', instrument='OLD_F20', reserve_date='2031-03-01', start_time='18:00',
+        end_time='20:00', reserve_time='2030-01-01 00:00:00',
+        alternatives=json.dumps([dict(start_time='8:00', end_time='8:30'), dict(start_time='16:00',
+                                                                                 end_time='18:00')]))
+    ).get_json(force=True)
+    assert result['code'] == 0
+    assert result['conflicts'] == [dict(start_time='14:00', end_time='17:00', window=1, own=False,
+                                        request_window=2)]
+
+    jobs = client.get('/api/slot_jobs?username=%s&password=x&instrument=OLD_F20&reserve_date=2031-03-01'
+                      % user).get_json(force=True)['jobs']
+    assert [(job['start_time'], job['window'], job.get('job_id')) for job in jobs] == [
+        ('8:00', 1, None), ('9:00', 0, job_id), ('14:00', 1, job_id), ('16:00', 2, None), ('18:00', 0, None)]
+    jobs = client.get('/api/slot_jobs?username=%s&password=x&instrument=OLD_F20&reserve_date=2031-03-01'
+                      '&start_time=12:00&end_time=15:00' % user).get_json(force=True)['jobs']
+    assert [(job['start_time'], job['window']) for job in jobs] == [('9:00', 0), ('14:00', 1)]
@@ -0,0 +1,83 @@
+import pytest
+
+import auth_cache
+from config import config
+from auth_cache import AuthCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """AuthCache使用的time.time()，测试中手动前进"""
+    fake = Clock()
+    monkeypatch.setattr(auth_cache.time, 'time', fake.time)
+    return fake
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(config, 'AUTH_CACHE_TTL', 600)
+    monkeypatch.setattr(config, 'AUTH_CACHE_NEGATIVE_TTL', 30)
+    monkeypatch.setattr(config, 'AUTH_CACHE_SIZE', 3)
+    cache = AuthCache()
+    cache.clear()
+    yield cache
+    cache.clear()
+
+
+def test_ttl(cache, clock):
+    cache.put('alice', 'right', True)
+    cache.put('alice', 'wrong', False)
+    assert cache.get('alice', 'right') is True
+    assert cache.get('alice', 'wrong') is False
+    # 失败的结果先过期
+    clock.now += 31
+    assert cache.get('alice', 'wrong') is None
+    assert cache.get('alice', 'right') is True
+    clock.now += 600
+    assert cache.get('alice', 'right') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_lru(cache, clock):
+    for name in ('a', 'b', 'c'):
+        cache.put(name, 'p', True)
+    cache.get('a', 'p')
+    cache.put('d', 'p', True)
+    # b最久未使用，被淘汰
+    assert cache.get('b', 'p') is None
+    assert [cache.get(name, 'p') for name in ('a', 'c', 'd')] == [True, True, True]
+
+
+def test_invalidate(cache, clock):
+    cache.put('alice', 'old', True)
+    cache.put('alice', 'new', True)
+    cache.put('bob', 'p', True)
+    cache.invalidate('alice', 'old')
+    assert cache.get('alice', 'old') is None
+    assert cache.get('alice', 'new') is True
+    cache.invalidate('alice')
+    assert cache.get('alice', 'new') is None
+    assert cache.get('bob', 'p') is True
+
+
+def test_api_auth_uses_cache(cache, fake_upstream, monkeypatch):
+    from api import edit_sched
+    from api.edit_sched import auth
+    fake_upstream.accounts = {'dave': 'right'}
+    assert auth('dave', 'wrong') is False
+    assert auth('dave', 'wrong') is False
+    assert fake_upstream.login_count == 1
+    assert auth('dave', 'right') is True
+    assert auth('dave', 'right') is True
+    assert fake_upstream.login_count == 2
+    # 命中缓存时不创建ReserveTem
+    monkeypatch.setattr(edit_sched, 'ReserveTem', None)
+    assert auth('dave', 'right') is True
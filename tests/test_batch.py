@@ -0,0 +1,147 @@
+import time
+import sqlite3
+import datetime
+from uuid import uuid4
+
+import pytest
+from apscheduler.job import Job
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.date import DateTrigger
+
+import batch
+from batch import ReserveBatch
+from clock import ServerClock
+from config import config
+from instrument import Instrument
+from jobstore import ReserveJobStore
+from reserve import keep_reserve_job
+
+DAY = '2030年01月02日'
+
+
+def kwargs_of(username, instrument='OLD_F20', priority=0, trigger_time=None):
+    return dict(username=username, password='p', priority=priority, submitted_at=time.time(),
+                trigger_time=trigger_time, alternatives=[],
+                reserve_data=dict(reserveDate=DAY, reserveStartTime='9:00', reserveEndTime='13:00',
+                                  instrumentId=Instrument.get(name=instrument).instrument_id, ReserveReport='test'))
+
+
+@pytest.fixture
+def calibrated(monkeypatch):
+    """服务器时钟与本地相同，执行前不再校准"""
+    clock = ServerClock()
+    for name, value in dict(offset=0.0, latency=0.0, error=0.001, sample_count=8,
+                            calibrated_at=datetime.datetime.now()).items():
+        monkeypatch.setattr(clock, name, value)
+    return clock
+
+
+@pytest.mark.parametrize('engine', ['thread', 'asyncio'])
+def test_run_report(fake_upstream, calibrated, monkeypatch, engine):
+    monkeypatch.setattr(config, 'ENGINE', engine)
+    delays = []
+    real_sleep = batch.sleep
+    monkeypatch.setattr(batch, 'sleep', lambda seconds: (delays.append(seconds), real_sleep(seconds)))
+    finished = []
+    trigger_time = datetime.datetime.now() + datetime.timedelta(seconds=1)
+    # alice和bob预约同一时间段，bob优先级高；carol预约另一台仪器
+    jobs_kwargs = [kwargs_of('alice'), kwargs_of('bob', priority=5), kwargs_of('carol', instrument='FIB')]
+
+    reserve_batch = ReserveBatch(trigger_time, jobs_kwargs, on_finished=finished.append)
+    report = reserve_batch.run(stagger=0.1)
+
+    assert report['jobs'] == 3
+    assert report['success'] == 2
+    assert report['posts'] == reserve_batch.planned_posts()
+    assert report['first_post_delay'] is not None and report['first_post_delay'] > -1
+    assert [[(item['username'], item['rank'], item['success']) for item in queue]
+            for queue in report['dispatch']['queues']] == [[('bob', 0, True), ('alice', 1, False)],
+                                                          [('carol', 0, True)]]
+    assert batch.reports[-1] is report
+    assert sorted(finished) == [0, 1, 2]
+    if engine == 'thread':
+        # 按名次依次登录，间隔stagger
+        assert sorted(delays) == pytest.approx([0, 0.1, 0.2])
+
+
+def test_default_stagger(fake_upstream, calibrated, monkeypatch):
+    monkeypatch.setattr(config, 'BATCH_WARMUP_STAGGER', 0.05)
+    delays = []
+    monkeypatch.setattr(batch, 'sleep', delays.append)
+    trigger_time = datetime.datetime.now() + datetime.timedelta(seconds=0.5)
+    ReserveBatch(trigger_time, [kwargs_of('alice'), kwargs_of('bob', instrument='FIB')]).run()
+    assert sorted(delays) == pytest.approx([0, 0.05])
+
+
+def make_job(scheduler, job_id, run_date):
+    trigger = DateTrigger(run_date=run_date, timezone=scheduler.timezone)
+    return Job(scheduler, id=job_id, func=keep_reserve_job, trigger=trigger, executor='default', args=(),
+               kwargs=kwargs_of('alice', trigger_time=run_date), name='keep_reserve_job', misfire_grace_time=1,
+               coalesce=True, max_instances=1, next_run_time=trigger.get_next_fire_time(None, run_date))
+
+
+def test_claimed_jobs_are_not_due(tmp_path):
+    scheduler = BackgroundScheduler()
+    store = ReserveJobStore('sqlite:///%s' % (tmp_path / 'jobs.sqlite'))
+    store.start(scheduler, 'default')
+    past = datetime.datetime(2020, 1, 1)
+    store.add_jobs([make_job(scheduler, 'a', past), make_job(scheduler, 'b', past)])
+    try:
+        assert store.claim_jobs(['a', 'missing']) == ['a']
+        assert store.claim_jobs(['a', 'b']) == ['b']
+        assert store.get_due_jobs(datetime.datetime.now().astimezone()) == []
+        assert store.get_next_run_time() is None
+        assert [job.id for job in store.get_claimed_jobs()] == ['a', 'b']
+        # 认领的任务仍在jobstore中，执行完才删除
+        assert [job.id for job in store.get_all_jobs()] == ['a', 'b']
+    finally:
+        store.shutdown()
+
+
+def test_add_claimed_at_column(tmp_path):
+    path = tmp_path / 'old.sqlite'
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.execute('CREATE TABLE reserve_jobs (id TEXT PRIMARY KEY, next_run_time REAL, username TEXT, '
+                           'instrument_id TEXT, experiment_date TEXT, trigger_time TEXT, kwargs TEXT, '
+                           'job_state BLOB NOT NULL)')
+    connection.close()
+    scheduler = BackgroundScheduler()
+    store = ReserveJobStore('sqlite:///%s' % path)
+    store.start(scheduler, 'default')
+    try:
+        store.add_jobs([make_job(scheduler, 'a', datetime.datetime(2020, 1, 1))])
+        assert store.claim_jobs(['a']) == ['a']
+    finally:
+        store.shutdown()
+
+
+def wait_for(condition, timeout=15):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def test_batch_claims_then_removes_each_job(scheduler_handler, fake_upstream, calibrated):
+    store = scheduler_handler.store
+    trigger_time = (datetime.datetime.now() + datetime.timedelta(seconds=2)).replace(microsecond=0)
+    specs = []
+    for username in ('batch_a', 'batch_b'):
+        kwargs = kwargs_of(username, instrument='OLD_F20' if username == 'batch_a' else 'FIB',
+                           trigger_time=trigger_time)
+        specs.append((uuid4().hex, keep_reserve_job, trigger_time, kwargs, None))
+    reports = len(batch.reports)
+    # 开始预约时间已经很近，批处理任务立即触发并认领这两个任务
+    job_ids = [job.id for job in scheduler_handler.add_jobs(specs)]
+
+    wait_for(lambda: len(store.get_claimed_jobs()) == 2)
+    assert sorted(job.id for job in store.get_claimed_jobs()) == sorted(job_ids)
+    assert scheduler_handler.get_user_job_ids('batch_a') == {job_ids[0]}
+
+    wait_for(lambda: len(batch.reports) > reports)
+    wait_for(lambda: not store.lookup_jobs(job_ids))
+    assert batch.reports[-1]['success'] == 2
+    assert scheduler_handler.get_user_job_ids('batch_a') == set()
+    # 任务只执行了一次（批处理），没有被scheduler单独触发
+    assert len(fake_upstream.reserve_posts) == 2
@@ -0,0 +1,52 @@
+import datetime
+
+import pytest
+
+from instrument import Instrument
+from reserve import ReserveTem, burst_offsets
+
+DAY = '2030年01月02日'
+BURST = dict(count=8, spacing=0.1, window=0.75)
+
+
+@pytest.fixture
+def reserve(fake_upstream):
+    reserve = ReserveTem()
+    reserve.set_account('alice', 'p')
+    reserve.set_info(dict(reserveDate=DAY, reserveStartTime='9:00', reserveEndTime='13:00',
+                          instrumentId=Instrument.get(name='OLD_F20').instrument_id, ReserveReport='test'))
+    assert reserve.login()
+    reserve.prepare()
+    return reserve
+
+
+def test_offsets():
+    assert burst_offsets(None) == []
+    assert burst_offsets(BURST) == pytest.approx([i * 0.1 for i in range(8)])
+    # 超出窗口的不发送
+    assert len(burst_offsets(dict(count=8, spacing=0.1, window=0.25))) == 3
+
+
+def test_first_success_cancels_the_rest(reserve, fake_upstream):
+    trigger_time = datetime.datetime.now() + datetime.timedelta(seconds=0.5)
+    # 窗口开始后约0.15秒开放，前两次提交“未开放”，之后的第一次成功
+    fake_upstream.open_time = (trigger_time - datetime.timedelta(seconds=0.22)).timestamp()
+
+    result = reserve.burst_reserve(trigger_time, BURST)
+
+    assert result['status'] and result['abort'] is None
+    assert 2 <= result['attempt'] <= 4
+    assert result['sent'] < len(burst_offsets(BURST))
+    assert len(fake_upstream.reserve_posts) == result['sent']
+    assert [posted for _, _, posted in fake_upstream.reserve_posts].count('success') == 1
+
+
+def test_abort_cancels_the_rest(reserve, fake_upstream):
+    data = reserve.reserve_data
+    fake_upstream.book(data['instrumentId'], DAY, data['reserveStartTime'], data['reserveEndTime'])
+
+    result = reserve.burst_reserve(datetime.datetime.now() + datetime.timedelta(seconds=0.5), BURST)
+
+    assert not result['status']
+    assert result['abort']
+    assert result['sent'] < len(burst_offsets(BURST))
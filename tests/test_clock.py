@@ -0,0 +1,93 @@
+import math
+import datetime
+
+import pytest
+
+import clock
+from clock import ServerClock
+
+
+@pytest.fixture
+def server_clock(monkeypatch):
+    """ServerClock单例，测试结束后恢复原来的估计；校准时不sleep"""
+    instance = ServerClock()
+    for name in ('offset', 'latency', 'error', 'sample_count', 'calibrated_at'):
+        monkeypatch.setattr(instance, name, getattr(instance, name))
+    monkeypatch.setattr(clock.time, 'sleep', lambda seconds: None)
+    return instance
+
+
+def simulated_samples(offset, phases, rtt=0.02, base=1000000.0):
+    """服务器时钟比本地快offset秒，请求在往返的中点生成Date（精确到秒）"""
+    samples = []
+    for i, phase in enumerate(phases):
+        t0 = base + i * 10 + phase
+        t1 = t0 + rtt
+        samples.append((t0, t1, float(math.floor(t0 + rtt / 2 + offset))))
+    return samples
+
+
+def calibrate_with(server_clock, monkeypatch, samples):
+    samples = iter(samples)
+    monkeypatch.setattr(ServerClock, '_sample', staticmethod(lambda url: next(samples)))
+    return server_clock.calibrate(url='http://unused/', samples=8)
+
+
+def test_intervals_intersect(server_clock, monkeypatch):
+    true_offset = 2.3
+    phases = [i / 8 for i in range(8)]
+    assert calibrate_with(server_clock, monkeypatch, simulated_samples(true_offset, phases))
+    assert abs(server_clock.offset - true_offset) <= server_clock.error
+    # 错开相位的采样把误差从1秒缩小到约一个相位间隔
+    assert server_clock.error <= 1 / 16 + 0.02
+    assert server_clock.latency == pytest.approx(0.01)
+    assert server_clock.sample_count == 8
+    assert not server_clock.is_stale()
+
+
+def test_negative_offset(server_clock, monkeypatch):
+    true_offset = -0.75
+    phases = [i / 8 for i in range(8)]
+    assert calibrate_with(server_clock, monkeypatch, simulated_samples(true_offset, phases))
+    assert abs(server_clock.offset - true_offset) <= server_clock.error
+
+
+def test_disjoint_samples_use_fastest_round_trip(server_clock, monkeypatch):
+    # 第二次采样的Date跳了2秒（服务器时钟跳变），区间没有交集
+    samples = [(100.0, 100.1, 101.0), (200.0, 200.02, 203.0)]
+    assert calibrate_with(server_clock, monkeypatch, samples)
+    assert server_clock.offset == pytest.approx(203.5 - 200.01)
+    assert server_clock.error == pytest.approx(0.5 + 0.01)
+    assert server_clock.latency == pytest.approx(0.01)
+
+
+def test_failed_samples_keep_estimate(server_clock, monkeypatch):
+    server_clock.offset = 1.5
+
+    def fail(url):
+        raise OSError('unreachable')
+
+    monkeypatch.setattr(ServerClock, '_sample', staticmethod(fail))
+    assert not server_clock.calibrate(url='http://unused/', samples=3)
+    assert server_clock.offset == 1.5
+
+
+def test_no_sleep_after_last_sample(server_clock, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(clock.time, 'sleep', sleeps.append)
+    assert calibrate_with(server_clock, monkeypatch, simulated_samples(0.5, [i / 8 for i in range(8)]))
+    assert len(sleeps) == 7
+
+
+def test_to_local(server_clock):
+    server_clock.offset = 2.0
+    server_clock.latency = 0.05
+    server_time = datetime.datetime(2030, 1, 1, 12, 0, 0)
+    assert server_clock.to_local(server_time) == server_time - datetime.timedelta(seconds=2.05)
+
+
+def test_calibrate_against_fake_upstream(server_clock, fake_upstream):
+    # 模拟服务器与本地是同一个时钟
+    assert server_clock.calibrate(samples=4)
+    assert server_clock.sample_count == 4
+    assert abs(server_clock.offset) <= server_clock.error + 0.05
@@ -0,0 +1,74 @@
+from config import config
+from dispatch import dispatch, resolution, collision_groups, Assignment, PRIORITY, FIFO, ROUND_ROBIN
+
+DAY = '2030年01月02日'
+
+
+def job(username, start='9:00', end='13:00', instrument='F20', day=DAY, priority=0, submitted_at=0,
+        alternatives=()):
+    return dict(username=username, priority=priority, submitted_at=submitted_at,
+                reserve_data=dict(instrumentId=instrument, reserveDate=day, reserveStartTime=start,
+                                  reserveEndTime=end),
+                alternatives=[dict(instrumentId=i, reserveDate=d, reserveStartTime=s, reserveEndTime=e)
+                              for i, d, s, e in alternatives])
+
+
+def ranks(jobs, policy):
+    return [(assignment.kwargs['username'], assignment.rank) for assignment in dispatch(jobs, policy)]
+
+
+def test_collision_groups():
+    jobs = [
+        job('a', '9:00', '13:00'),
+        job('b', '13:00', '17:00'),  # 与a首尾相接，不竞争
+        job('c', '12:00', '14:00'),  # 与a、b都重叠，三个任务连成一组
+        job('d', day='2030年01月03日'),
+        job('e', instrument='FIB'),
+        job('f', '9:00', '10:00', instrument='JEM', alternatives=[('FIB', DAY, '12:00', '14:00')]),
+        job('g', '11:00', '12:00', instrument='JEM'),
+    ]
+    assert collision_groups(jobs) == [0, 0, 0, 3, 4, 4, 6]
+    assert collision_groups([job('a', '9:00', '13:00'), job('b', '13:00', '17:00')]) == [0, 1]
+
+
+def test_only_colliding_jobs_are_ranked():
+    jobs = [job('a', submitted_at=1), job('b', '14:00', '17:00', submitted_at=2),
+            job('c', day='2030年01月03日', submitted_at=3), job('d', submitted_at=4)]
+    assignments = dispatch(jobs, FIFO)
+    assert [assignment.rank for assignment in assignments] == [0, 0, 0, 1]
+    assert assignments[3].release_offset == config.DISPATCH_RELEASE_STEP
+    assert assignments[1].release_offset == 0
+
+
+def test_policies():
+    jobs = [job('alice', submitted_at=3), job('bob', priority=5, submitted_at=2), job('alice', submitted_at=1),
+            job('carol', submitted_at=4), job('bob', priority=5, submitted_at=5)]
+    assert [rank for _, rank in ranks(jobs, PRIORITY)] == [3, 0, 2, 4, 1]
+    assert [rank for _, rank in ranks(jobs, FIFO)] == [2, 1, 0, 3, 4]
+    # 各用户轮流，每个用户先设定的在前：alice(1), bob(2), carol(4), alice(3), bob(5)
+    assert [rank for _, rank in ranks(jobs, ROUND_ROBIN)] == [3, 1, 0, 2, 4]
+
+
+def test_old_jobs_without_submitted_at_come_first():
+    jobs = [job('new', submitted_at=100), job('old', submitted_at=None)]
+    assert ranks(jobs, FIFO) == [('new', 1), ('old', 0)]
+
+
+def test_burst_for_decays_with_rank():
+    burst = dict(count=8, spacing=0.1, window=0.6)
+    counts = [Assignment(rank, {}, rank).burst_for(burst)['count'] for rank in range(6)]
+    assert counts[0] == 8
+    assert counts == sorted(counts, reverse=True)
+    assert min(counts) == min(config.DISPATCH_BURST_MIN, 8)
+    assert Assignment(0, {}, 0).burst_for(None) is None
+
+
+def test_resolution():
+    jobs = [job('a', submitted_at=2), job('b', instrument='FIB'), job('c', submitted_at=1)]
+    report = resolution(dispatch(jobs, FIFO), outcomes={0: False, 1: True, 2: True}, policy=FIFO)
+    assert report['policy'] == FIFO
+    assert [[(item['username'], item['rank'], item['success']) for item in queue] for queue in report['queues']] == [
+        [('c', 0, True), ('a', 1, False)],
+        [('b', 0, True)],
+    ]
+    assert report['queues'][1][0]['instrumentId'] == 'FIB'
@@ -0,0 +1,76 @@
+import time
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from config import config
+from http_client import HttpClient
+
+
+@pytest.fixture
+def url(fake_upstream, monkeypatch):
+    """每个测试的模拟服务器端口不同，HttpClient为它新建大小为2的连接池"""
+    monkeypatch.setattr(config, 'HTTP_POOL_SIZE', 2)
+    return config.UPSTREAM_URL + '/'
+
+
+def timed_parallel(url, count):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        responses = list(executor.map(lambda i: HttpClient().open(url), range(count)))
+    assert all(response.status == 200 for response in responses)
+    return time.perf_counter() - start
+
+
+def test_keep_alive_reuse(url):
+    client = HttpClient()
+    client.open(url)
+    pool = client._pool(url)
+    [(conn, _)] = pool.idle
+    client.open(url)
+    assert [idle for idle, _ in pool.idle] == [conn]
+    assert pool.in_use == 0
+
+
+def test_pool_limits_concurrent_requests(url, fake_upstream):
+    fake_upstream.latency = 0.2
+    # 连接池大小为2，4个请求分两轮
+    assert timed_parallel(url, 4) >= 0.38
+
+    client = HttpClient()
+    client.reserve(url, 2)
+    try:
+        assert timed_parallel(url, 4) < 0.38
+        assert len(client._pool(url).idle) == 4
+    finally:
+        client.unreserve(url, 2)
+    pool = client._pool(url)
+    assert pool.size == 2
+    # 多出的空闲连接被关闭
+    assert len(pool.idle) == 2
+
+
+def test_exhausted_pool(url, monkeypatch):
+    monkeypatch.setattr(config, 'HTTP_TIMEOUT', 0.1)
+    pool = HttpClient()._pool(url)
+    held = [pool.acquire()[0] for i in range(2)]
+    with pytest.raises(http.client.HTTPException):
+        pool.acquire()
+    pool.release(held.pop())
+    conn, reused = pool.acquire()
+    assert reused
+    for conn in held + [conn]:
+        pool.release(conn)
+
+
+def test_cookie_jar_shared_per_user():
+    client = HttpClient()
+    jar = client.acquire_cookie_jar('carol')
+    assert client.acquire_cookie_jar('carol') is jar
+    client.release_cookie_jar('carol')
+    assert client.jars['carol'][1] == 1
+    client.release_cookie_jar('carol')
+    assert 'carol' not in client.jars
+    assert client.acquire_cookie_jar('carol') is not jar
+    client.release_cookie_jar('carol')
@@ -0,0 +1,82 @@
+import random
+
+from interval_index import IntervalIndex, minutes_of, format_minutes
+
+SLOT = ('instrument', '2030年01月02日')
+
+
+def test_minutes():
+    assert minutes_of('9:30') == 570
+    assert minutes_of(' 13:05 ') == 785
+    assert minutes_of('9.30') is None
+    assert minutes_of(None) is None
+    assert format_minutes(570) == '9:30'
+
+
+def test_overlapping():
+    index = IntervalIndex()
+    index.add('morning', [(SLOT, '9:00', '13:00')])
+    index.add('afternoon', [(SLOT, '13:00', '17:00')])
+    index.add('long', [(SLOT, '8:00', '18:00')])
+    index.add('other day', [(('instrument', '2030年01月03日'), '9:00', '13:00')])
+
+    def ids(start, end, slot=SLOT):
+        return [job_id for _, _, job_id, _ in index.overlapping(slot, start, end)]
+
+    assert ids('12:00', '14:00') == ['long', 'morning', 'afternoon']
+    # 首尾相接不算重叠
+    assert ids('17:00', '18:00') == ['long']
+    assert ids('18:00', '19:00') == []
+    assert ids('9:00', '13:00', ('other', '2030年01月02日')) == []
+    assert ids('bad', '13:00') == []
+
+
+def test_add_replaces_and_remove():
+    index = IntervalIndex()
+    index.add('job', [(SLOT, '9:00', '13:00')])
+    index.add('job', [(SLOT, '14:00', '15:00')])
+    assert index.intervals(SLOT) == [(840, 900, 'job', 0)]
+    index.remove('job')
+    index.remove('missing')
+    assert index.intervals(SLOT) == []
+    assert SLOT not in index.slots
+    # 时间不正确或结束不晚于开始的不加入
+    index.add('bad', [(SLOT, '13:00', '9:00'), (SLOT, '9:00', None)])
+    assert index.intervals(SLOT) == []
+    assert 'bad' not in index.job_intervals
+
+
+def test_alternative_windows():
+    index = IntervalIndex()
+    other_day = ('instrument', '2030年01月03日')
+    # 第1个备选时间段不正确，不加入，但之后的备选时间段编号不变
+    index.add('job', [(SLOT, '9:00', '13:00'), (SLOT, 'bad', '17:00'), (other_day, '9:00', '13:00'),
+                      (SLOT, '12:00', '14:00')])
+    assert index.overlapping(SLOT, '12:30', '12:45') == [(540, 780, 'job', 0), (720, 840, 'job', 3)]
+    assert index.intervals(other_day) == [(540, 780, 'job', 2)]
+    # 重新设定时替换所有时间段
+    index.add('job', [(SLOT, '15:00', '16:00')])
+    assert index.intervals(SLOT) == [(900, 960, 'job', 0)]
+    assert other_day not in index.slots
+    index.remove('job')
+    assert index.slots == {} and index.job_intervals == {}
+
+
+def test_matches_brute_force():
+    rng = random.Random(20301)
+    index = IntervalIndex()
+    intervals = {}
+    for step in range(600):
+        job_id = 'job%d' % rng.randrange(80)
+        if rng.random() < 0.3:
+            index.remove(job_id)
+            intervals.pop(job_id, None)
+        else:
+            start = rng.randrange(0, 23 * 60)
+            end = start + rng.randrange(1, 6 * 60)
+            index.add(job_id, [(SLOT, format_minutes(start), format_minutes(end))])
+            intervals[job_id] = (start, end)
+        start = rng.randrange(0, 24 * 60)
+        end = start + rng.randrange(1, 4 * 60)
+        expected = sorted((s, e, job_id, 0) for job_id, (s, e) in intervals.items() if s < end and start < e)
+        assert index.overlapping(SLOT, format_minutes(start), format_minutes(end)) == expected
@@ -0,0 +1,108 @@
+import json
+import pickle
+import sqlite3
+import datetime
+
+import pytest
+from apscheduler.job import Job
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.jobstores.base import ConflictingIdError
+
+from jobstore import ReserveJobStore
+
+RUN_DATE = datetime.datetime(2030, 1, 1, 0, 0, 0)
+
+
+def make_job(scheduler, job_id, username='alice', minutes=0, day='2030年01月02日'):
+    run_date = RUN_DATE + datetime.timedelta(minutes=minutes)
+    trigger = DateTrigger(run_date=run_date, timezone=scheduler.timezone)
+    kwargs = dict(username=username, password='p', trigger_time=run_date,
+                  reserve_data=dict(instrumentId='F20', reserveDate=day, reserveStartTime='9:00',
+                                    reserveEndTime='13:00'))
+    return Job(scheduler, id=job_id, func='reserve:keep_reserve_job', trigger=trigger, executor='default',
+               args=(), kwargs=kwargs, name='keep_reserve_job', misfire_grace_time=1, coalesce=True,
+               max_instances=1, next_run_time=trigger.get_next_fire_time(None, run_date))
+
+
+@pytest.fixture
+def scheduler():
+    return BackgroundScheduler()
+
+
+@pytest.fixture
+def store(tmp_path, scheduler):
+    store = ReserveJobStore('sqlite:///%s' % (tmp_path / 'jobs.sqlite'), pool_size=2)
+    store.start(scheduler, 'default')
+    yield store
+    store.shutdown()
+
+
+def test_migrate_legacy_table(tmp_path, scheduler):
+    path = tmp_path / 'legacy.sqlite'
+    connection = sqlite3.connect(str(path))
+    with connection:
+        connection.execute('CREATE TABLE apscheduler_jobs (id VARCHAR(191) PRIMARY KEY, next_run_time FLOAT, '
+                           'job_state BLOB NOT NULL)')
+        for i in range(3):
+            job = make_job(scheduler, 'legacy%d' % i, minutes=i)
+            connection.execute('INSERT INTO apscheduler_jobs VALUES (?, ?, ?)',
+                               (job.id, job.next_run_time.timestamp(), pickle.dumps(job.__getstate__())))
+        connection.execute('INSERT INTO apscheduler_jobs VALUES (?, ?, ?)', ('broken', 0, b'not a pickle'))
+    connection.close()
+
+    store = ReserveJobStore('sqlite:///%s' % path)
+    store.start(scheduler, 'default')
+    try:
+        jobs = store.get_all_jobs()
+        assert [job.id for job in jobs] == ['legacy0', 'legacy1', 'legacy2']
+        assert jobs[0].kwargs['trigger_time'] == RUN_DATE
+        assert jobs[0].kwargs['reserve_data']['reserveDate'] == '2030年01月02日'
+        assert [row[:4] for row in store.get_index_rows()][0] == ('legacy0', 'alice', 'F20', '2030-01-02')
+        with store._connection() as connection:
+            assert connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='apscheduler_jobs'"
+                                      ).fetchone()[0] == 0
+            # kwargs单独保存为JSON
+            kwargs = connection.execute("SELECT kwargs FROM reserve_jobs WHERE id='legacy1'").fetchone()[0]
+        assert json.loads(kwargs)['username'] == 'alice'
+    finally:
+        store.shutdown()
+
+
+def test_add_jobs_is_atomic(store, scheduler):
+    store.add_jobs([make_job(scheduler, 'a'), make_job(scheduler, 'b')])
+    with pytest.raises(ConflictingIdError):
+        store.add_jobs([make_job(scheduler, 'c'), make_job(scheduler, 'a')])
+    assert [job.id for job in store.get_all_jobs()] == ['a', 'b']
+
+
+def test_cursor_pagination(store, scheduler):
+    # 相同的next_run_time按id排序
+    store.add_jobs([make_job(scheduler, 'job%02d' % i, username='alice' if i % 3 else 'bob', minutes=i // 2)
+                    for i in range(20)])
+    expected = [job_id for job_id, _ in store.query_job_ids(username='alice')]
+    assert len(expected) == 13
+
+    pages, cursor = [], None
+    while True:
+        rows = store.query_job_ids(username='alice', after=cursor, limit=4)
+        if not rows:
+            break
+        pages.append([job_id for job_id, _ in rows])
+        cursor = rows[-1][1]
+    assert [len(page) for page in pages] == [4, 4, 4, 1]
+    assert sum(pages, []) == expected
+
+    # 翻页期间删除已经返回的任务，不影响之后的页
+    rows = store.query_job_ids(username='alice', limit=4)
+    store.remove_job(rows[0][0])
+    assert [job_id for job_id, _ in store.query_job_ids(username='alice', after=rows[-1][1], limit=4)] == \
+        expected[4:8]
+
+
+def test_query_filters(store, scheduler):
+    store.add_jobs([make_job(scheduler, 'd1', day='2030年01月01日'), make_job(scheduler, 'd2', day='2030年01月02日'),
+                    make_job(scheduler, 'd3', day='2030年01月03日', minutes=30)])
+    assert [job_id for job_id, _ in store.query_job_ids(date_from=datetime.date(2030, 1, 2))] == ['d2', 'd3']
+    assert [job_id for job_id, _ in store.query_job_ids(
+        trigger_to=RUN_DATE + datetime.timedelta(minutes=10))] == ['d1', 'd2']
@@ -0,0 +1,75 @@
+from time import perf_counter
+from urllib.parse import quote
+
+import metrics
+from fake_upstream import NOT_OPEN, SLOT_TAKEN
+from reserve import ReserveTem
+
+
+def test_counter_and_label_escaping():
+    counter = metrics.Counter('test_total', 'Test counter', ['code'])
+    counter.inc(code='a')
+    counter.inc(2, code='a')
+    counter.inc(code='say "hi"\\\n')
+    assert counter.expose() == [
+        '# HELP test_total Test counter',
+        '# TYPE test_total counter',
+        'test_total{code="a"} 3',
+        'test_total{code="say \\"hi\\"\\\\\\n"} 1',
+    ]
+
+
+def test_gauge():
+    values = {('x',): 1.5, ('y',): None}
+    gauge = metrics.Gauge('test_gauge', 'Test gauge', lambda: values, ['stat'])
+    # 值为None的不导出
+    assert gauge.expose()[2:] == ['test_gauge{stat="x"} 1.5']
+    assert metrics.Gauge('test_scalar', 'Scalar', lambda: 7).expose()[2:] == ['test_scalar 7']
+    assert metrics.Gauge('test_none', 'None', lambda: None).expose()[2:] == []
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram('test_seconds', 'Test histogram', ['result'], buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, result='ok')
+    assert histogram.expose()[2:] == [
+        'test_seconds_bucket{result="ok",le="0.1"} 2',
+        'test_seconds_bucket{result="ok",le="1"} 3',
+        'test_seconds_bucket{result="ok",le="+Inf"} 4',
+        'test_seconds_sum{result="ok"} 3.65',
+        'test_seconds_count{result="ok"} 4',
+    ]
+
+
+def test_registry_expose():
+    registry = metrics.Registry()
+    registry.register(metrics.Counter('a_total', 'A')).inc()
+    registry.register(metrics.Gauge('b', 'B', lambda: 2))
+    assert registry.expose() == '# HELP a_total A\n# TYPE a_total counter\na_total 1\n' \
+                                '# HELP b B\n# TYPE b gauge\nb 2\n'
+
+
+def test_upstream_errors_use_known_codes():
+    reserve = ReserveTem()
+    before = dict(metrics.upstream_errors.children)
+    for msg in (NOT_OPEN, SLOT_TAKEN, '未知错误 #1', '未知错误 #2'):
+        location = 'http://example.com/user/reserve.action?errorType=error&errorCode=' + quote(quote(msg))
+        assert reserve._reserve_result(location, perf_counter()) == dict(status=False, msg=msg)
+    added = {key: value - before.get(key, 0) for key, value in metrics.upstream_errors.children.items()
+             if value != before.get(key, 0)}
+    # 原文不作为标签，没有匹配分类规则的都是other
+    assert added == {('未开放',): 1, ('已被预约',): 1, ('other',): 2}
+
+
+def test_merge_processes():
+    web = '# HELP a_total A\n# TYPE a_total counter\na_total{code="x y"} 1\n# HELP b B\n# TYPE b gauge\nb 2\n'
+    scheduler = '# HELP a_total A\n# TYPE a_total counter\na_total{code="z"} 3\n'
+    assert metrics.merge([('web', web), ('scheduler', scheduler)]).splitlines() == [
+        '# HELP a_total A',
+        '# TYPE a_total counter',
+        'a_total{process="web",code="x y"} 1',
+        'a_total{process="scheduler",code="z"} 3',
+        '# HELP b B',
+        '# TYPE b gauge',
+        'b{process="web"} 2',
+    ]
@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import sqlite3
+import datetime
+import subprocess
+
+import pytest
+from apscheduler.job import Job
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.date import DateTrigger
+
+import recovery
+from clock import ServerClock
+from config import config
+from instrument import Instrument
+from jobstore import ReserveJobStore
+from reserve import keep_reserve_job
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAY = '2030年01月02日'
+
+
+def kwargs_of(username, trigger_time, instrument='OLD_F20'):
+    return dict(username=username, password='p', trigger_time=trigger_time, alternatives=[],
+                reserve_data=dict(reserveDate=DAY, reserveStartTime='9:00', reserveEndTime='13:00',
+                                  instrumentId=Instrument.get(name=instrument).instrument_id, ReserveReport='test'))
+
+
+def make_job(scheduler, job_id, run_date, kwargs):
+    trigger = DateTrigger(run_date=run_date, timezone=scheduler.timezone)
+    return Job(scheduler, id=job_id, func=keep_reserve_job, trigger=trigger, executor='default', args=(),
+               kwargs=kwargs, name='keep_reserve_job', misfire_grace_time=1, coalesce=True, max_instances=1,
+               next_run_time=trigger.get_next_fire_time(None, run_date))
+
+
+def wait_for(condition, timeout=20):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ReserveJobStore('sqlite:///%s' % (tmp_path / 'jobs.sqlite'))
+    store.start(BackgroundScheduler(), 'default')
+    yield store
+    store.shutdown()
+
+
+@pytest.fixture
+def calibrated(monkeypatch):
+    clock = ServerClock()
+    for name, value in dict(offset=0.0, latency=0.0, error=0.001, sample_count=8,
+                            calibrated_at=datetime.datetime.now()).items():
+        monkeypatch.setattr(clock, name, value)
+
+
+def test_catch_up(store, fake_upstream, calibrated):
+    scheduler = store._scheduler
+    now = datetime.datetime.now()
+    soon = now + datetime.timedelta(seconds=1)
+    store.add_jobs([
+        # 重启期间到了触发时间，开始预约时间还没到
+        make_job(scheduler, 'due', now - datetime.timedelta(seconds=5), kwargs_of('due_user', soon)),
+        # 重启前已被批处理认领，还没有执行完；本身的触发时间还没到
+        make_job(scheduler, 'claimed', soon, kwargs_of('claimed_user', soon, 'FIB')),
+        # 开始预约时间早已过去
+        make_job(scheduler, 'missed', now - datetime.timedelta(hours=1),
+                 kwargs_of('missed_user', now - datetime.timedelta(hours=1))),
+        make_job(scheduler, 'future', now + datetime.timedelta(hours=1),
+                 kwargs_of('future_user', now + datetime.timedelta(hours=2))),
+    ])
+    store.claim_jobs(['claimed'])
+    finished = []
+
+    assert recovery.catch_up(store, now, finish=lambda job_id: (finished.append(job_id), store.remove_job(job_id))) \
+        == (2, 1)
+    # 执行中的任务都已认领，scheduler不会再单独触发
+    assert sorted(job.id for job in store.get_claimed_jobs()) == ['claimed', 'due']
+    assert store.lookup_job('missed') is None
+
+    wait_for(lambda: len(finished) == 2)
+    assert sorted(finished) == ['claimed', 'due']
+    assert [job.id for job in store.get_all_jobs()] == ['future']
+    assert sorted(username for _, username, result in fake_upstream.reserve_posts if result == 'success') == [
+        'claimed_user', 'due_user']
+
+
+# 'crash'：启动scheduler，批处理认领任务后立即退出（模拟进程在执行前崩溃）；'restart'：重新启动scheduler
+SCHEDULER = '''
+import os
+import sys
+import time
+import datetime
+sys.path.insert(0, sys.argv[1])
+import config as Config
+Config.config = Config.get_config('debug')
+Config.config.SCHEDULER_STORE_URL = sys.argv[2]
+Config.config.UPSTREAM_URL = sys.argv[3]
+Config.config.AVAILABILITY_MODE = 'off'
+# 批处理在开始预约前10秒认领，任务本身在前5秒触发
+Config.config.WARMUP_SECONDS = 5
+from scheduler import SchedulerHandler
+from reserve import keep_reserve_job
+from instrument import Instrument
+if sys.argv[4] == 'crash':
+    import batch
+    batch.ReserveBatch.run = lambda self, stagger=None: os._exit(3)
+handler = SchedulerHandler()
+handler.start()
+if sys.argv[4] == 'crash':
+    trigger_time = datetime.datetime.fromtimestamp(float(sys.argv[5]))
+    kwargs = dict(username='restart_user', password='p', trigger_time=trigger_time, alternatives=[],
+                  reserve_data=dict(reserveDate='2030年01月02日', reserveStartTime='9:00', reserveEndTime='13:00',
+                                    instrumentId=Instrument.get(name='OLD_F20').instrument_id))
+    handler.add_jobs([('restart-job', keep_reserve_job, None, kwargs, None)])
+time.sleep(60)
+'''
+
+
+def run_scheduler(store_url, upstream_url, cwd, *args):
+    return subprocess.Popen([sys.executable, '-c', SCHEDULER, ROOT, store_url, upstream_url] + list(args),
+                            cwd=str(cwd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def test_restart_after_take_trigger_jobs(tmp_path, fake_upstream):
+    path = tmp_path / 'jobs.sqlite'
+    store_url = 'sqlite:///%s' % path
+    trigger_time = datetime.datetime.now().replace(microsecond=0) + datetime.timedelta(seconds=8)
+
+    crashed = run_scheduler(store_url, config.UPSTREAM_URL, tmp_path, 'crash', str(trigger_time.timestamp()))
+    _, stderr = crashed.communicate(timeout=30)
+    assert crashed.returncode == 3, stderr.decode()
+
+    def rows():
+        connection = sqlite3.connect(str(path))
+        try:
+            return connection.execute('SELECT id, claimed_at FROM reserve_jobs').fetchall()
+        finally:
+            connection.close()
+
+    # 任务已被认领，但还在jobstore中
+    [(job_id, claimed_at)] = rows()
+    assert job_id == 'restart-job' and claimed_at is not None
+    assert fake_upstream.reserve_posts == []
+
+    restarted = run_scheduler(store_url, config.UPSTREAM_URL, tmp_path, 'restart')
+    try:
+        wait_for(lambda: fake_upstream.reserve_posts, timeout=30)
+        wait_for(lambda: rows() == [])
+    finally:
+        restarted.terminate()
+        restarted.wait()
+    [(arrived_at, username, result)] = fake_upstream.reserve_posts
+    assert (username, result) == ('restart_user', 'success')
+    assert arrived_at >= trigger_time.timestamp() - 1
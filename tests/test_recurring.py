@@ -0,0 +1,85 @@
+import datetime
+
+import pytest
+
+from instrument import Instrument
+from recurring import RecurringRules, next_date
+from reserve import ReserveTime
+
+# 2030-01-07是周一
+MONDAY = datetime.datetime(2030, 1, 7, 8, 0)
+
+
+def rule(weekday=0, start_time='9:00', last_date=None, end_date='2030-12-31'):
+    return dict(weekday=weekday, start_time=start_time, last_date=last_date, end_date=end_date)
+
+
+def test_today_before_start_time():
+    assert next_date(rule(), MONDAY) == datetime.date(2030, 1, 7)
+    assert next_date(rule(weekday=3), MONDAY) == datetime.date(2030, 1, 10)
+
+
+def test_today_after_start_time_is_skipped():
+    assert next_date(rule(), MONDAY.replace(hour=9)) == datetime.date(2030, 1, 14)
+    assert next_date(rule(start_time='13:30'), MONDAY.replace(hour=13, minute=29)) == datetime.date(2030, 1, 7)
+    assert next_date(rule(start_time='13:30'), MONDAY.replace(hour=13, minute=30)) == datetime.date(2030, 1, 14)
+    # 其他周几不受影响
+    assert next_date(rule(weekday=1), MONDAY.replace(hour=23)) == datetime.date(2030, 1, 8)
+
+
+def test_after_last_date():
+    assert next_date(rule(last_date='2030-01-07'), MONDAY) == datetime.date(2030, 1, 14)
+    assert next_date(rule(last_date='2030-01-14'), MONDAY) == datetime.date(2030, 1, 21)
+    # 上次生成的日期早于今天时从今天算起
+    assert next_date(rule(last_date='2029-12-30'), MONDAY) == datetime.date(2030, 1, 7)
+
+
+def test_end_date():
+    assert next_date(rule(end_date='2030-01-07'), MONDAY) == datetime.date(2030, 1, 7)
+    assert next_date(rule(end_date='2030-01-07'), MONDAY.replace(hour=10)) is None
+    assert next_date(rule(last_date='2030-01-07', end_date='2030-01-13'), MONDAY) is None
+
+
+@pytest.fixture
+def add_rule(scheduler_handler, monkeypatch):
+    """添加规则，但不立即生成任务（add按当前时间生成），由测试按指定的now调用materialize"""
+    rules = RecurringRules()
+    instrument = Instrument.get(name='OLD_F20')
+
+    def add(username):
+        with monkeypatch.context() as m:
+            m.setattr(RecurringRules, 'materialize', lambda self, rule, now=None: rule)
+            return rules.add(username, 'x', instrument.instrument_id, 0, '9:00', '13:00', datetime.date(2030, 12, 31))
+    yield add
+    for rule in rules.rules():
+        rules.remove(rule['id'], rule['username'])
+
+
+def test_materialize(scheduler_handler, add_rule):
+    rules = RecurringRules()
+    rule = rules.materialize(add_rule('recurring_user'), MONDAY)
+    assert rule['last_date'] == '2030-01-07' and rule['error'] is None
+    assert scheduler_handler.get_user_job_ids('recurring_user') == {rule['job_id']}
+    trigger_time = ReserveTime.get_time(Instrument.get(name='OLD_F20'), datetime.date(2030, 1, 7))
+    assert rule['trigger_time'] == trigger_time.strftime('%Y-%m-%d %H:%M:%S')
+    assert rules.get(rule['id']) == rule
+    # 任务还没有执行时不再生成
+    assert rules.materialize(rule, MONDAY) == rule
+    assert scheduler_handler.get_user_job_ids('recurring_user') == {rule['job_id']}
+
+    # 任务执行（删除）后生成下一周的
+    scheduler_handler.remove_job(rule['job_id'], 'recurring_user')
+    rule = rules.materialize(rule, MONDAY)
+    assert rule['last_date'] == '2030-01-14'
+    assert scheduler_handler.get_user_job_ids('recurring_user') == {rule['job_id']}
+
+
+def test_materialize_concurrently(scheduler_handler, add_rule):
+    rules = RecurringRules()
+    rule = add_rule('recurring_race')
+    stale = dict(rule)
+    rule = rules.materialize(rule, MONDAY)
+    # 另一处拿着旧的规则同时生成：条件更新失败，删除自己生成的任务，返回数据库中的规则
+    assert rules.materialize(stale, MONDAY) == rule
+    assert scheduler_handler.get_user_job_ids('recurring_race') == {rule['job_id']}
+    assert rules.get(rule['id'])['last_date'] == '2030-01-07'
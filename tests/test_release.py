@@ -0,0 +1,48 @@
+import time
+import asyncio
+import threading
+
+from release import PreciseTimer
+
+
+def test_wait_releases_close_to_target():
+    timer = PreciseTimer()
+    count = timer.stats()['count']
+    errors = [timer.wait(time.time() + 0.05) for i in range(5)]
+    # 自旋保证不会提前释放，误差只来自调度抖动（测试机器负载高时也在20ms之内）
+    assert all(0 <= error < 0.02 for error in errors)
+    assert timer.calibrated and timer.spin_margin > 0
+    assert timer.stats()['count'] == min(count + 5, timer.release_errors.maxlen)
+
+
+def test_wait_past_target_returns_immediately():
+    timer = PreciseTimer()
+    if not timer.calibrated:
+        timer.calibrate()
+    start = time.perf_counter()
+    error = timer.wait(time.time() - 0.5)
+    assert time.perf_counter() - start < 0.01
+    assert error >= 0.5
+
+
+def test_wait_cancelled():
+    cancel = threading.Event()
+    threading.Timer(0.02, cancel.set).start()
+    start = time.perf_counter()
+    assert PreciseTimer().wait(time.time() + 1, cancel) is None
+    assert time.perf_counter() - start < 0.5
+    # 已经取消的等待立即返回
+    assert PreciseTimer().wait(time.time() + 1, cancel) is None
+
+
+def test_wait_async():
+    async def main():
+        cancel = asyncio.Event()
+        error = await PreciseTimer().wait_async(time.time() + 0.05, cancel)
+        asyncio.get_running_loop().call_later(0.02, cancel.set)
+        return error, await PreciseTimer().wait_async(time.time() + 1, cancel)
+
+    error, cancelled = asyncio.run(main())
+    # 事件循环的计时器精度更低
+    assert 0 <= error < 0.05
+    assert cancelled is None
@@ -0,0 +1,57 @@
+import socket
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+from config import config
+from errors import SessionExpiredException
+from fake_upstream import NOT_OPEN, SLOT_TAKEN
+from retry import RetryPolicy, RETRY_NOW, BACKOFF, RELOGIN, ABORT
+
+
+def http_error(code):
+    return HTTPError('http://example.com', code, 'error', {}, None)
+
+
+def test_classify_result_matches_first_rule():
+    policy = RetryPolicy()
+    assert policy.classify_result(NOT_OPEN) == RETRY_NOW
+    assert policy.classify_result(SLOT_TAKEN) == ABORT
+    assert policy.classify_result('您没有权限预约该仪器') == ABORT
+    assert policy.classify_result('未知的错误') == config.RETRY_DEFAULT
+    assert policy.classify_result(None) == config.RETRY_DEFAULT
+
+    policy = RetryPolicy(rules=[('已被预约', RETRY_NOW), ('预约', ABORT)])
+    assert policy.classify_result(SLOT_TAKEN) == RETRY_NOW
+
+
+def test_classify_exception():
+    policy = RetryPolicy(http_rules={503: RETRY_NOW})
+    assert policy.classify_exception(SessionExpiredException('expired')) == RELOGIN
+    assert policy.classify_exception(http_error(503)) == RETRY_NOW
+    # 不在分类表中的状态码：5xx退避，其余不再重试
+    assert policy.classify_exception(http_error(500)) == BACKOFF
+    assert policy.classify_exception(http_error(404)) == ABORT
+    assert policy.classify_exception(URLError('refused')) == BACKOFF
+    assert policy.classify_exception(socket.timeout()) == BACKOFF
+    assert policy.classify_exception(ConnectionResetError()) == BACKOFF
+    assert policy.classify_exception(ValueError('bad')) == config.RETRY_DEFAULT
+
+
+def test_delay():
+    policy = RetryPolicy()
+    delays = [policy.delay(BACKOFF, i) for i in range(10)]
+    assert delays[0] == config.RETRY_BACKOFF_BASE
+    assert delays[1] == config.RETRY_BACKOFF_BASE * 2
+    assert max(delays) == config.RETRY_BACKOFF_MAX
+    assert delays == sorted(delays)
+    assert policy.delay(RETRY_NOW) == config.RETRY_NOW_DELAY
+    assert policy.delay(RELOGIN) == 0
+    assert policy.delay(ABORT) == 0
+
+
+def test_unknown_action():
+    with pytest.raises(ValueError):
+        RetryPolicy(rules=[('已被预约', 'give_up')])
+    with pytest.raises(ValueError):
+        RetryPolicy(default='wait')
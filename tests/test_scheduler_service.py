@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import fcntl
+import datetime
+import subprocess
+from uuid import uuid4
+
+import pytest
+from flask import Flask
+
+import scheduler_service
+from config import config
+from errors import SchedulerException
+from fake_upstream import FakeUpstream
+from reserve import keep_reserve_job
+from scheduler import SchedulerHandler
+from scheduler_service import RemoteSchedulerHandler, AUTHKEY_ENV
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUTHKEY = 'test-authkey'
+
+# 单独的scheduler进程，与conftest相同的测试配置
+SERVE = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import config as Config
+Config.config = Config.get_config('debug')
+Config.config.SCHEDULER_STORE_URL = sys.argv[2]
+Config.config.UPSTREAM_URL = sys.argv[3]
+Config.config.AVAILABILITY_MODE = 'off'
+import scheduler_service
+scheduler_service.serve()
+'''
+
+
+def start_scheduler(store_url, upstream_url, cwd):
+    env = dict(os.environ, **{AUTHKEY_ENV: AUTHKEY})
+    return subprocess.Popen([sys.executable, '-c', SERVE, ROOT, store_url, upstream_url], cwd=str(cwd), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+@pytest.fixture(scope='module')
+def remote(tmp_path_factory):
+    """在子进程中运行的scheduler，以及本进程中转发给它的RemoteSchedulerHandler"""
+    path = tmp_path_factory.mktemp('remote')
+    store_url = 'sqlite:///%s' % (path / 'jobs.sqlite')
+    fake = FakeUpstream()
+    process = start_scheduler(store_url, fake.start(), path)
+    saved = dict(store_url=config.SCHEDULER_STORE_URL, instance=RemoteSchedulerHandler._instance,
+                 authkey=os.environ.get(AUTHKEY_ENV))
+    config.SCHEDULER_STORE_URL = store_url
+    os.environ[AUTHKEY_ENV] = AUTHKEY
+    RemoteSchedulerHandler._instance = None
+    socket_path = str(path / 'jobs.sqlite.sock')
+    deadline = time.time() + 20
+    while not os.path.exists(socket_path):
+        assert process.poll() is None, process.stderr.read().decode()
+        assert time.time() < deadline
+        time.sleep(0.05)
+    yield RemoteSchedulerHandler(), store_url, path
+    process.terminate()
+    process.wait()
+    fake.stop()
+    config.SCHEDULER_STORE_URL = saved['store_url']
+    RemoteSchedulerHandler._instance = saved['instance']
+    if saved['authkey'] is None:
+        os.environ.pop(AUTHKEY_ENV, None)
+    else:
+        os.environ[AUTHKEY_ENV] = saved['authkey']
+
+
+def test_round_trip(remote):
+    handler = remote[0]
+    version = handler.get_version('remote_user')
+    trigger_time = (datetime.datetime.now() + datetime.timedelta(days=1)).replace(microsecond=0)
+    kwargs = dict(username='remote_user', password='p', trigger_time=trigger_time, alternatives=[],
+                  reserve_data=dict(instrumentId='F20', reserveDate='2030年01月02日', reserveStartTime='9:00',
+                                    reserveEndTime='13:00'))
+    # run_date由scheduler进程按它的时钟计算
+    [job] = handler.add_jobs([(uuid4().hex, keep_reserve_job, None, kwargs, None)])
+    run_date = job.next_run_time.replace(tzinfo=None)
+    expected = trigger_time - datetime.timedelta(seconds=config.WARMUP_SECONDS)
+    assert abs((run_date - expected).total_seconds()) < 2
+
+    assert handler.get_user_job_ids('remote_user') == {job.id}
+    assert handler.get_version('remote_user') != version
+    assert handler.remove_job(job.id, 'remote_user')
+    assert handler.get_user_job_ids('remote_user') == set()
+
+
+def test_errors_are_raised_in_web_process(remote):
+    handler = remote[0]
+    with pytest.raises(SchedulerException):
+        handler._call('start')
+    # 出错后连接仍可以继续使用
+    assert handler.get_user_job_ids('nobody') == set()
+
+
+def test_wrong_authkey(remote, monkeypatch):
+    monkeypatch.setattr(RemoteSchedulerHandler, '_instance', None)
+    monkeypatch.setenv(AUTHKEY_ENV, 'wrong')
+    with pytest.raises(SchedulerException):
+        RemoteSchedulerHandler().get_version('alice')
+
+
+def test_clock_and_metrics_come_from_scheduler(remote, monkeypatch):
+    from api import api
+    handler = remote[0]
+    deadline = time.time() + 20
+    # scheduler启动时校准时钟
+    while handler.clock_status()['error'] is None:
+        assert time.time() < deadline
+        time.sleep(0.1)
+    monkeypatch.setattr(config, 'SCHEDULER_MODE', 'remote')
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    client = app.test_client()
+
+    clock = client.get('/api/clock').get_json(force=True)['clock']
+    assert clock['error'] is not None and clock['samples'] > 0
+
+    text = client.get('/api/metrics').get_data(as_text=True)
+    assert 'tem_server_clock_seconds{process="scheduler",stat="offset"}' in text
+    assert text.count('# TYPE tem_reserve_post_seconds histogram') == 1
+
+
+def test_second_scheduler_is_refused(remote):
+    handler, store_url, path = remote
+    process = start_scheduler(store_url, 'http://127.0.0.1:9', path)
+    _, stderr = process.communicate(timeout=30)
+    assert process.returncode != 0
+    assert b'another scheduler' in stderr
+    # 第一个scheduler不受影响
+    assert handler.get_user_job_ids('nobody') == set()
+
+
+def test_acquire_lock_refused(tmp_path, monkeypatch):
+    path = str(tmp_path / 'jobs.lock')
+    monkeypatch.setattr(config, 'SCHEDULER_LOCK_FILE', path)
+    with open(path, 'a+') as held:
+        fcntl.flock(held, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        held.write('12345')
+        held.flush()
+        handler = SchedulerHandler()
+        monkeypatch.setattr(handler, 'lock_file', handler.lock_file)
+        with pytest.raises(SchedulerException, match='12345'):
+            handler._acquire_lock()
+
+
+def test_authkey_file_permissions(tmp_path, monkeypatch):
+    monkeypatch.delenv(AUTHKEY_ENV, raising=False)
+    key_file = tmp_path / 'authkey'
+    key_file.write_text('secret\n')
+    monkeypatch.setattr(config, 'SCHEDULER_AUTHKEY_FILE', str(key_file))
+    key_file.chmod(0o644)
+    with pytest.raises(SchedulerException):
+        scheduler_service.scheduler_authkey()
+    key_file.chmod(0o600)
+    assert scheduler_service.scheduler_authkey() == b'secret'